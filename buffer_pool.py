@@ -1,99 +1,593 @@
+from buffer_stats import BufferStats
 from page import Page
-import threading
-import collections
+from page_writer import PageWriter
+from read_ahead import ReadAhead
+from replacement_policy import POLICIES
+from scan_ring import ScanRing
+import config
+import copy
 import os
+import threading
+import time
 
-class BufferPool:
-    
-    def __init__(self, size):
+class BufferPoolShard:
+
+    """
+    A shard is a fixed array of size frames with its own latch. frame_map maps
+    a (table_name, page_id) pair directly to the frame that holds that page,
+    and free_frames holds the frames that have never been used (or have been
+    released). Once there are no free frames, victims are chosen by the
+    shard's replacement policy (see replacement_policy).
+
+    Frames that hold pages read by a bulk operation running in a scan ring
+    (see ScanRing) are kept out of the policy, in ring_frames, and are reused
+    by the ring itself, so a scan does not evict the rest of the shard. If
+    another thread requests such a page, the frame is handed to the policy.
+
+    Disk I/O never happens while holding the latch. A page that is being read
+    in is already in frame_map, pinned, with an event in loading; a page whose
+    dirty contents are being written back on eviction has an event in writing.
+    Threads that want either page wait on its event instead of issuing their
+    own I/O, while requests for other pages go ahead.
+
+    stats (see BufferStats) is only updated while holding the latch.
+    """
+    def __init__(self, pool, size, policy):
+        self.pool = pool
         self.limit = size
-        self.pages = []
-        self.table_index = {}
-        self.eviction_queue = collections.OrderedDict()
-        self.buffer_lock = threading.Lock()
-
-    def get_page(self, table_name, page_id):
-        self.buffer_lock.acquire()
-        if table_name in self.table_index:
-            sub_directory = self.table_index[table_name]
-        else:
-            self.table_index[table_name] = {}
-            sub_directory = self.table_index[table_name]
-
-        if page_id in sub_directory:
-            location = sub_directory[page_id]
-            if (table_name, page_id) in self.eviction_queue:
-                self.eviction_queue.pop((table_name, page_id))
-            self.eviction_queue[(table_name, page_id)] = None
-            self.buffer_lock.release()
-            return self.pages[location]
-        else:
-            if len(self.pages) < self.limit:
-                location = self.fetch(table_name, page_id, None) 
-                if (table_name, page_id) in self.eviction_queue:
-                    self.eviction_queue.pop((table_name, page_id))
-                self.eviction_queue[(table_name, page_id)] = None
-                sub_directory[page_id] = location
-                self.buffer_lock.release()
-                return self.pages[location]
+        self.frames = [None]*size
+        self.frame_keys = [None]*size
+        self.frame_map = {}
+        self.free_frames = list(range(size - 1, -1, -1))
+        self.policy = POLICIES[policy](size)
+        self.ring_frames = {}
+        self.latch = threading.Lock()
+        self.frame_released = threading.Condition(self.latch)
+        self.loading = {}
+        self.writing = {}
+        self.stats = BufferStats()
+        """
+        Hits are counted per frame, which is cheaper than updating the per
+        table counters on every request, and folded into stats when the page
+        leaves its frame or when the stats are read.
+        """
+        self.frame_hits = [0]*size
+
+    """
+    Waits for the latch, timing the wait. Callers first try to take the latch
+    without blocking, so uncontended acquisitions are not timed.
+    """
+    def _wait_for_latch(self):
+        start_time = time.perf_counter()
+        self.latch.acquire()
+        self.stats.record_latch_wait(time.perf_counter() - start_time)
+
+    def get_page(self, table_name, page_id, pin):
+        key = (table_name, page_id)
+        if not self.latch.acquire(False):
+            self._wait_for_latch()
+        while True:
+            frame = self.frame_map.get(key)
+            if frame is not None:
+                event = self.loading.get(key)
             else:
-               location = self.evict()
-               self.fetch(table_name, page_id, location)
-               sub_directory[page_id] = location
-               if (table_name, page_id) in self.eviction_queue:
-                   self.eviction_queue.pop((table_name, page_id))
-               self.eviction_queue[(table_name, page_id)] = None
-               self.buffer_lock.release()
-               return self.pages[location]
-
-    def fetch(self, table_name, page_id, location):
-        path = table_name+'/page_file'
-        f = open(path, mode='rb+')
-        f.seek(4096*page_id)
-        read_data = f.read(4096)
+                event = self.writing.get(key)
+            if event is not None:
+                # another thread is reading or writing back this page:
+                self.latch.release()
+                event.wait()
+                self.latch.acquire()
+                continue
+
+            if frame is not None:
+                page = self.frames[frame]
+                self.frame_hits[frame] += 1
+                if self.ring_frames and frame in self.ring_frames:
+                    self._ring_hit(frame)
+                elif not self.pool.rings or threading.get_ident() not in self.pool.rings:
+                    # (requests from bulk operations do not count as reuse)
+                    self.policy.access(frame)
+                if pin:
+                    page.pin()
+                self.latch.release()
+                return page
+
+            ring = self.pool.rings.get(threading.get_ident()) if self.pool.rings else None
+            if ring is not None and ring.closed:
+                ring = None
+            try:
+                if self.free_frames:
+                    frame = self.free_frames.pop()
+                    victim = None
+                else:
+                    frame = None
+                    if ring is not None:
+                        frame = ring.reusable_frame(self)
+                    if frame is not None:
+                        victim = self._detach(frame)
+                    else:
+                        frame, victim = self.evict()
+            except Exception:
+                self.latch.release()
+                raise
+            if key not in self.frame_map and key not in self.writing:
+                break
+            # evict() had to wait for a frame, and another thread has read the
+            # page in meanwhile. Give the frame back and start over.
+            self.ring_frames.pop(frame, None)
+            self.free_frames.append(frame)
+            if victim is not None:
+                self.latch.release()
+                self._write_back(*victim)
+                self.latch.acquire()
+
         page = Page(page_id)
-        page.load_data(read_data)
-        if location == None:
-            self.pages.append(page)
-            location = self.pages.index(page)
+        page.pin()
+        loaded = threading.Event()
+        self.frames[frame] = page
+        self.frame_keys[frame] = key
+        self.frame_map[key] = frame
+        if ring is not None and not ring.closed and (
+                self.ring_frames.get(frame) is ring or ring.add(self, frame)):
+            self.ring_frames[frame] = ring
         else:
-            self.pages[location] = page
-        f.close()
-        return location
+            self.ring_frames.pop(frame, None)
+            self.policy.admit(frame, key)
+        self.loading[key] = loaded
+        self.latch.release()
+        prefetching = self.pool.read_ahead.record_miss(table_name, page_id)
 
+        try:
+            if victim is not None:
+                self._write_back(*victim)
+            start_time = time.perf_counter()
+            self.pool.fetch(table_name, page_id, page)
+            miss_time = time.perf_counter() - start_time
+        except Exception:
+            with self.latch:
+                del self.frame_map[key]
+                if self.ring_frames.pop(frame, None) is None:
+                    self.policy.remove(frame)
+                self.frames[frame] = None
+                self.frame_keys[frame] = None
+                self.free_frames.append(frame)
+                del self.loading[key]
+            loaded.set()
+            raise
+        with self.latch:
+            del self.loading[key]
+            if prefetching:
+                self.stats.prefetches += 1
+            else:
+                self.stats.record_miss(table_name, page_id, miss_time)
+            if not pin:
+                page.unpin()
+        loaded.set()
+        return page
+
+    """
+    Writes a dirty victim back to disk and then lets threads that are waiting
+    to read the victim page back in go ahead.
+    """
+    def _write_back(self, key, page, written):
+        try:
+            self.pool.write_page(page, key[1], key[0])
+        finally:
+            with self.latch:
+                del self.writing[key]
+            written.set()
+
+    """
+    Frees a frame by evicting its page. Must be called while holding the latch.
+    Returns the frame and, if the evicted page is dirty, a (key, page, event)
+    triple for the write-back, which the caller performs after releasing the
+    latch. If every frame is pinned, the calling thread waits (releasing the
+    latch) for pages to be unpinned, for at most config.PIN_WAIT_TIMEOUT
+    seconds.
+    """
     def evict(self):
-        location = None
-        for e in self.eviction_queue:
-            page = self.pages[self.table_index[e[0]][e[1]]]
-            if page.pinned == 0:
-                self.eviction_queue.pop(e)
-                if page.dirty:
-                    self.write_page(page, e[1], e[0])
-                del self.table_index[e[0]][e[1]]
-                location = self.pages.index(page)
+        deadline = None
+        while True:
+            frame = self._choose_victim()
+            if frame is not None:
                 break
-            else:
+            if deadline is None:
+                wait_start = time.monotonic()
+                deadline = wait_start + config.PIN_WAIT_TIMEOUT
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stats.record_pin_wait(time.monotonic() - wait_start)
+                raise Exception('buffer pool error: all pages are pinned')
+            self.frame_released.wait(min(remaining, 0.01))
+            # a frame may have been released while we were waiting:
+            if self.free_frames:
+                self.stats.record_pin_wait(time.monotonic() - wait_start)
+                return self.free_frames.pop(), None
+        if deadline is not None:
+            self.stats.record_pin_wait(time.monotonic() - wait_start)
+        self.policy.remove(frame, evicted=True)
+        return frame, self._detach(frame)
+
+    """
+    Takes the page out of frame so the frame can be reused, and returns the
+    write-back triple if the page is dirty (see evict). Must be called while
+    holding the latch.
+    """
+    def _detach(self, frame):
+        page = self.frames[frame]
+        key = self.frame_keys[frame]
+        self._fold_hits(frame)
+        self.stats.record_eviction(key[0], page.dirty)
+        victim = None
+        if page.dirty:
+            victim = (key, page, threading.Event())
+            self.writing[key] = victim[2]
+        del self.frame_map[key]
+        self.frames[frame] = None
+        self.frame_keys[frame] = None
+        return victim
+
+    """
+    Walks the policy's eviction candidates until it finds an unpinned frame.
+    While the background writer is running, clean frames are preferred: once
+    a dirty candidate has been found, up to config.WRITER_CLEAN_SEARCH more
+    candidates are looked at for a clean one before settling for it. Either
+    way, the writer is woken up to clean the dirty candidates, which would
+    otherwise keep being passed over in favor of clean (possibly hot) pages.
+    Returns None if every frame is pinned.
+    """
+    def _choose_victim(self):
+        frames = self.frames
+        dirty_frame = None
+        search = 0
+        prefer_clean = self.pool.writer.thread is not None
+        for frame in self.policy.candidates():
+            page = frames[frame]
+            if page.pinned != 0:
                 continue
-        if location == None:
-            print('fatal buffer pool error: all pages are pinned')
-            os._exit(1)
-        return location
+            if not page.dirty or not prefer_clean:
+                if dirty_frame is not None:
+                    self.pool.writer.notify()
+                return frame
+            if dirty_frame is None:
+                dirty_frame = frame
+            search += 1
+            if search > config.WRITER_CLEAN_SEARCH:
+                break
+        if dirty_frame is not None:
+            self.pool.writer.notify()
+        return dirty_frame
+
+    """
+    A page in a scan ring's frame has been requested. If the request comes
+    from outside the ring, the page is evidently shared, so the frame leaves
+    the ring and joins the policy.
+    """
+    def _ring_hit(self, frame):
+        if self.pool.rings.get(threading.get_ident()) is not self.ring_frames[frame]:
+            del self.ring_frames[frame]
+            self.policy.admit(frame, self.frame_keys[frame])
+
+    """
+    Hands the frames of a finished scan ring over to the policy, as the first
+    candidates for eviction.
+    """
+    def release_ring(self, ring):
+        with self.latch:
+            for frame in ring.frames.pop(self, ()):
+                if self.ring_frames.get(frame) is ring:
+                    del self.ring_frames[frame]
+                    self.policy.admit(frame, self.frame_keys[frame], cold=True)
+
+    """
+    Returns the (table_name, page_id, page) triples of every dirty page in the
+    shard.
+    """
+    def dirty_pages(self):
+        with self.latch:
+            dirty = []
+            for key, frame in self.frame_map.items():
+                page = self.frames[frame]
+                if page.dirty and key not in self.loading:
+                    dirty.append((key[0], key[1], page))
+            return dirty
+
+    """
+    Returns the events of the write-backs of evicted pages that are still in
+    progress.
+    """
+    def pending_writes(self):
+        with self.latch:
+            return list(self.writing.values())
+
+    """
+    Pins and returns a page if it is currently resident (and not still being
+    read in), without reading it in otherwise.
+    """
+    def pin_resident(self, table_name, page_id):
+        key = (table_name, page_id)
+        with self.latch:
+            frame = self.frame_map.get(key)
+            if frame is None or key in self.loading:
+                return None
+            page = self.frames[frame]
+            page.pin()
+            return page
+
+    """
+    Moves the hits counted for a frame into stats. Must be called while holding
+    the latch.
+    """
+    def _fold_hits(self, frame):
+        hits = self.frame_hits[frame]
+        if hits:
+            self.frame_hits[frame] = 0
+            self.stats.record_hits(self.frame_keys[frame], hits)
+
+    """
+    Returns a copy of the shard's stats, including the hits on pages that are
+    still resident.
+    """
+    def snapshot_stats(self):
+        with self.latch:
+            for frame in self.frame_map.values():
+                self._fold_hits(frame)
+            return copy.deepcopy(self.stats)
+
+    def reset_stats(self):
+        with self.latch:
+            self.stats.reset()
+            self.frame_hits = [0]*self.limit
+
+    def enable_heat_map(self, enabled):
+        with self.latch:
+            for frame in self.frame_map.values():
+                self._fold_hits(frame)
+            self.stats.enable_heat_map(enabled)
+
+    def drop_table(self, table_name):
+        with self.latch:
+            for key in [key for key in self.frame_map if key[0] == table_name]:
+                frame = self.frame_map.pop(key)
+                self._fold_hits(frame)
+                if self.ring_frames.pop(frame, None) is None:
+                    self.policy.remove(frame)
+                self.frames[frame] = None
+                self.frame_keys[frame] = None
+                self.free_frames.append(frame)
+
+
+class BufferPool:
+
+    """
+    The buffer pool is split into hash-partitioned shards (see
+    BufferPoolShard), each with its own latch, so threads only contend when
+    they want pages that live in the same shard.
+    policy names the replacement policy (see replacement_policy.POLICIES); it
+    defaults to config.BUFFER_POOL_POLICY.
+    """
+    def __init__(self, size, policy=None):
+        self.limit = size
+        self.policy = policy or config.BUFFER_POOL_POLICY
+        if self.policy not in POLICIES:
+            raise Exception('buffer pool error: unknown replacement policy ' + str(self.policy))
+        num_shards = max(1, min(config.BUFFER_POOL_SHARDS, size))
+        self.shards = []
+        for i in range(num_shards):
+            shard_size = size // num_shards + (1 if i < size % num_shards else 0)
+            self.shards.append(BufferPoolShard(self, shard_size, self.policy))
+        """
+        The scan ring (see ScanRing) of every thread that is currently running
+        a bulk operation, by thread id.
+        """
+        self.rings = {}
+        """
+        One open file descriptor per table page file. Page I/O uses
+        positional reads and writes (pread/pwrite), so a single descriptor
+        can be shared by every thread.
+        """
+        self.files = {}
+        self.file_lock = threading.Lock()
+        self.writer = PageWriter(self)
+        self.read_ahead = ReadAhead(self)
+        """
+        The write-ahead log of the database, if it has one (see flush_log).
+        """
+        self.wal = None
+
+    def get_shard(self, table_name, page_id):
+        return self.shards[hash((table_name, page_id)) % len(self.shards)]
+
+    """
+    Returns the requested page, reading it into the pool if necessary. If pin
+    is True, the page is pinned before it is returned so it cannot be evicted
+    until the caller unpins it.
+    """
+    def get_page(self, table_name, page_id, pin=False):
+        return self.get_shard(table_name, page_id).get_page(table_name, page_id, pin)
+
+    def is_resident(self, table_name, page_id):
+        return (table_name, page_id) in self.get_shard(table_name, page_id).frame_map
+
+    """
+    Returns a scan ring for a bulk operation (a scan, merge or index build):
+
+        with bp.scan_ring():
+            ...
+
+    While the block runs, pages the calling thread reads into the pool are
+    kept in a small private ring of config.SCAN_RING_SIZE frames instead of
+    displacing the pages other threads are working with.
+    """
+    def scan_ring(self):
+        return ScanRing(self, config.SCAN_RING_SIZE)
+
+    """
+    Returns the scan ring the calling thread is running in, if any.
+    """
+    def current_ring(self):
+        if not self.rings:
+            return None
+        return self.rings.get(threading.get_ident())
+
+    """
+    Hints that page_ids of table_name will be needed soon, so they are read
+    into the pool in the background (see ReadAhead).
+    """
+    def prefetch(self, table_name, page_ids):
+        self.read_ahead.prefetch(table_name, page_ids)
+
+    """
+    Pins and returns the page if it is resident in the pool, else None.
+    """
+    def pin_resident(self, table_name, page_id):
+        return self.get_shard(table_name, page_id).pin_resident(table_name, page_id)
+
+    """
+    Unpins a page that was obtained with get_page(..., pin=True). Threads
+    waiting for an evictable frame poll for unpinned pages, so this does not
+    have to find the page's shard.
+    """
+    def unpin(self, page):
+        page.unpin()
+
+    """
+    Returns the file descriptor of a table's page file, opening it on first
+    use.
+    """
+    def get_file(self, table_name):
+        fd = self.files.get(table_name)
+        if fd is None:
+            with self.file_lock:
+                fd = self.files.get(table_name)
+                if fd is None:
+                    fd = os.open(table_name+'/page_file', os.O_RDWR)
+                    self.files[table_name] = fd
+        return fd
+
+    """
+    Closes the page file of a table, if it is open.
+    """
+    def close_file(self, table_name):
+        with self.file_lock:
+            fd = self.files.pop(table_name, None)
+            if fd is not None:
+                os.close(fd)
+
+    """
+    Reads a page from disk directly into the slot array of page.
+    """
+    def fetch(self, table_name, page_id, page):
+        fd = self.get_file(table_name)
+        os.preadv(fd, [page.prepare_load()], 4096*page_id)
+        page.finish_load()
+        return page
+
+    """
+    Returns the on-disk image of a page that is not resident, without reading
+    the page into the pool, or None if it is resident or being written back
+    (the image on disk may not be current then). Only meant for pages that
+    are never written to again, such as merged base pages (see
+    ColumnScanner._summarize_page_range).
+    """
+    def read_image(self, table_name, page_id):
+        key = (table_name, page_id)
+        shard = self.get_shard(table_name, page_id)
+        if key in shard.frame_map or key in shard.writing:
+            return None
+        return os.pread(self.get_file(table_name), 4096, 4096*page_id)
 
     def write_page(self, page, page_id, table_name):
-        path = table_name+'/page_file'
         try:
-            f = open(path, mode='rb+')
-            f.seek(4096*page_id)
-            f.write(page.data)
-            f.close
+            fd = self.get_file(table_name)
         except FileNotFoundError:
-            pass
+            return
+        page.dirty = False
+        data = page.data
+        self.flush_log(page.lsn)
+        os.pwrite(fd, data, 4096*page_id)
+
+    """
+    Write-ahead logging: a page may only be written once the log is on disk up
+    to the page's lsn (read after copying the page data, so the copy never
+    holds a change whose record is not covered). Without an lsn, flushes the
+    whole log.
+    """
+    def flush_log(self, lsn=None):
+        if self.wal is not None and (lsn is None or lsn > self.wal.flushed_lsn):
+            self.wal.flush(lsn)
 
+    """
+    Waits for the write-backs of evicted pages that are in progress and then
+    fsyncs every open page file, so every page written so far is on disk.
+    """
+    def sync_files(self):
+        for shard in self.shards:
+            for written in shard.pending_writes():
+                written.wait()
+        with self.file_lock:
+            for fd in self.files.values():
+                os.fsync(fd)
+
+    """
+    Returns the (table_name, page_id, page) triples of every dirty page in the
+    pool.
+    """
+    def dirty_pages(self):
+        dirty = []
+        for shard in self.shards:
+            dirty.extend(shard.dirty_pages())
+        return dirty
+
+    """
+    Returns the combined counters of every shard (see BufferStats.combine),
+    together with the progress of the background writer and of read-ahead.
+    """
+    def snapshot_stats(self):
+        snapshot = BufferStats.combine(
+                [shard.snapshot_stats() for shard in self.shards])
+        snapshot['writer'] = self.writer.progress()
+        snapshot['read_ahead'] = {
+                'pages_requested': self.read_ahead.pages_requested,
+                'pages_loaded': self.read_ahead.pages_loaded}
+        return snapshot
+
+    def reset_stats(self):
+        for shard in self.shards:
+            shard.reset_stats()
+
+    """
+    Turns per page access counting on or off (it keeps a counter for every
+    page that has been requested since, so it is off by default).
+    """
+    def enable_heat_map(self, enabled=True):
+        for shard in self.shards:
+            shard.enable_heat_map(enabled)
+
+    """
+    Writes every dirty page back to disk, in batches (see PageWriter).
+    """
     def flush(self):
-        for table in self.table_index:
-            sub_directory = self.table_index[table]
-            for page_id in sub_directory:
-                location = sub_directory[page_id]
-                page = self.pages[location]
-                if page.dirty:
-                    self.write_page(page, page_id, table) 
+        self.writer.flush()
+
+    """
+    Discards every page of a table from the pool without writing it back, and
+    closes the table's page file. Used when a table is dropped.
+    """
+    def drop_table(self, table_name):
+        self.read_ahead.stop()
+        for shard in self.shards:
+            shard.drop_table(table_name)
+        self.close_file(table_name)
+
+    """
+    Writes back every dirty page and closes all open page files.
+    """
+    def close(self):
+        self.read_ahead.stop()
+        self.writer.stop()
+        self.flush()
+        with self.file_lock:
+            for fd in self.files.values():
+                os.close(fd)
+            self.files = {}
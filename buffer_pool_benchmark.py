@@ -0,0 +1,68 @@
+from db import Database
+from query import Query
+from random import randrange, seed
+import config
+import os
+import tempfile
+import threading
+import time
+
+"""
+Point lookups against a small, hot table while another thread keeps scanning
+a table that is several times larger than the buffer pool. Prints the buffer
+pool hit rate of the point lookups for every replacement policy, with and
+without scan rings.
+"""
+
+POOL_SIZE = 160
+HOT_RECORDS = 6000
+SCAN_RECORDS = 60000
+RUN_TIME = 3
+
+def run(policy, ring_size):
+    config.BUFFER_POOL_POLICY = policy
+    config.BUFFER_POOL_SIZE = POOL_SIZE
+    config.SCAN_RING_SIZE = ring_size
+    os.chdir(tempfile.mkdtemp())
+    db = Database()
+    db.open(os.getcwd() + '/db')
+    hot_query = Query(db.create_table('Hot', 5, 0))
+    scan_query = Query(db.create_table('Scan', 5, 0))
+    hot_query.insert_many([[key, key, key, key, key] for key in range(HOT_RECORDS)])
+    scan_query.insert_many([[key, key, key, key, key] for key in range(SCAN_RECORDS)])
+
+    stopping = False
+    lookups = [0]
+    scans = [0]
+    def point_lookups():
+        while not stopping:
+            hot_query.select(randrange(HOT_RECORDS), 0, [1, 1, 1, 1, 1])
+            lookups[0] += 1
+    def full_scans():
+        while not stopping:
+            scan_query.sum(0, SCAN_RECORDS - 1, 1)
+            scans[0] += 1
+
+    # warm the pool up with the hot table before measuring:
+    for key in range(HOT_RECORDS):
+        hot_query.select(key, 0, [1, 1, 1, 1, 1])
+    db.reset_buffer_stats()
+    threads = [threading.Thread(target=point_lookups), threading.Thread(target=full_scans)]
+    for thread in threads:
+        thread.start()
+    time.sleep(RUN_TIME)
+    stopping = True
+    for thread in threads:
+        thread.join()
+    stats = db.buffer_stats()
+    db.close()
+    hot = stats['tables']['Hot']
+    return hot['hit_rate'], hot['misses'], lookups[0], scans[0]
+
+seed(165)
+print('policy\tscan ring\thot hit rate\thot misses\tlookups\tscans')
+for policy in ['clock', 'lru', '2q', 'arc']:
+    for ring_size in [0, 32]:
+        hit_rate, misses, lookups, scans = run(policy, ring_size)
+        print(policy, '\t', ring_size or 'off', '\t\t', round(hit_rate, 4), '\t\t',
+                misses, '\t\t', lookups, '\t', scans, sep='')
@@ -0,0 +1,116 @@
+"""
+Buffer pool instrumentation. Every BufferPoolShard owns one BufferStats object
+and only updates it while holding its own latch, so counting never needs a lock
+of its own; BufferPool.snapshot_stats adds the shards' counters together.
+
+Counted per pool and per table: hits, misses, evictions and dirty
+write-backs. Counted per pool: threads that had to wait for a shard latch or
+for an unpinned frame (and how long they waited), and a histogram of miss
+latencies, where bucket i counts misses that took less than 2^i microseconds
+(the last bucket also takes everything slower). Pages read in by read-ahead
+are counted as prefetches rather than misses.
+Optionally, per page access counts can be collected as well (the heat map);
+Database.buffer_stats folds these into per page range counts.
+"""
+HISTOGRAM_BUCKETS = 24
+
+TABLE_COUNTERS = ('hits', 'misses', 'evictions', 'writebacks')
+POOL_COUNTERS = ('latch_waits', 'latch_wait_time', 'pin_waits',
+        'pin_wait_time', 'miss_time', 'prefetches')
+
+class BufferStats:
+
+    def __init__(self):
+        self.heat_map = None
+        self.reset()
+
+    def reset(self):
+        for counter in POOL_COUNTERS:
+            setattr(self, counter, 0)
+        """
+        The per table counters map a table name to its count; the pool wide
+        totals are their sums.
+        """
+        self.hits = {}
+        self.misses = {}
+        self.evictions = {}
+        self.writebacks = {}
+        self.miss_latency = [0]*HISTOGRAM_BUCKETS
+        if self.heat_map is not None:
+            self.heat_map = {}
+
+    def enable_heat_map(self, enabled):
+        self.heat_map = {} if enabled else None
+
+    def record_hits(self, key, count):
+        self.hits[key[0]] = self.hits.get(key[0], 0) + count
+        if self.heat_map is not None:
+            self.heat_map[key] = self.heat_map.get(key, 0) + count
+
+    def record_miss(self, table_name, page_id, seconds):
+        self.misses[table_name] = self.misses.get(table_name, 0) + 1
+        self.miss_time += seconds
+        bucket = min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.miss_latency[bucket] += 1
+        if self.heat_map is not None:
+            key = (table_name, page_id)
+            self.heat_map[key] = self.heat_map.get(key, 0) + 1
+
+    def record_eviction(self, table_name, dirty):
+        self.evictions[table_name] = self.evictions.get(table_name, 0) + 1
+        if dirty:
+            self.writebacks[table_name] = self.writebacks.get(table_name, 0) + 1
+
+    def record_latch_wait(self, seconds):
+        self.latch_waits += 1
+        self.latch_wait_time += seconds
+
+    def record_pin_wait(self, seconds):
+        self.pin_waits += 1
+        self.pin_wait_time += seconds
+
+    """
+    Adds the counters of several BufferStats objects together into a plain
+    dictionary.
+    """
+    @staticmethod
+    def combine(stats_list):
+        snapshot = {counter: 0 for counter in POOL_COUNTERS}
+        snapshot['miss_latency'] = [0]*HISTOGRAM_BUCKETS
+        tables = {counter: {} for counter in TABLE_COUNTERS}
+        heat_map = None
+        for stats in stats_list:
+            for counter in POOL_COUNTERS:
+                snapshot[counter] += getattr(stats, counter)
+            for i in range(HISTOGRAM_BUCKETS):
+                snapshot['miss_latency'][i] += stats.miss_latency[i]
+            for counter in TABLE_COUNTERS:
+                BufferStats._add(tables[counter], getattr(stats, counter))
+            if stats.heat_map is not None:
+                if heat_map is None:
+                    heat_map = {}
+                BufferStats._add(heat_map, stats.heat_map)
+        for counter in TABLE_COUNTERS:
+            snapshot[counter] = sum(tables[counter].values())
+        snapshot['hit_rate'] = BufferStats._hit_rate(snapshot)
+        snapshot['tables'] = {}
+        table_names = set()
+        for counter in TABLE_COUNTERS:
+            table_names.update(tables[counter])
+        for table_name in table_names:
+            table = {counter: tables[counter].get(table_name, 0)
+                    for counter in TABLE_COUNTERS}
+            table['hit_rate'] = BufferStats._hit_rate(table)
+            snapshot['tables'][table_name] = table
+        snapshot['heat_map'] = heat_map
+        return snapshot
+
+    @staticmethod
+    def _add(totals, counts):
+        for key, count in counts.items():
+            totals[key] = totals.get(key, 0) + count
+
+    @staticmethod
+    def _hit_rate(counters):
+        requests = counters['hits'] + counters['misses']
+        return counters['hits'] / requests if requests else 0
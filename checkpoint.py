@@ -0,0 +1,122 @@
+import config
+import os
+import pickle
+import threading
+import time
+
+"""
+Fuzzy checkpoints. A checkpoint bounds the part of the write-ahead log that
+recovery has to replay, without stopping transactions while it runs:
+
+1. It notes the current end of the log (the checkpoint LSN) and the BEGIN LSN
+   of the oldest transaction that is still running.
+2. It frees for reuse the pages that merges retired before the checkpoint
+   LSN of the last checkpoint (see Table.reclaim_pages): that one is durable,
+   unlike this one until its master record is saved. Only then does it take
+   a snapshot of the metadata of every table (holding each table's latches
+   only for the copy, see Table.latch_all) and of the rid space allocator.
+   Every change logged before the checkpoint LSN is complete by then, since
+   changes are logged and made under the same latch.
+3. It writes back the pages that are dirty at that point, a batch of
+   config.CHECKPOINT_BATCH_PAGES pages at a time, and fsyncs the page files.
+   Pages dirtied while this runs are simply covered by the log.
+4. It saves the snapshots and a snapshot of every index, stamped with the
+   checkpoint LSN (see IndexSnapshot), and finally the master record
+   (root_path/checkpoint) with both LSNs. Every file is replaced atomically,
+   so a crash in the middle leaves the previous checkpoint usable.
+5. It deletes the log segments that are no longer needed.
+
+On open, Database.recover replays the log from the checkpoint LSN on top of
+the saved metadata and pages, and rolls back the transactions that never
+finished (see Table.redo and Table.undo). Replaying a change that the saved
+state already contains is harmless, so the snapshots do not have to match the
+checkpoint LSN exactly.
+
+Checkpoints are taken in the background every config.CHECKPOINT_INTERVAL
+seconds, or sooner once config.CHECKPOINT_LOG_SIZE bytes have been logged
+since the last one.
+"""
+
+"""
+Replaces the file at path with the pickled obj: the pickle is written to a
+temporary file, fsynced and renamed over path.
+"""
+def save_pickle(path, obj):
+    temp_path = path + '.tmp'
+    with open(temp_path, mode='wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class Checkpointer:
+
+    def __init__(self, db):
+        self.db = db
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.checkpoint_lock = threading.Lock()
+        """
+        The checkpoint LSN of the last checkpoint whose master record is
+        saved: recovery never starts before it.
+        """
+        self.last_lsn = 0
+        self.checkpoints = 0
+        self.last_checkpoint_time = 0
+        self.pages_freed = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        next_checkpoint = time.monotonic() + config.CHECKPOINT_INTERVAL
+        while not self.stopping:
+            self.wakeup.wait(min(config.CHECKPOINT_INTERVAL, 1))
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            log_size = self.db.wal.next_lsn - self.last_lsn
+            if (time.monotonic() >= next_checkpoint or
+                    log_size >= config.CHECKPOINT_LOG_SIZE):
+                self.checkpoint()
+                next_checkpoint = time.monotonic() + config.CHECKPOINT_INTERVAL
+
+    def checkpoint(self):
+        db = self.db
+        with self.checkpoint_lock:
+            start_time = time.monotonic()
+            checkpoint_lsn, undo_lsn = db.wal.checkpoint_lsns()
+            tables = {}
+            for table in db.tables:
+                self.pages_freed += table.reclaim_pages(self.last_lsn)
+                tables[table.name] = table.snapshot_metadata()
+            rid_space = db.rid_space.snapshot()
+            dirty = db.bp.dirty_pages()
+            for start in range(0, len(dirty), config.CHECKPOINT_BATCH_PAGES):
+                db.bp.writer.write_batch(dirty[start:start + config.CHECKPOINT_BATCH_PAGES])
+            db.bp.sync_files()
+            for table in db.tables:
+                table.save_metadata(tables[table.name])
+                table.index.save_snapshots(checkpoint_lsn)
+            save_pickle(db.root_path + '/rid_space', rid_space)
+            db.save_catalog()
+            save_pickle(db.root_path + '/checkpoint',
+                    {'checkpoint_lsn': checkpoint_lsn, 'undo_lsn': undo_lsn})
+            db.wal.truncate(min(checkpoint_lsn, undo_lsn))
+            self.last_lsn = checkpoint_lsn
+            self.checkpoints += 1
+            self.last_checkpoint_time = time.monotonic() - start_time
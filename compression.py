@@ -0,0 +1,205 @@
+from array import array
+from itertools import accumulate, chain, groupby, repeat
+from operator import add, mul, ne, sub
+import struct
+import sys
+
+"""
+Compressed images of merged base pages. Once a page range has been merged,
+its base column pages are never written to again (updates go to tail pages,
+and the next merge writes new base pages), and their values are mostly small
+numbers, counters and timestamps. Such pages are written to disk in one of
+these encodings, whichever is smallest:
+
+- FRAME_OF_REFERENCE: the smallest value, and every value minus it packed
+  into 0 (all values equal), 1, 2 or 4 bytes,
+- DELTA: the first value, and the difference between every value and the one
+  before it, packed the same way (for ascending keys and timestamps),
+- RUN_LENGTH: the distinct runs of values, as (value, length) pairs.
+
+Packing is byte-aligned, so packing and unpacking are array conversions that
+run in C. A compressed image still takes up the page's 4096 bytes in the page
+file (page ids are file offsets), padded with zeros. It starts with the TPS
+and then the encoding, negated, where a plain page has its record count (which
+is never negative), followed by the record count and the encoded values:
+
+    >q tps, >q -encoding, >H num_records, encoding header, packed values
+
+Packed values are stored in little-endian byte order. Pages are decoded when
+they are read into the buffer pool (see Page.finish_load), and summarize
+aggregates over a compressed image without decoding it (see
+ColumnScanner.aggregate).
+"""
+FRAME_OF_REFERENCE = 1
+DELTA = 2
+RUN_LENGTH = 3
+
+PAGE_SIZE = 4096
+HEADER = struct.Struct('>qqH')
+REFERENCE_HEADER = struct.Struct('>qB')
+DELTA_HEADER = struct.Struct('>qqB')
+RUN_HEADER = struct.Struct('>H')
+TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+SWAP_BYTES = sys.byteorder == 'big'
+
+"""
+Returns the number of bytes (0, 1, 2 or 4) needed to pack values that lie in
+[0, span], or None if they need more than 4.
+"""
+def packed_width(span):
+    if span == 0:
+        return 0
+    for width in (1, 2, 4):
+        if span < 1 << (8*width):
+            return width
+    return None
+
+def pack(values, reference, width):
+    if width == 0:
+        return b''
+    packed = array(TYPECODES[width], map(sub, values, repeat(reference)))
+    if SWAP_BYTES:
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack(data, count, width):
+    packed = array(TYPECODES[width])
+    packed.frombytes(data[:count*width])
+    if SWAP_BYTES:
+        packed.byteswap()
+    return packed
+
+"""
+Returns the compressed image of a page, given its slot array, or None if no
+encoding makes the page's values smaller.
+"""
+def encode_page(slots):
+    num_records = slots[1]
+    values = slots[2:num_records]
+    count = len(values)
+    if count == 0:
+        return None
+    # the sizes of the encodings are worked out first, and only the smallest
+    # is packed:
+    candidates = []
+    lo = min(values)
+    width = packed_width(max(values) - lo)
+    if width is not None:
+        candidates.append((REFERENCE_HEADER.size + count*width, FRAME_OF_REFERENCE, width))
+    num_runs = 1
+    if count > 1:
+        num_runs += sum(map(ne, values[1:], values[:-1]))
+        if width is None or width > 1:
+            deltas = list(map(sub, values[1:], values[:-1]))
+            delta_lo = min(deltas)
+            delta_width = packed_width(max(deltas) - delta_lo)
+            if delta_width is not None:
+                candidates.append((DELTA_HEADER.size + (count - 1)*delta_width,
+                        DELTA, delta_width))
+    candidates.append((RUN_HEADER.size + 10*num_runs, RUN_LENGTH, None))
+    size, encoding, width = min(candidates, key=lambda candidate: candidate[0])
+    if size >= 8*count:
+        return None
+    if encoding == FRAME_OF_REFERENCE:
+        payload = REFERENCE_HEADER.pack(lo, width) + pack(values, lo, width)
+    elif encoding == DELTA:
+        payload = DELTA_HEADER.pack(values[0], delta_lo, width) + pack(deltas, delta_lo, width)
+    else:
+        runs = [(value, len(list(run))) for value, run in groupby(values)]
+        run_values = array('q', [run[0] for run in runs])
+        run_lengths = array('H', [run[1] for run in runs])
+        if SWAP_BYTES:
+            run_values.byteswap()
+            run_lengths.byteswap()
+        payload = RUN_HEADER.pack(num_runs) + run_values.tobytes() + run_lengths.tobytes()
+    image = HEADER.pack(slots[0], -encoding, num_records) + payload
+    return image + bytes(PAGE_SIZE - len(image))
+
+"""
+Whether a page's on-disk image is compressed: its record count is negative.
+"""
+def is_compressed(image):
+    return len(image) >= HEADER.size and image[8] & 0x80 != 0
+
+def image_tps(image):
+    return HEADER.unpack_from(image)[0]
+
+"""
+Returns the values of the records of a compressed image, and the image's TPS
+and record count.
+"""
+def decode_values(image):
+    tps, encoding, num_records = HEADER.unpack_from(image)
+    count = num_records - 2
+    position = HEADER.size
+    if -encoding == FRAME_OF_REFERENCE:
+        lo, width = REFERENCE_HEADER.unpack_from(image, position)
+        if width == 0:
+            values = array('q', [lo])*count
+        else:
+            position += REFERENCE_HEADER.size
+            packed = unpack(image[position:], count, width)
+            values = array('q', map(add, packed, repeat(lo)))
+    elif -encoding == DELTA:
+        first, delta_lo, width = DELTA_HEADER.unpack_from(image, position)
+        if width == 0:
+            deltas = repeat(delta_lo, count - 1)
+        else:
+            position += DELTA_HEADER.size
+            deltas = map(add, unpack(image[position:], count - 1, width), repeat(delta_lo))
+        values = array('q', accumulate(deltas, initial=first))
+    elif -encoding == RUN_LENGTH:
+        run_values, run_lengths = _runs(image, position)
+        values = array('q', chain.from_iterable(map(repeat, run_values, run_lengths)))
+    else:
+        raise Exception('page error: unknown page encoding ' + str(-encoding))
+    return values, tps, num_records
+
+"""
+Returns the slot array of the page whose compressed image is given.
+"""
+def decode_page(image):
+    values, tps, num_records = decode_values(image)
+    slots = array('q', bytes(PAGE_SIZE))
+    slots[0] = tps
+    slots[1] = num_records
+    slots[2:num_records] = values
+    return slots
+
+def _runs(image, position):
+    (num_runs,) = RUN_HEADER.unpack_from(image, position)
+    position += RUN_HEADER.size
+    run_values = array('q')
+    run_values.frombytes(image[position:position + 8*num_runs])
+    position += 8*num_runs
+    run_lengths = array('H')
+    run_lengths.frombytes(image[position:position + 2*num_runs])
+    if SWAP_BYTES:
+        run_values.byteswap()
+        run_lengths.byteswap()
+    return run_values, run_lengths
+
+"""
+Returns (sum, count, min, max) of the record values of a compressed image,
+computed over the encoded values where the encoding allows it, or None if the
+image is not compressed or holds no records.
+"""
+def summarize(image):
+    if not is_compressed(image):
+        return None
+    tps, encoding, num_records = HEADER.unpack_from(image)
+    count = num_records - 2
+    if count <= 0:
+        return None
+    if -encoding == FRAME_OF_REFERENCE:
+        lo, width = REFERENCE_HEADER.unpack_from(image, HEADER.size)
+        if width == 0:
+            return lo*count, count, lo, lo
+        packed = unpack(image[HEADER.size + REFERENCE_HEADER.size:], count, width)
+        return lo*count + sum(packed), count, lo + min(packed), lo + max(packed)
+    if -encoding == RUN_LENGTH:
+        run_values, run_lengths = _runs(image, HEADER.size)
+        return (sum(map(mul, run_values, run_lengths)), count,
+                min(run_values), max(run_values))
+    values = decode_values(image)[0]
+    return sum(values), count, min(values), max(values)
@@ -3,3 +3,98 @@
 #
 def init():
     pass
+
+"""
+Query.sum switches from index lookups to a full columnar scan once the key
+range is expected to cover at least this fraction of the table's records.
+"""
+SCAN_SELECTIVITY = 0.125
+
+"""
+How long (in seconds) a thread waits for a frame to be unpinned when every
+frame in the buffer pool is pinned, before giving up with an error.
+"""
+PIN_WAIT_TIMEOUT = 5
+
+"""
+Number of frames in a database's buffer pool, and the number of independently
+latched shards the pool is partitioned into.
+"""
+BUFFER_POOL_SIZE = 600
+BUFFER_POOL_SHARDS = 8
+
+"""
+Page replacement policy of the buffer pool: 'clock', 'lru', '2q' or 'arc' (see
+replacement_policy), and the number of frames a scan ring may use (see
+ScanRing). A ring size of 0 lets bulk operations use the whole pool.
+"""
+BUFFER_POOL_POLICY = 'clock'
+SCAN_RING_SIZE = 64
+
+"""
+Background page writer settings (see PageWriter): how often the writer wakes
+up, the fraction of the pool that may be dirty before it starts writing, the
+longest run of adjacent pages written with a single call, and how many frames
+the eviction clock looks at for a clean victim after finding a dirty one.
+"""
+WRITER_INTERVAL = 0.5
+WRITER_DIRTY_RATIO = 0.2
+WRITER_MAX_RUN = 64
+WRITER_CLEAN_SEARCH = 16
+
+"""
+Buffer pool read-ahead settings (see ReadAhead): number of background I/O
+threads, consecutive misses on a table before read-ahead kicks in, number of
+pages read ahead, and the most pages that may be queued at once.
+"""
+READ_AHEAD_THREADS = 4
+READ_AHEAD_TRIGGER = 4
+READ_AHEAD_WINDOW = 32
+READ_AHEAD_MAX_PENDING = 256
+
+"""
+Size (in bytes) after which the write-ahead log starts a new segment file (see
+WriteAheadLog).
+"""
+WAL_SEGMENT_SIZE = 16*1024*1024
+
+"""
+Checkpoint settings (see Checkpointer): the longest time between two
+checkpoints, the amount of log (in bytes) after which a checkpoint is taken
+early, and how many dirty pages a checkpoint writes per batch.
+"""
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_LOG_SIZE = 64*1024*1024
+CHECKPOINT_BATCH_PAGES = 256
+
+"""
+Number of groups of page directory entries (255 records each) whose decoded
+entries are kept in memory (see PageDirectory).
+"""
+DIRECTORY_CACHE_GROUPS = 1024
+
+"""
+Merge triggers (see MergeScheduler): a page range whose base pages are full is
+queued for a merge once it has received MERGE_UPDATE_COUNT updates or
+MERGE_TAIL_SEGMENTS sets of tail pages since its last merge, or once a read
+had to follow MERGE_CHAIN_LENGTH of its tail records to find the current
+version of a record. 0 turns a trigger off.
+"""
+MERGE_UPDATE_COUNT = 1024
+MERGE_TAIL_SEGMENTS = 4
+MERGE_CHAIN_LENGTH = 16
+
+"""
+Whether merged base pages are written to disk compressed (see compression).
+"""
+COMPRESS_MERGED_PAGES = True
+
+"""
+Record locks (see LockManager): the number of independently latched shards
+of the lock table, how deadlocks between transactions are avoided
+('wait-die', 'wound-wait', 'timeout' or 'no-wait'), and the longest time (in
+seconds) a lock request waits before it fails.
+"""
+LOCK_SHARDS = 16
+LOCK_POLICY = 'wound-wait'
+LOCK_TIMEOUT = 2
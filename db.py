@@ -1,5 +1,11 @@
 from table import Table
 from buffer_pool import BufferPool
+from wal import WriteAheadLog, COMMIT, ABORT, INDEX
+from checkpoint import Checkpointer, save_pickle
+from merge_scheduler import MergeScheduler
+from lock_manager import LockManager
+import config
+import copy
 import os
 import pathlib
 import pickle
@@ -16,10 +22,17 @@ class RIDspace():
         self.rid_block = new_block
         return assigned_block
 
-    def assign_tail_rid(self):
-        assigned_rid = self.tail_rid
-        self.tail_rid = self.tail_rid - 1
-        return assigned_rid
+    """
+    Tail rids count down from 2^60, and are handed out to tables in blocks of
+    512 as well: (first, last) with first > last.
+    """
+    def assign_tail_space(self):
+        assigned_block = (self.tail_rid, self.tail_rid - 511)
+        self.tail_rid = self.tail_rid - 512
+        return assigned_block
+
+    def snapshot(self):
+        return copy.copy(self)
 
 
 class Database():
@@ -29,8 +42,23 @@ class Database():
         self.table_data = []
         self.table_map = {}
         self.rid_space = RIDspace()
-        self.bp = BufferPool(600)
+        self.bp = BufferPool(config.BUFFER_POOL_SIZE)
         self.root_path = None
+        """
+        The write-ahead log, which lives in root_path/wal once the database has
+        been opened.
+        """
+        self.wal = None
+        self.checkpointer = Checkpointer(self)
+        """
+        Merges the page ranges of every table in the background (see
+        MergeScheduler). Runs while the database is open.
+        """
+        self.merge_scheduler = MergeScheduler()
+        """
+        The record locks of the transactions on every table (see LockManager).
+        """
+        self.lock_manager = LockManager()
 
     """
     If open() is invoked, then the following directory will be constructed:
@@ -39,51 +67,157 @@ class Database():
     |___________tables
     |
     |___________rid_space
+    |
+    |___________wal
+    |
+    |___________checkpoint
 
-    where tables contains the pickled table_data list, and rid_space contains
-    the pickled rid space allocator.
+    where tables contains the pickled table_data list, rid_space contains
+    the pickled rid space allocator, wal holds the segment files of the
+    write-ahead log and checkpoint the log positions of the last checkpoint
+    (see Checkpointer). tables and rid_space are rewritten by every
+    checkpoint, and tables also whenever a table is created or dropped.
     """
     
     def init_dir(self, root_path):
         os.makedirs(root_path, 0o777)
-        f = open(root_path+'/tables', mode='wb')
-        f.close
-        f = open(root_path+'/rid_space', mode='wb')
-        f.close
         self.root_path = root_path
+        self.save_catalog()
+        save_pickle(root_path+'/rid_space', self.rid_space)
+        self.open_wal()
+        self.bp.writer.start()
+        self.checkpointer.start()
+        self.merge_scheduler.start()
+
+    def open_wal(self):
+        self.wal = WriteAheadLog(self.root_path + '/wal')
+        self.bp.wal = self.wal
         
+    """
+    Opens the database in root_path, creating it if it does not exist. The
+    tables are loaded from the last checkpoint, brought up to date from the
+    write-ahead log (see recover), together with their index snapshots, and
+    checkpointed again once the indices without a valid snapshot are rebuilt.
+    """
     def open(self, root_path):
         try:
             f1 = open(root_path+'/tables', mode='rb')
             f2 = open(root_path+'/rid_space', mode='rb')
-            self.table_data = pickle.load(f1)
+            table_data = pickle.load(f1)
             self.rid_space = pickle.load(f2)
             self.root_path = root_path
+            self.open_wal()
             f1.close()
             f2.close()
-            table_data = self.table_data[:]
+            self.table_data = []
             for bundle in table_data:
                 table = self.create_table(bundle[0], bundle[1], bundle[2])
+            self.recover()
+            for table in self.tables:
+                table.load_index()
+            self.checkpoint()
+            self.bp.writer.start()
+            self.checkpointer.start()
+            self.merge_scheduler.start()
 
         except FileNotFoundError:
             self.init_dir(root_path)
 
-    def close(self):
+    """
+    Crash recovery. Replays the write-ahead log from the last checkpoint on
+    top of the saved table metadata, pages and index snapshots (see
+    Table.redo and Index.redo), then rolls back the transactions that neither
+    committed nor aborted (see Table.undo and Index.undo). Only the log
+    written since the last checkpoint is replayed (plus the records of
+    transactions that were running at the time), so recovery time depends on
+    recent activity, not on the size of the tables.
+    Returns the number of transactions that were rolled back.
+    """
+    def recover(self):
         try:
-            open(self.root_path + '/tables', mode='rb').close()
-            open(self.root_path + '/rid_space', mode='rb').close()
-
-            f = open(self.root_path + '/tables', mode='wb')
-            pickle.dump(self.table_data, f)
-            f.close()
-            f = open(self.root_path + '/rid_space', mode='wb')
-            pickle.dump(self.rid_space, f)
-            f.close()
-            for table in self.tables:
-                table.close_table()
-            self.bp.flush()
+            with open(self.root_path + '/checkpoint', mode='rb') as f:
+                master = pickle.load(f)
         except FileNotFoundError:
+            master = {'checkpoint_lsn': 0, 'undo_lsn': 0}
+        checkpoint_lsn = master['checkpoint_lsn']
+        self.checkpointer.last_lsn = checkpoint_lsn
+        for table in self.tables:
+            table.index.open_snapshots(checkpoint_lsn)
+        # changes of the transactions that have not finished (yet):
+        changes = {}
+        for lsn, txn_id, record_type, table_name, values in self.wal.records(
+                min(checkpoint_lsn, master['undo_lsn'])):
+            if record_type == COMMIT or record_type == ABORT:
+                changes.pop(txn_id, None)
+                continue
+            if table_name not in self.table_map:
+                continue
+            table = self.tables[self.table_map[table_name]]
+            if txn_id != 0:
+                changes.setdefault(txn_id, []).append((table, record_type, values))
+            if lsn < checkpoint_lsn:
+                continue
+            if record_type == INDEX:
+                table.index.redo(values)
+            else:
+                table.redo(record_type, values)
+        for txn_id, records in changes.items():
+            for table, record_type, values in reversed(records):
+                if record_type == INDEX:
+                    table.index.undo(values)
+                else:
+                    table.undo(record_type, values)
+        return len(changes)
+
+    """
+    Takes a checkpoint (see Checkpointer). One is taken in the background
+    every config.CHECKPOINT_INTERVAL seconds as well.
+    """
+    def checkpoint(self):
+        if self.wal is None:
+            print('checkpoint error: database has not been opened')
+            return
+        self.checkpointer.checkpoint()
+
+    """
+    Shrinks the page file of every table to the pages that are in use (see
+    Table.compact). Merges free the pages they replace for reuse, but never
+    give the space back to the file system; this does. No transactions may
+    run while the database is compacted. Returns the number of pages each
+    table's page file shrank by.
+    """
+    def compact(self):
+        if self.wal is None:
+            print('compact error: database has not been opened')
+            return
+        self.merge_scheduler.stop()
+        self.checkpointer.stop()
+        self.checkpoint()
+        shrunk = {}
+        for table in self.tables:
+            size, new_size = table.compact()
+            shrunk[table.name] = size - new_size
+        self.checkpoint()
+        self.checkpointer.start()
+        self.merge_scheduler.start()
+        return shrunk
+
+    """
+    Saves the list of tables.
+    """
+    def save_catalog(self):
+        if self.root_path is not None:
+            save_pickle(self.root_path + '/tables', self.table_data)
+
+    def close(self):
+        if self.wal is None:
             print('db close error: cannot close without ever having opened')
+            return
+        self.merge_scheduler.stop()
+        self.checkpointer.stop()
+        self.checkpoint()
+        self.bp.close()
+        self.wal.close()
 
 
     """
@@ -100,10 +234,12 @@ class Database():
             ' currently existing table')
             return
 
-        table = Table(name, num_columns, key, self.rid_space, self.bp)
+        table = Table(name, num_columns, key, self.rid_space, self.bp, self.wal,
+                self.merge_scheduler, self.lock_manager)
         self.tables.append(table)
         self.table_data.append((name, num_columns, key))
         table.open_table()
+        self.save_catalog()
         self.table_map[name] = self.tables.index(table)
         return table
 
@@ -114,14 +250,50 @@ class Database():
         try:
             i = self.table_map[name]
             table_to_be_deleted = self.tables[i]
+            self.merge_scheduler.forget(table_to_be_deleted)
             table_to_be_deleted.delete_files()
             self.tables.pop(i)
             for i in range(len(self.table_data)):
                 if self.table_data[i][0] == name:
                     self.table_data.pop(i)
+                    break
+            self.save_catalog()
         except KeyError:
             pass
     
+    """
+    Returns a snapshot of the buffer pool statistics (see BufferStats). If the
+    heat map is enabled (enable_heat_map), 'heat_map' maps each table name to
+    the number of page requests per page range index; pages that belong to no
+    page range are counted under None.
+    """
+    def buffer_stats(self):
+        stats = self.bp.snapshot_stats()
+        if stats['heat_map'] is not None:
+            stats['heat_map'] = self.__page_range_heat(stats['heat_map'])
+        return stats
+
+    def reset_buffer_stats(self):
+        self.bp.reset_stats()
+
+    def enable_heat_map(self, enabled=True):
+        self.bp.enable_heat_map(enabled)
+
+    def __page_range_heat(self, page_heat):
+        range_of_page = {}
+        for table in self.tables:
+            pages = {}
+            for range_idx, page_range in enumerate(table.page_ranges):
+                for page_id in page_range:
+                    pages[page_id] = range_idx
+            range_of_page[table.name] = pages
+        heat = {}
+        for (table_name, page_id), count in page_heat.items():
+            range_idx = range_of_page.get(table_name, {}).get(page_id)
+            table_heat = heat.setdefault(table_name, {})
+            table_heat[range_idx] = table_heat.get(range_idx, 0) + count
+        return heat
+
     def get_table(self, name):
         try:
             i = self.table_map[name]
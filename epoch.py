@@ -0,0 +1,49 @@
+import threading
+
+"""
+Epoch-based quiescence for pages that are taken out of use (see
+Table.reclaim_pages). Readers enter the current epoch before they look up
+pages in a table's page ranges and leave it once they are done with them.
+Retiring pages advances the epoch, and the pages may only be reused once
+every reader that entered the epoch they were retired in, or an earlier
+one, has left: later readers can no longer find them.
+"""
+class EpochManager:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = 0
+        """
+        Maps each epoch to the number of readers in it.
+        """
+        self.readers = {}
+
+    def enter(self):
+        with self.lock:
+            epoch = self.epoch
+            self.readers[epoch] = self.readers.get(epoch, 0) + 1
+            return epoch
+
+    def exit(self, epoch):
+        with self.lock:
+            count = self.readers[epoch] - 1
+            if count == 0:
+                del self.readers[epoch]
+            else:
+                self.readers[epoch] = count
+
+    """
+    Returns the epoch that pages retired now belong to, and starts a new one.
+    """
+    def advance(self):
+        with self.lock:
+            epoch = self.epoch
+            self.epoch += 1
+            return epoch
+
+    """
+    Whether every reader that entered epoch (or an earlier one) has left.
+    """
+    def quiesced(self, epoch):
+        with self.lock:
+            return all(reader_epoch > epoch for reader_epoch in self.readers)
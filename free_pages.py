@@ -0,0 +1,90 @@
+from bisect import bisect_left
+
+"""
+The free space of a table's page file: the page ids that have been given
+back (see Table.reclaim_pages) and can be handed out again before the page
+file is grown (see Table.allocate_pages). Free pages are kept as a sorted
+list of [first_page_id, count] extents, with neighbouring extents joined, so
+runs of consecutive pages (a page range's base pages, a set of tail pages)
+can be allocated at once. Saved with the table's metadata.
+"""
+class FreePageMap:
+
+    def __init__(self):
+        self.extents = []
+
+    def __len__(self):
+        return sum(count for first_page_id, count in self.extents)
+
+    """
+    Takes count consecutive free pages, from the first extent that is large
+    enough. Returns the id of the first page, or None if no extent is.
+    """
+    def allocate(self, count):
+        for i in range(len(self.extents)):
+            extent = self.extents[i]
+            if extent[1] >= count:
+                first_page_id = extent[0]
+                if extent[1] == count:
+                    del self.extents[i]
+                else:
+                    extent[0] += count
+                    extent[1] -= count
+                return first_page_id
+        return None
+
+    """
+    Adds the count pages starting at first_page_id.
+    """
+    def release(self, first_page_id, count):
+        i = bisect_left(self.extents, [first_page_id, count])
+        self.extents.insert(i, [first_page_id, count])
+        # join with the next extent, then with the previous one:
+        if i + 1 < len(self.extents) and first_page_id + count == self.extents[i + 1][0]:
+            self.extents[i][1] += self.extents.pop(i + 1)[1]
+        if i > 0 and self.extents[i - 1][0] + self.extents[i - 1][1] == first_page_id:
+            self.extents[i - 1][1] += self.extents.pop(i)[1]
+
+    """
+    Removes the count pages starting at first_page_id, those of them that are
+    free. Used by recovery for pages that the log shows were allocated.
+    """
+    def claim(self, first_page_id, count):
+        self.extents = subtract_extent(self.extents, first_page_id, count)
+
+    def snapshot(self):
+        return [tuple(extent) for extent in self.extents]
+
+    def load(self, extents):
+        self.extents = [list(extent) for extent in extents]
+
+
+"""
+Returns extents ([first_page_id, count] lists, or lists that start with
+those two fields) without the count pages starting at first_page_id.
+"""
+def subtract_extent(extents, first_page_id, count):
+    end = first_page_id + count
+    remaining = []
+    for extent in extents:
+        extent_end = extent[0] + extent[1]
+        if extent_end <= first_page_id or extent[0] >= end:
+            remaining.append(extent)
+            continue
+        if extent[0] < first_page_id:
+            remaining.append([extent[0], first_page_id - extent[0]] + extent[2:])
+        if extent_end > end:
+            remaining.append([end, extent_end - end] + extent[2:])
+    return remaining
+
+"""
+Splits a list of page ids into extents of consecutive ids.
+"""
+def page_extents(page_ids):
+    extents = []
+    for page_id in sorted(page_ids):
+        if extents and extents[-1][0] + extents[-1][1] == page_id:
+            extents[-1][1] += 1
+        else:
+            extents.append([page_id, 1])
+    return extents
@@ -1,3 +1,10 @@
+from sorted_index import SortedIndex
+from index_snapshot import IndexSnapshot, save_index_snapshot, stamp_index_snapshot
+from wal import INDEX, INDEX_ADD, INDEX_UPDATE, INDEX_DELETE, INDEX_CREATE, INDEX_DROP
+from logger import in_transaction
+from lock_manager import current_owner, EXCLUSIVE
+from operator import itemgetter
+import os
 import threading
 
 class Index:
@@ -8,112 +15,134 @@ class Index:
         self.table = table
         self.primary_key = self.table.key
         self.rid_maps = {}
-        self.init_indices(self.table.num_columns)
-        self.create_index(self.primary_key)
+        self.index_log = {}
         """
-        Used for concurrent transaction support:
+        The columns whose index has changed since its last snapshot (see
+        save_snapshots), and the columns whose index has to be rebuilt from
+        the records after recovery (see open_snapshots), mapped to whether
+        the index is ordered.
         """
-        self.lock_map = {}
-        self.owned_xlocks = {}
-        self.owned_rlocks = {} 
-        self.index_log = {}
+        self.modified = set()
+        self.rebuild = {}
+        self.init_indices(self.table.num_columns)
+        # the table is empty when it is created, and its indices are loaded
+        # or rebuilt (see open_snapshots) when it is opened:
+        self.indices[self.primary_key] = SortedIndex()
+        self.rid_maps[self.primary_key] = {}
+        self.modified.add(self.primary_key)
 
 
+    """
+    Appends an index change to the table's write-ahead log, if it has one.
+    entries holds (rid, key, new_key) triples, one after the other.
+    """
+    def log(self, op, column_number, entries):
+        self.modified.add(column_number)
+        if self.table.wal is not None:
+            self.table.wal.log(INDEX, self.table.name, [op, column_number] + entries)
+
     def init_indices(self, num_columns):
         for i in range(num_columns):
             self.indices[i] = None
 
+    """
+    Returns the index on column_number. An index that is still a snapshot
+    (see IndexSnapshot) is loaded into memory if it is about to be changed
+    (write) or recovery replayed changes to it. Called while holding
+    index_lock.
+    """
+    def get_index(self, column_number, write=False):
+        idx = self.indices[column_number]
+        if isinstance(idx, IndexSnapshot) and (write or idx.pending):
+            snapshot = idx
+            idx, rid_map = snapshot.load()
+            for change in snapshot.pending:
+                self.apply(idx, rid_map, *change)
+            self.indices[column_number] = idx
+            self.rid_maps[column_number] = rid_map
+        return idx
+
     """
     Returns the location of all records with the given value
     """
     def locate(self, column_number, value):
         with self.index_lock:
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number)
             try:
                 return idx[value]
             except KeyError:
                 return []
 
+    """
+    Record locks are kept by the table's lock manager (see LockManager), for
+    the transaction running on the calling thread, or for the query if it
+    runs outside of one (see release_locks). Reads take none (see mvcc).
+    Locks rid exclusively, and returns whether the lock was granted.
+    """
     def obtain_xlock(self, rid):
-        with self.index_lock:
-            thread_id = threading.current_thread().ident
-            if thread_id not in self.owned_xlocks:
-                self.owned_xlocks[thread_id] = set()
-            else:
-                if rid in self.owned_xlocks[thread_id]:
-                    return True
-            if self.lock_map[rid][1] != 1 and (self.lock_map[rid][0] == 0 or rid in self.owned_rlocks[thread_id]):
-                self.lock_map[rid][1] = 1
-                self.owned_xlocks[thread_id].add(rid)
-            else:
-                return False
-            return True
-    
-    def obtain_rlock(self, rids):
-        with self.index_lock:
-            thread_id = threading.current_thread().ident
-            if thread_id not in self.owned_rlocks:
-                self.owned_rlocks[thread_id] = set()
-            for rid in rids:
-                if rid in self.owned_rlocks[thread_id]:
-                    continue
-                if self.lock_map[rid][1] != 1:
-                    self.lock_map[rid][0] += 1
-                    self.owned_rlocks[thread_id].add(rid)
-                else:
-                    return False 
-            return True
-
-    def release_xlock(self, rids):
-        with self.index_lock:
-            for rid in rids:
-                self.lock_map[rid][1] = 0
-            
-    def release_rlock(self, rids):
-        with self.index_lock:
-            for rid in rids:
-                if self.lock_map[rid][0] != 0:
-                    self.lock_map[rid][0] -= 1
+        return self.table.lock_manager.acquire(current_owner(), (self.table.name, rid),
+                EXCLUSIVE)
 
     """
-    Create index on specific column
+    Create index on specific column. If ordered is True, the index also keeps
+    its keys in sorted order (see SortedIndex), which makes range lookups on
+    the column proportional to the size of the range.
     """
-    def create_index(self, column_number):
+    def create_index(self, column_number, ordered=False):
         if column_number >= self.table.num_columns:
             print('error: cannot create index on column that does not exist')
             return
         with self.index_lock:
-            self.indices[column_number] = {}
-            self.rid_maps[column_number] = {}
-            idx = self.indices[column_number]
-            rid_map = self.rid_maps[column_number]
+            self.log(INDEX_CREATE, column_number, [int(ordered)])
+            self.build_index(column_number, ordered)
 
-            query_columns = [0]*self.table.num_columns
-            query_columns[column_number] = 1
+    """
+    Builds the index on column_number from the table's records. Called while
+    holding index_lock.
+    """
+    def build_index(self, column_number, ordered):
+        if ordered:
+            self.indices[column_number] = SortedIndex()
+        else:
+            self.indices[column_number] = {}
+        self.rid_maps[column_number] = {}
+        self.modified.add(column_number)
+        idx = self.indices[column_number]
+        rid_map = self.rid_maps[column_number]
+        query_columns = [0]*self.table.num_columns
+        query_columns[column_number] = 1
 
-            for rid in self.table.base_rids:
+        # visit records in page range order, reading the next page range
+        # in while the current one is being indexed, in a scan ring:
+        with self.table.bp.scan_ring():
+            range_idx = None
+            for rid in self.table.page_directory.base_rids():
+                rid_range_idx = self.table.page_directory[rid][3]
+                if rid_range_idx != range_idx:
+                    range_idx = rid_range_idx
+                    self.table.prefetch_page_ranges([range_idx + 1], [column_number])
                 record = self.table.get_records([rid], query_columns, 0)[0]
                 key_value = record.columns[column_number]
                 rid_map[rid] = key_value
-                if key_value in idx.keys() and rid not in idx[key_value]:
-                    idx[key_value].append(rid)
+                if key_value in idx:
+                    if rid not in idx[key_value]:
+                        idx[key_value].append(rid)
                 else:
                     idx[key_value] = [rid]
-                if rid not in self.lock_map:
-                    self.lock_map[rid] = [0,0]
 
     """
     Add a new key, rid pair to index
     """
     def add_key(self, rid, column_number, bp):
         with self.index_lock:
-            self.table.directory_lock.acquire()
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number, True)
             rid_map = self.rid_maps[column_number]
             rid_tuple = self.table.page_directory[rid]
-            page_id = rid_tuple[0] + column_number
-            page = bp.get_page(self.table.name, page_id)
-            key_value = page.read(rid_tuple[2])
+            with self.table.range_latches[rid_tuple[3]]:
+                page_id = self.table.page_ranges[rid_tuple[3]][column_number]
+                page = bp.get_page(self.table.name, page_id)
+                key_value = page.read(rid_tuple[2])
+            self.log(INDEX_ADD, column_number, [rid, key_value, 0])
             try:
                 if rid not in idx[key_value]:
                     idx[key_value].append(rid)
@@ -121,21 +150,45 @@ class Index:
             except KeyError:
                 idx[key_value] = [rid]
                 rid_map[rid] = key_value
-            if rid not in self.lock_map:
-                self.lock_map[rid] = [0,0]
-            if threading.current_thread().ident not in self.index_log:
-                self.index_log[threading.current_thread().ident] = []
-            self.index_log[threading.current_thread().ident].append(('add', rid, column_number, key_value)) 
-            self.table.directory_lock.release()
+            if in_transaction():
+                if threading.current_thread().ident not in self.index_log:
+                    self.index_log[threading.current_thread().ident] = []
+                self.index_log[threading.current_thread().ident].append(('add', rid, column_number, key_value))
+
+    """
+    Add many rid, key pairs to the index on column_number at once.
+    """
+    def add_keys(self, rids, column_number, key_values):
+        with self.index_lock:
+            idx = self.get_index(column_number, True)
+            rid_map = self.rid_maps[column_number]
+            archive = None
+            if in_transaction():
+                thread_id = threading.current_thread().ident
+                archive = self.index_log.setdefault(thread_id, [])
+            entries = []
+            for rid, key_value in zip(rids, key_values):
+                entries.extend((rid, key_value, 0))
+            self.log(INDEX_ADD, column_number, entries)
+            for rid, key_value in zip(rids, key_values):
+                try:
+                    if rid not in idx[key_value]:
+                        idx[key_value].append(rid)
+                except KeyError:
+                    idx[key_value] = [rid]
+                rid_map[rid] = key_value
+                if archive is not None:
+                    archive.append(('add', rid, column_number, key_value))
 
     """
     Update prexisting key, rid pair. From old_key->rid to new_key->rid
     """
     def update_index(self, rid, column_number, new_key):
         with self.index_lock:
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number, True)
             rid_map = self.rid_maps[column_number]
             old_key = rid_map[rid]
+            self.log(INDEX_UPDATE, column_number, [rid, old_key, new_key])
             if old_key != new_key:
                 rid_map[rid] = new_key
                 idx[old_key].remove(rid)
@@ -146,60 +199,114 @@ class Index:
                         idx[new_key].append(rid)
                 except KeyError:
                     idx[new_key] = [rid]
-            if threading.current_thread().ident not in self.index_log:
-                self.index_log[threading.current_thread().ident] = []
-            self.index_log[threading.current_thread().ident].append(('update', rid, column_number, old_key, new_key)) 
+            if in_transaction():
+                if threading.current_thread().ident not in self.index_log:
+                    self.index_log[threading.current_thread().ident] = []
+                self.index_log[threading.current_thread().ident].append(('update', rid, column_number, old_key, new_key))
  
+    """
+    Returns the rids of all records whose value in column_number lies in
+    [begin, end]. Ordered indices bisect their sorted keys; hash indices have
+    to sort all of their keys.
+    """
     def locate_range(self, begin, end, column_number):
         with self.index_lock:
+            idx = self.get_index(column_number)
+            if isinstance(idx, (SortedIndex, IndexSnapshot)):
+                return idx.rid_range(begin, end)
             rids = []
-            idx = self.indices[column_number]
-            sorted_keys = sorted(idx.keys())
-            for key in sorted_keys:
+            for key in sorted(idx.keys()):
                 if key > end:
                     break
-                if key in range(begin, end+1):
+                if key >= begin:
                     rids.extend(idx[key])
             return rids
 
+    """
+    Estimates the number of keys of column_number in [begin, end]. Cheap for
+    ordered indices; hash indices report every key they hold.
+    """
+    def estimate_range(self, begin, end, column_number):
+        with self.index_lock:
+            idx = self.get_index(column_number)
+            if isinstance(idx, (SortedIndex, IndexSnapshot)):
+                return idx.estimate_range(begin, end)
+            return len(idx)
+
+    """
+    Iterates over the (key, rids) pairs of column_number with keys in
+    [begin, end], in ascending key order. The key range is fixed when the
+    cursor is created and rids are looked up batch_size keys at a time, so
+    the index lock is never held while the caller consumes the cursor.
+    """
+    def range_cursor(self, begin, end, column_number, batch_size=512):
+        with self.index_lock:
+            idx = self.get_index(column_number)
+            if isinstance(idx, (SortedIndex, IndexSnapshot)):
+                keys = idx.key_range(begin, end)
+            else:
+                keys = sorted(key for key in idx.keys() if begin <= key <= end)
+        for start in range(0, len(keys), batch_size):
+            batch = []
+            with self.index_lock:
+                # the snapshot may have been loaded into memory meanwhile:
+                if self.indices.get(column_number) is not None:
+                    idx = self.indices[column_number]
+                for key in keys[start:start + batch_size]:
+                    rids = idx.get(key)
+                    if rids:
+                        batch.append((key, rids[:]))
+            for pair in batch:
+                yield pair
+
     def drop_index(self, column_number):
         with self.index_lock:
-            del self.indices[column_number]
-            del self.rid_maps[column_number]
+            self.log(INDEX_DROP, column_number, [])
+            self.indices[column_number] = None
+            self.rid_maps.pop(column_number, None)
 
+    """
+    Removes rid from the index on column_number. key is the key it was
+    located with; the rid is removed from under the key the index holds for
+    it, which differs for an index on another column.
+    """
     def delete(self, rid, column_number, key):
         with self.index_lock:
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number, True)
             rid_map = self.rid_maps[column_number]
+            key = rid_map.get(rid, key)
+            self.log(INDEX_DELETE, column_number, [rid, key, 0])
             idx[key].remove(rid)
             del rid_map[rid]
             if idx[key] == []:
                 del idx[key]
-            if threading.current_thread().ident not in self.index_log:
-                self.index_log[threading.current_thread().ident] = []
-            self.index_log[threading.current_thread().ident].append(('delete', rid, column_number, key))
-
-    def release_locks(self, thread_id):
-        locks_owned = self.ownership_map[thread_id]
-        for lock in locks_owned:
-            if lock[0] == 'r':
-                self.release_rlock(lock[1])
-            else:
-                self.release_xlock(lock[1])
+            if in_transaction():
+                if threading.current_thread().ident not in self.index_log:
+                    self.index_log[threading.current_thread().ident] = []
+                self.index_log[threading.current_thread().ident].append(('delete', rid, column_number, key))
+
+    """
+    Releases the locks taken by the queries the calling thread ran outside
+    of a transaction. Transactions release theirs when they commit or abort.
+    """
+    def release_locks(self):
+        self.table.lock_manager.release_all(current_owner())
 
     def undo_add(self, rid, column_number, key_value):
         with self.index_lock:
-            idx = self.indices[column_number]
-            rid_map = self.rid_map[column_number]
+            idx = self.get_index(column_number, True)
+            rid_map = self.rid_maps[column_number]
+            self.log(INDEX_DELETE, column_number, [rid, key_value, 0])
             idx[key_value].remove(rid)
             del rid_map[rid]
-            if idx[key] == []:
-                del idx[key]
+            if idx[key_value] == []:
+                del idx[key_value]
 
     def undo_update(self, rid, column_number, old_key, new_key):
         with self.index_lock:
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number, True)
             rid_map = self.rid_maps[column_number]
+            self.log(INDEX_UPDATE, column_number, [rid, new_key, old_key])
             if old_key != new_key:
                 rid_map[rid] = old_key
                 idx[new_key].remove(rid)
@@ -213,16 +320,20 @@ class Index:
 
     def undo_delete(self, rid, column_number, key):
         with self.index_lock:
-            idx = self.indices[column_number]
+            idx = self.get_index(column_number, True)
             rid_map = self.rid_maps[column_number]
-            idx[key].append(rid)
-            rid_map[rid] = key_value
+            self.log(INDEX_ADD, column_number, [rid, key, 0])
+            try:
+                idx[key].append(rid)
+            except KeyError:
+                idx[key] = [rid]
+            rid_map[rid] = key
 
     def rollback_index(self, thread_id):
         if thread_id in self.index_log:
             archive = self.index_log[thread_id]
             while len(archive) != 0:
-                chage = archive.pop()
+                change = archive.pop()
                 if change[0] == 'add':
                     self.undo_add(*change[1:])
                     continue
@@ -234,5 +345,154 @@ class Index:
                 else:
                     raise Exception('rollback index error: archive error')
             
+    """
+    Applies a logged change to the entry of rid in an index and its rid map,
+    in a way that can be repeated: the rid ends up under key (INDEX_ADD),
+    under new_key (INDEX_UPDATE) or not in the index at all (INDEX_DELETE),
+    whatever the index held for it before.
+    """
+    def apply(self, idx, rid_map, op, rid, key, new_key):
+        old_key = rid_map.pop(rid, None)
+        if old_key is not None:
+            rids = idx.get(old_key)
+            if rids is not None and rid in rids:
+                rids.remove(rid)
+                if rids == []:
+                    del idx[old_key]
+        if op == INDEX_DELETE:
+            return
+        if op == INDEX_UPDATE:
+            key = new_key
+        rid_map[rid] = key
+        try:
+            idx[key].append(rid)
+        except KeyError:
+            idx[key] = [rid]
+
+    """
+    Applies changes, (op, rid, key, new_key) tuples, to the index on
+    column_number during recovery. Changes to a snapshot are kept until it is
+    loaded (see get_index), and changes to an index that is rebuilt after
+    recovery are dropped.
+    """
+    def replay(self, column_number, changes):
+        idx = self.indices.get(column_number)
+        if idx is None or column_number in self.rebuild or not changes:
+            return
+        self.modified.add(column_number)
+        for change in changes:
+            if isinstance(idx, IndexSnapshot):
+                idx.pending.append(change)
+            else:
+                self.apply(idx, self.rid_maps[column_number], *change)
+
+    """
+    Repeats a logged index change (see Database.recover), on top of index
+    snapshots that may already contain it.
+    """
+    def redo(self, values):
+        op, column_number = values[:2]
+        if op == INDEX_CREATE:
+            self.indices[column_number] = None
+            self.rid_maps.pop(column_number, None)
+            self.rebuild[column_number] = bool(values[2])
+        elif op == INDEX_DROP:
+            self.indices[column_number] = None
+            self.rid_maps.pop(column_number, None)
+            self.rebuild.pop(column_number, None)
+        else:
+            self.replay(column_number, [(op,) + tuple(values[i:i + 3])
+                    for i in range(2, len(values), 3)])
+
+    """
+    Reverts a logged index change of a transaction that never finished (see
+    Table.undo).
+    """
+    def undo(self, values):
+        op, column_number = values[:2]
+        if op == INDEX_CREATE or op == INDEX_DROP:
+            return
+        changes = []
+        for i in reversed(range(2, len(values), 3)):
+            rid, key, new_key = values[i:i + 3]
+            if op == INDEX_ADD:
+                changes.append((INDEX_DELETE, rid, key, 0))
+            else:
+                # an update or delete is undone by putting the rid back under key
+                changes.append((INDEX_ADD, rid, key, 0))
+        self.replay(column_number, changes)
+
+    def snapshot_path(self, column_number):
+        return self.table.name + '/index_%d' % column_number
+
+    """
+    Loads the index snapshots that the checkpoint with checkpoint_lsn saved
+    (see IndexSnapshot), when the table is opened. Indices without a valid
+    snapshot are rebuilt from the records after recovery (see
+    rebuild_indices).
+    """
+    def open_snapshots(self, checkpoint_lsn):
+        with self.index_lock:
+            self.rebuild = {self.primary_key: True}
+            for file_name in sorted(os.listdir(self.table.name)):
+                if not file_name.startswith('index_') or not file_name[6:].isdigit():
+                    continue
+                column_number = int(file_name[6:])
+                try:
+                    snapshot = IndexSnapshot(self.table.name + '/' + file_name)
+                except ValueError:
+                    self.rebuild[column_number] = column_number == self.primary_key
+                    continue
+                if snapshot.lsn == checkpoint_lsn:
+                    self.indices[column_number] = snapshot
+                    self.rid_maps.pop(column_number, None)
+                    self.rebuild.pop(column_number, None)
+                    self.modified.discard(column_number)
+                else:
+                    self.rebuild[column_number] = snapshot.ordered
+
+    """
+    Rebuilds the indices that open_snapshots found no valid snapshot for.
+    """
+    def rebuild_indices(self):
+        with self.index_lock:
+            for column_number, ordered in sorted(self.rebuild.items()):
+                self.build_index(column_number, ordered)
+            self.rebuild = {}
+
+    """
+    Saves a snapshot of every index for the checkpoint with checkpoint_lsn
+    and deletes the snapshots of dropped indices. The snapshot of an index
+    that has not changed since it was saved is only stamped with the new LSN.
+    The indices are copied while holding index_lock, which every logged
+    index change holds as well, so recovery can replay the log from
+    checkpoint_lsn on top of the snapshots.
+    """
+    def save_snapshots(self, checkpoint_lsn):
+        stamps = []
+        saves = []
+        with self.index_lock:
+            for column_number in list(self.indices):
+                if self.indices[column_number] is None:
+                    continue
+                if column_number not in self.modified:
+                    stamps.append(column_number)
+                    continue
+                idx = self.get_index(column_number)
+                items = [(key, rids[:]) for key, rids in idx.items()]
+                saves.append((column_number, isinstance(idx, SortedIndex), items))
+            self.modified = set()
+        for column_number in stamps:
+            stamp_index_snapshot(self.snapshot_path(column_number), checkpoint_lsn)
+        for column_number, ordered, items in saves:
+            items.sort(key=itemgetter(0))
+            save_index_snapshot(self.snapshot_path(column_number), checkpoint_lsn,
+                    column_number, ordered, items)
+        file_names = set(self.snapshot_path(column_number).split('/')[-1]
+                for column_number in stamps + [save[0] for save in saves])
+        for file_name in os.listdir(self.table.name):
+            if file_name.startswith('index_') and file_name not in file_names:
+                os.unlink(self.table.name + '/' + file_name)
+
     def print_index(self):
         print(self.idx)
@@ -0,0 +1,170 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from sorted_index import SortedIndex
+import mmap
+import os
+import struct
+import sys
+
+"""
+On-disk snapshots of a table's indices, so that opening a table does not have
+to scan it to rebuild them (see Index.open_snapshots and Index.save_snapshots).
+
+Each index is saved by every checkpoint to its own file, table_name/index_<n>
+for the index on column n:
+
+    magic (8 bytes) | checkpoint LSN | column_number | ordered | count
+    count keys
+    count rids
+
+(all little-endian int64 after the magic, so a snapshot means the same on
+every host)
+
+with one key, rid pair per rid in the index, sorted by key (rids with the same
+key in the order the index holds them). The checkpoint LSN is the validity
+marker: a snapshot is only used if it matches the LSN of the checkpoint that
+the database is recovered from, since only then does the write-ahead log hold
+every index change made after the snapshot was taken. An index whose snapshot
+is unchanged since the last checkpoint only has its LSN rewritten.
+
+A snapshot is loaded by memory-mapping its file. Lookups are answered by
+bisecting the mapped key array, so an index that is only read is never built
+in memory; the first change to it (or a change replayed by recovery) turns it
+into a regular index (see load). On a big-endian host the keys and rids are
+read into byte-swapped arrays instead.
+"""
+MAGIC = b'LSTIDX01'
+HEADER = struct.Struct('<8sqqqq')
+SWAP_BYTES = sys.byteorder == 'big'
+
+"""
+Writes a snapshot of an index to path, replacing the file atomically. items
+are the (key, rids) pairs of the index, sorted by key.
+"""
+def save_index_snapshot(path, lsn, column_number, ordered, items):
+    keys = array('q')
+    rids = array('q')
+    for key, key_rids in items:
+        keys.extend([key]*len(key_rids))
+        rids.extend(key_rids)
+    if SWAP_BYTES:
+        keys.byteswap()
+        rids.byteswap()
+    temp_path = path + '.tmp'
+    with open(temp_path, mode='wb') as f:
+        f.write(HEADER.pack(MAGIC, lsn, column_number, int(ordered), len(keys)))
+        f.write(keys.tobytes())
+        f.write(rids.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+"""
+Sets the checkpoint LSN of the snapshot at path to lsn, for a snapshot that is
+still up to date.
+"""
+def stamp_index_snapshot(path, lsn):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, struct.pack('<q', lsn), 8)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IndexSnapshot:
+
+    """
+    Maps the snapshot at path. Raises ValueError if the file is not a
+    complete snapshot.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError('index snapshot error: file is cut short')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.lsn, self.column_number, ordered, count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or size != HEADER.size + 16*count:
+            self.map.close()
+            raise ValueError('index snapshot error: not an index snapshot')
+        self.ordered = bool(ordered)
+        view = memoryview(self.map)
+        self.keys = view[HEADER.size:HEADER.size + 8*count].cast('q')
+        self.rids = view[HEADER.size + 8*count:].cast('q')
+        if SWAP_BYTES:
+            self.keys = array('q', self.keys)
+            self.keys.byteswap()
+            self.rids = array('q', self.rids)
+            self.rids.byteswap()
+        """
+        Changes replayed by recovery (see Index.redo), applied when the
+        snapshot is loaded.
+        """
+        self.pending = []
+
+    def __getitem__(self, key):
+        lo = bisect_left(self.keys, key)
+        hi = bisect_right(self.keys, key, lo)
+        if lo == hi:
+            raise KeyError(key)
+        return self.rids[lo:hi].tolist()
+
+    def __contains__(self, key):
+        lo = bisect_left(self.keys, key)
+        return lo < len(self.keys) and self.keys[lo] == key
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    """
+    Returns the distinct keys in [begin, end], in ascending order.
+    """
+    def key_range(self, begin, end):
+        keys = self.keys
+        lo = bisect_left(keys, begin)
+        hi = bisect_right(keys, end, lo)
+        distinct = []
+        while lo < hi:
+            key = keys[lo]
+            distinct.append(key)
+            lo = bisect_right(keys, key, lo, hi)
+        return distinct
+
+    """
+    Returns the number of rids with keys in [begin, end], an upper bound on
+    the number of keys.
+    """
+    def estimate_range(self, begin, end):
+        return bisect_right(self.keys, end) - bisect_left(self.keys, begin)
+
+    def rid_range(self, begin, end):
+        lo = bisect_left(self.keys, begin)
+        hi = bisect_right(self.keys, end, lo)
+        return self.rids[lo:hi].tolist()
+
+    """
+    Builds the index in memory. Returns the index (a SortedIndex if the
+    snapshot is of an ordered index, a dict otherwise) and its rid map.
+    """
+    def load(self):
+        keys = self.keys.tolist()
+        rids = self.rids.tolist()
+        buckets = {}
+        for key, rid in zip(keys, rids):
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [rid]
+            else:
+                bucket.append(rid)
+        rid_map = dict(zip(rids, keys))
+        if self.ordered:
+            idx = SortedIndex()
+            idx.load_sorted(buckets)
+        else:
+            idx = buckets
+        return idx, rid_map
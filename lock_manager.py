@@ -0,0 +1,262 @@
+from collections import deque
+from logger import transaction_context, in_transaction
+import config
+import threading
+import time
+
+"""
+Record locks. Transactions lock the records they change, exclusively, until
+they commit or abort (reads see a snapshot and take no locks, see mvcc).
+Locks are kept in a lock table that is split into config.LOCK_SHARDS shards,
+each with a latch of its own, so requests for different records rarely
+contend for a latch. Every lock has a queue of the requests waiting for it,
+which are granted in the order they were made, except that a transaction
+that holds a shared lock and asks for an exclusive one (an upgrade) goes
+first.
+
+A request that conflicts with the lock's holders, or with the requests
+queued before it, waits, unless config.LOCK_POLICY says otherwise. Waiting
+transactions could deadlock, which the policies rule out by transaction age
+(the start time of the transaction's snapshot, older is smaller):
+
+- 'wait-die': a transaction only waits for younger ones; one that would
+  wait for an older one fails its request (dies),
+- 'wound-wait': a transaction waits for older ones, and wounds the younger
+  ones it would wait for: their next lock request fails (or the one they are
+  waiting on), so they abort and release their locks,
+- 'timeout': every transaction waits,
+- 'no-wait': no transaction waits.
+
+Every wait gives up after config.LOCK_TIMEOUT seconds, which also breaks the
+deadlocks that 'timeout' lets happen. A failed request makes the query fail,
+and the transaction aborts. Queries that run outside of a transaction never
+hold more than one lock, so they always wait, and they release it when they
+finish.
+"""
+SHARED = 1
+EXCLUSIVE = 2
+
+WAIT_DIE = 'wait-die'
+WOUND_WAIT = 'wound-wait'
+TIMEOUT = 'timeout'
+NO_WAIT = 'no-wait'
+
+"""
+Returns the owner of the locks the calling thread takes: that of its
+transaction (see Transaction.begin), or, outside of a transaction, one that
+its queries share.
+"""
+def current_owner():
+    if in_transaction():
+        owner = getattr(transaction_context, 'lock_owner', None)
+        if owner is not None:
+            return owner
+    owner = getattr(transaction_context, 'query_owner', None)
+    if owner is None:
+        owner = LockOwner()
+        transaction_context.query_owner = owner
+    return owner
+
+
+"""
+The locks held by a transaction. timestamp orders transactions by age, and
+is None for the queries run outside of a transaction.
+"""
+class LockOwner:
+
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp
+        """
+        Maps the key of every lock held to the LockManager that holds it.
+        """
+        self.locks = {}
+        """
+        Whether an older transaction wounded this one (see WOUND_WAIT). Set
+        with the wakeup event, which waiting requests wait on.
+        """
+        self.wounded = False
+        self.wakeup = threading.Event()
+
+    def older_than(self, other):
+        if self.timestamp is None or other.timestamp is None:
+            return False
+        return self.timestamp < other.timestamp
+
+
+class LockRequest:
+
+    def __init__(self, owner, mode, upgrade):
+        self.owner = owner
+        self.mode = mode
+        self.upgrade = upgrade
+        self.granted = False
+
+
+class LockEntry:
+
+    def __init__(self):
+        """
+        Maps each holder of the lock to the mode it holds it in.
+        """
+        self.holders = {}
+        self.queue = deque()
+
+
+class LockShard:
+
+    def __init__(self):
+        self.latch = threading.Lock()
+        self.locks = {}
+
+
+class LockManager:
+
+    def __init__(self, num_shards=None, policy=None, timeout=None):
+        if num_shards is None:
+            num_shards = config.LOCK_SHARDS
+        self.shards = [LockShard() for i in range(num_shards)]
+        self.policy = policy if policy is not None else config.LOCK_POLICY
+        if self.policy not in (WAIT_DIE, WOUND_WAIT, TIMEOUT, NO_WAIT):
+            raise Exception('lock error: unknown lock policy ' + str(self.policy))
+        self.timeout = timeout if timeout is not None else config.LOCK_TIMEOUT
+        """
+        Statistics: requests that waited, requests that failed because of the
+        policy (dies, and requests refused by 'no-wait'), transactions
+        wounded, and waits that timed out.
+        """
+        self.waits = 0
+        self.refusals = 0
+        self.wounds = 0
+        self.timeouts = 0
+
+    def get_shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    """
+    Locks key in mode (SHARED or EXCLUSIVE) for owner, waiting if the policy
+    lets it. A holder of a shared lock that asks for an exclusive one gets
+    its lock upgraded. Returns whether the lock was granted.
+    """
+    def acquire(self, owner, key, mode):
+        if owner.wounded:
+            return False
+        shard = self.get_shard(key)
+        with shard.latch:
+            entry = shard.locks.get(key)
+            if entry is None:
+                entry = LockEntry()
+                shard.locks[key] = entry
+            held = entry.holders.get(owner)
+            if held is not None and held >= mode:
+                return True
+            upgrade = held is not None
+            if self._compatible(entry, owner, mode) and (upgrade or not entry.queue):
+                self._grant(entry, owner, key, mode)
+                return True
+            if not self._may_wait(entry, owner, mode, upgrade):
+                self.refusals += 1
+                self._forget(shard, key, entry)
+                return False
+            request = LockRequest(owner, mode, upgrade)
+            if upgrade:
+                entry.queue.appendleft(request)
+            else:
+                entry.queue.append(request)
+            self.waits += 1
+            deadline = time.monotonic() + self.timeout
+            while not request.granted:
+                # cleared before the checks, so a wound that comes after them
+                # ends the wait:
+                owner.wakeup.clear()
+                remaining = deadline - time.monotonic()
+                if owner.wounded or remaining <= 0:
+                    if not owner.wounded:
+                        self.timeouts += 1
+                    entry.queue.remove(request)
+                    # the requests queued behind it may be grantable now:
+                    self._grant_waiting(entry, key)
+                    self._forget(shard, key, entry)
+                    return False
+                shard.latch.release()
+                try:
+                    owner.wakeup.wait(remaining)
+                finally:
+                    shard.latch.acquire()
+            return True
+
+    """
+    Whether owner can be granted key in mode as far as the lock's holders
+    are concerned.
+    """
+    def _compatible(self, entry, owner, mode):
+        for holder, held in entry.holders.items():
+            if holder is not owner and (mode == EXCLUSIVE or held == EXCLUSIVE):
+                return False
+        return True
+
+    """
+    Decides whether a request that conflicts with the lock may wait, by the
+    policy and the transactions it would wait for: the holders it conflicts
+    with, and the requests queued before it.
+    """
+    def _may_wait(self, entry, owner, mode, upgrade):
+        if owner.timestamp is None or self.policy == TIMEOUT:
+            return True
+        if self.policy == NO_WAIT:
+            return False
+        blockers = [holder for holder, held in entry.holders.items()
+                if holder is not owner and (mode == EXCLUSIVE or held == EXCLUSIVE)]
+        if not upgrade:
+            blockers.extend(request.owner for request in entry.queue)
+        if self.policy == WAIT_DIE:
+            return not any(blocker.older_than(owner) for blocker in blockers)
+        for blocker in blockers:
+            if owner.older_than(blocker) and not blocker.wounded:
+                blocker.wounded = True
+                blocker.wakeup.set()
+                self.wounds += 1
+        return True
+
+    def _grant(self, entry, owner, key, mode):
+        entry.holders[owner] = mode
+        owner.locks[key] = self
+
+    """
+    Grants the requests at the front of the queue of a lock, for as long as
+    they are compatible with its holders. Called while holding the latch of
+    the lock's shard.
+    """
+    def _grant_waiting(self, entry, key):
+        while entry.queue:
+            request = entry.queue[0]
+            if not self._compatible(entry, request.owner, request.mode):
+                break
+            entry.queue.popleft()
+            self._grant(entry, request.owner, key, request.mode)
+            request.granted = True
+            request.owner.wakeup.set()
+
+    def _forget(self, shard, key, entry):
+        if not entry.holders and not entry.queue:
+            del shard.locks[key]
+
+    def release(self, owner, key):
+        shard = self.get_shard(key)
+        with shard.latch:
+            entry = shard.locks.get(key)
+            if entry is None or entry.holders.pop(owner, None) is None:
+                return
+            self._grant_waiting(entry, key)
+            self._forget(shard, key, entry)
+        owner.locks.pop(key, None)
+
+    """
+    Releases every lock owner holds in this lock manager.
+    """
+    def release_all(self, owner):
+        for key in [key for key, manager in owner.locks.items() if manager is self]:
+            self.release(owner, key)
+
+    def stats(self):
+        return {'waits': self.waits, 'refusals': self.refusals,
+                'wounds': self.wounds, 'timeouts': self.timeouts}
@@ -5,6 +5,17 @@ all operations performed by a set of transactions on a table within the scope
 of a single session. If the database is closed, then all changes recorded in
 the logger will be lost.
 """
+
+"""
+Whether the calling thread is running a transaction (see Transaction.begin).
+Operations made outside of a transaction can never be rolled back, so they
+are not archived.
+"""
+transaction_context = threading.local()
+
+def in_transaction():
+    return getattr(transaction_context, 'active', False)
+
 class Logger():
 
     def __init__(self):
@@ -25,6 +36,8 @@ class Logger():
         self.dir_log = {}
 
     def archive_delete(self, rid, rid_tuple):
+        if not in_transaction():
+            return
         thread_id = threading.current_thread().ident
         if thread_id not in self.log:
             self.log[thread_id] = {}
@@ -39,7 +52,9 @@ class Logger():
         self.log[thread_id]['deletes'].append(rid)
         self.dir_log[rid] = rid_tuple
 
-    def archive_update(self, tail_rid, base_rid, old_pointer, base_indir_id, base_schema_id, base_offset, tail_schema):
+    def archive_update(self, tail_rid, base_rid, old_pointer, base_indir_id, base_schema_id, base_offset, old_base_schema):
+        if not in_transaction():
+            return
         thread_id = threading.current_thread().ident
         if thread_id not in self.log:
             self.log[thread_id] = {}
@@ -47,16 +62,19 @@ class Logger():
             self.log[thread_id]['updates'] = []
         """
         Record the updated. This is done by specifying the tail record that
-        encodes the update (via the tail_rid) and the schema encoding for that
-        tail record. The base_indir_rid and indir_offset is used to specify the
-        exact indirection pointer of the updated base record that will point to
-        the update upon the update's creation. This data is also used to
-        restore the update in the event of a rollback.
+        encodes the update (via the tail_rid) and the schema encoding of the
+        base record before the update (old_base_schema). The base_indir_rid
+        and indir_offset is used to specify the exact indirection pointer of
+        the updated base record that will point to the update upon the
+        update's creation. This data is also used to restore the update in the
+        event of a rollback.
         """
         self.log[thread_id]['updates'].append((tail_rid, base_rid, old_pointer,
-            base_indir_id, base_schema_id, base_offset, tail_schema))
+            base_indir_id, base_schema_id, base_offset, old_base_schema))
 
     def archive_insert(self, rid):
+        if not in_transaction():
+            return
         thread_id = threading.current_thread().ident
         if thread_id not in self.log:
             self.log[thread_id] = {}
@@ -69,5 +87,19 @@ class Logger():
         self.log[thread_id]['inserts'].append(rid)
 
 
+    """
+    Returns the oldest tail rid archived by a transaction that is still
+    running (the largest one, as tail rids count down), or None. The tail
+    records from there on may still be rolled back, so merges leave them out.
+    """
+    def oldest_update(self):
+        oldest = None
+        # (other threads may archive changes meanwhile)
+        for archive in list(self.log.values()):
+            updates = archive.get('updates')
+            if updates and (oldest is None or updates[0][0] > oldest):
+                oldest = updates[0][0]
+        return oldest
+
     def clear_archive(self, thread_id):
-        del self.log[thread_id]
+        self.log.pop(thread_id, None)
@@ -0,0 +1,118 @@
+from collections import deque
+import threading
+import time
+
+"""
+Background merges. Updates only ever append tail records, so the longer a page
+range goes without a merge, the longer the tail chains that reads have to
+follow. Tables ask the scheduler to merge a page range (see
+Table.request_merge) when one of the triggers in config fires:
+
+- the range received config.MERGE_UPDATE_COUNT updates since its last merge,
+- it was given config.MERGE_TAIL_SEGMENTS sets of tail pages since then, or
+- a read had to follow config.MERGE_CHAIN_LENGTH tail records of the range to
+  find a record's current version.
+
+Requests are queued (each page range at most once) and merged one page range
+at a time, in the order they were made, by a single worker thread (see
+Table.merge_range).
+"""
+class MergeScheduler:
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = False
+        """
+        Queued (table, range_idx) pairs, and the set of those pairs (by table
+        name) for finding duplicates. current is the pair being merged.
+        """
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.queued = set()
+        self.current = None
+        self.requests = 0
+        self.merges = 0
+        self.skipped = 0
+        self.last_merge_time = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    """
+    Stops the worker once the merge in progress (if any) is done. Queued
+    requests are dropped: the triggers fire again for page ranges that still
+    need a merge.
+    """
+    def stop(self):
+        if self.thread is None:
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.thread = None
+        with self.condition:
+            self.queue.clear()
+            self.queued = set()
+
+    def request(self, table, range_idx):
+        with self.condition:
+            if (table.name, range_idx) in self.queued:
+                return
+            self.queued.add((table.name, range_idx))
+            self.queue.append((table, range_idx))
+            self.requests += 1
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                table, range_idx = self.current = self.queue.popleft()
+                self.queued.discard((table.name, range_idx))
+            start_time = time.monotonic()
+            try:
+                merged = table.merge_range(range_idx)
+            except Exception as e:
+                print('merge error: merging page range', range_idx, 'of',
+                        table.name, 'failed:', e)
+                merged = False
+            with self.condition:
+                if merged:
+                    self.merges += 1
+                    self.last_merge_time = time.monotonic() - start_time
+                else:
+                    self.skipped += 1
+                self.current = None
+                self.condition.notify_all()
+
+    """
+    Returns once every queued merge is done (or the worker has stopped).
+    """
+    def wait(self):
+        with self.condition:
+            while (self.queue or self.current is not None) and self.thread is not None:
+                self.condition.wait()
+
+    """
+    Drops the queued merges of a table and waits for its merge in progress, if
+    any. Used when the table is dropped.
+    """
+    def forget(self, table):
+        with self.condition:
+            self.queue = deque(pair for pair in self.queue if pair[0] is not table)
+            self.queued = set((pair[0].name, pair[1]) for pair in self.queue)
+            while self.current is not None and self.current[0] is table:
+                self.condition.wait()
+
+    def stats(self):
+        return {'requests': self.requests, 'merges': self.merges,
+                'skipped': self.skipped, 'queued': len(self.queue),
+                'last_merge_time': self.last_merge_time}
@@ -0,0 +1,241 @@
+from collections import deque
+from logger import transaction_context, in_transaction
+from page_directory import TAIL_RID_BASE
+import threading
+import time
+
+"""
+Multi-version concurrency control. Every version of a record, the base record
+and each of its tail records, is stamped with the time it was written (the
+time column). Reads see the table as of a snapshot, a (start_ts, thread_id)
+pair:
+
+- a transaction takes its snapshot when it begins (see Transaction.begin),
+  and every read it makes sees the versions committed before that, and its
+  own writes,
+- a query outside of a transaction reads at (None, thread_id): the latest
+  committed version of every record.
+
+Reads walk a record's tail chain, newest first, past the versions their
+snapshot cannot see (see Table._get_most_recent_update), so they need no
+record locks.
+
+Whether a version is visible is decided by the version table of its table
+(see VersionTable), which holds the versions written by transactions that
+have not committed yet and the commit times of the versions that some active
+snapshot may still not see. Versions that are in neither are visible to
+every snapshot. Timestamps are nanoseconds, and next_timestamp never hands
+out the same one twice.
+
+Deletes and indices are not versioned. A delete takes effect for every
+snapshot at once, since it removes the record from the page directory. An
+index holds the newest key of every record, committed or not, so a select
+through it leaves out the records whose version the snapshot sees has
+another key (see Query.select), but misses those whose key was changed away
+from the one searched for after the snapshot was taken.
+"""
+
+clock_lock = threading.Lock()
+last_timestamp = 0
+
+"""
+Start times of the snapshots of the transactions that are running. Changed
+while holding clock_lock, so a snapshot is registered before any later
+timestamp is handed out.
+"""
+active_lock = threading.Lock()
+active_snapshots = {}
+
+def _tick():
+    global last_timestamp
+    last_timestamp = max(time.time_ns(), last_timestamp + 1)
+    return last_timestamp
+
+"""
+Returns a timestamp greater than every timestamp returned before.
+"""
+def next_timestamp():
+    with clock_lock:
+        return _tick()
+
+"""
+Starts a snapshot at the current time, for the calling thread. It stays
+registered until end_snapshot, so the versions it can see are kept.
+"""
+def begin_snapshot():
+    with clock_lock:
+        start_ts = _tick()
+        with active_lock:
+            active_snapshots[start_ts] = True
+    return (start_ts, threading.get_ident())
+
+def end_snapshot(snapshot):
+    if snapshot is None:
+        return
+    with active_lock:
+        active_snapshots.pop(snapshot[0], None)
+
+"""
+The start time of the oldest active snapshot, or None if there is none.
+"""
+def oldest_snapshot():
+    with active_lock:
+        return min(active_snapshots, default=None)
+
+"""
+The snapshot that reads made by the calling thread see: that of its
+transaction, or the latest committed versions outside of one.
+"""
+def read_snapshot():
+    if in_transaction():
+        return getattr(transaction_context, 'snapshot', None)
+    return (None, threading.get_ident())
+
+"""
+Commits the versions written by the transaction running on thread writer in
+the tables whose version tables are given, all at the same commit time, which is
+returned.
+"""
+def commit(version_tables, writer):
+    with clock_lock:
+        commit_ts = _tick()
+        for versions in version_tables:
+            versions.commit(writer, commit_ts)
+    return commit_ts
+
+
+class VersionTable:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        """
+        Maps the rids of the versions that some snapshot may not see to
+        (commit time, page range). The commit time of a version written by a
+        transaction that has not committed yet is None, and its writer is in
+        owners.
+        """
+        self.stamps = {}
+        self.owners = {}
+        """
+        The versions written by each running transaction, as (rid, page range)
+        pairs.
+        """
+        self.writes = {}
+        """
+        For each page range, the number of versions in it that are not
+        committed yet and the latest commit time of a version in it, so a
+        reader can tell when it sees every version of a page range (see
+        sees_all).
+        """
+        self.pending = {}
+        self.latest = {}
+        """
+        The committed versions in stamps, as (commit time, rid) pairs in
+        commit order, so they can be dropped once every snapshot sees them.
+        """
+        self.order = deque()
+
+    """
+    Records a version written at timestamp to page range range_idx. Versions
+    written by a transaction stay invisible to other snapshots until it
+    commits; others are committed when they are written. Called while holding
+    the latch of the page range.
+    """
+    def record_write(self, rid, range_idx, timestamp):
+        transactional = in_transaction()
+        if not transactional and not active_snapshots:
+            # every snapshot taken from now on starts after timestamp
+            return
+        with self.lock:
+            if transactional:
+                writer = threading.get_ident()
+                self.stamps[rid] = (None, range_idx)
+                self.owners[rid] = writer
+                self.writes.setdefault(writer, []).append((rid, range_idx))
+                self.pending[range_idx] = self.pending.get(range_idx, 0) + 1
+            else:
+                self._stamp(rid, range_idx, timestamp)
+            self._prune()
+
+    def _stamp(self, rid, range_idx, timestamp):
+        self.stamps[rid] = (timestamp, range_idx)
+        if timestamp > self.latest.get(range_idx, 0):
+            self.latest[range_idx] = timestamp
+        self.order.append((timestamp, rid))
+
+    """
+    Drops the committed versions that every active snapshot sees, and that
+    every later snapshot will.
+    """
+    def _prune(self):
+        oldest = oldest_snapshot()
+        order = self.order
+        while order and (oldest is None or order[0][0] <= oldest):
+            timestamp, rid = order.popleft()
+            stamp = self.stamps.get(rid)
+            if stamp is not None and stamp[0] == timestamp:
+                del self.stamps[rid]
+
+    def commit(self, writer, commit_ts):
+        with self.lock:
+            for rid, range_idx in self.writes.pop(writer, ()):
+                # the version gets its commit time before it stops being
+                # pending, so readers see one or the other:
+                self._stamp(rid, range_idx, commit_ts)
+                del self.owners[rid]
+                self.pending[range_idx] -= 1
+            self._prune()
+
+    """
+    Forgets the versions written by the transaction running on writer, once
+    it has rolled them back.
+    """
+    def abort(self, writer):
+        with self.lock:
+            for rid, range_idx in self.writes.pop(writer, ()):
+                self.stamps.pop(rid, None)
+                self.owners.pop(rid, None)
+                self.pending[range_idx] -= 1
+
+    """
+    Whether the version rid is visible to snapshot (None sees every version,
+    committed or not).
+    """
+    def visible(self, rid, snapshot):
+        if snapshot is None:
+            return True
+        stamp = self.stamps.get(rid)
+        if stamp is None:
+            return True
+        if stamp[0] is None:
+            return self.owners.get(rid) == snapshot[1]
+        return snapshot[0] is None or stamp[0] <= snapshot[0]
+
+    """
+    Whether snapshot sees every version in page range range_idx, so reads of
+    the range need not check the versions one by one.
+    """
+    def sees_all(self, range_idx, snapshot):
+        if snapshot is None:
+            return True
+        if self.pending.get(range_idx, 0) != 0:
+            return False
+        return snapshot[0] is None or self.latest.get(range_idx, 0) <= snapshot[0]
+
+    """
+    Returns the rid of the oldest tail record in page range range_idx that
+    some snapshot cannot see yet (that a transaction may still roll back, or
+    that committed after the oldest active snapshot started), or None if
+    there is none. Merges stop short of it.
+    """
+    def merge_horizon(self, range_idx):
+        oldest = oldest_snapshot()
+        horizon = None
+        with self.lock:
+            for rid, (timestamp, stamp_range) in self.stamps.items():
+                if stamp_range != range_idx or rid < TAIL_RID_BASE // 2:
+                    continue
+                if timestamp is None or (oldest is not None and timestamp > oldest):
+                    if horizon is None or rid > horizon:
+                        horizon = rid
+        return horizon
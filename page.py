@@ -1,16 +1,70 @@
 # from config import *
-import struct
+from array import array
+import compression
+import sys
 import threading
 
+"""
+Pages are 4096 bytes, i.e. 512 slots of 64 bit integers. Slot 0 holds the TPS
+of base pages and slot 1 holds the number of records written to the page, so
+every page has room for 510 records.
+On disk each slot is stored as a big-endian int64. In memory the slots are kept
+in an array('q') in native byte order, so reads and writes are plain array
+indexing and whole columns can be moved with a single slice.
+Merged base pages are written in a compressed form instead (see compression).
+"""
+PAGE_SIZE = 4096
+PAGE_SLOTS = 512
+SWAP_BYTES = sys.byteorder == 'little'
+
 class Page:
 
     def __init__(self, page_id):
-        self.num_records = 2
         self.pg_id = page_id
         self.dirty = False
         self.pin_lock = threading.Lock()
         self.pinned = 0
-        self.data = bytearray(4096)
+        """
+        The LSN just past the last write-ahead log record of a change to this
+        page. Kept in memory only: the page may not be written to disk before
+        the log has been flushed up to it.
+        """
+        self.lsn = 0
+        self.slots = array('q', bytes(PAGE_SIZE))
+        self.slots[1] = 2
+        """
+        Set on merged base pages, which are never written to again, so they
+        are written to disk compressed (see compression).
+        """
+        self.compressed = False
+
+    """
+    num_records lives in slot 1 of the page, so the in-memory count and the
+    on-disk count can never drift apart (e.g. after a whole page copy).
+    """
+    @property
+    def num_records(self):
+        return self.slots[1]
+
+    @num_records.setter
+    def num_records(self, value):
+        self.slots[1] = value
+
+    """
+    The page contents in their on-disk (big-endian) byte layout, compressed if
+    the page is compressed and an encoding makes it smaller.
+    """
+    @property
+    def data(self):
+        if self.compressed:
+            image = compression.encode_page(self.slots)
+            if image is not None:
+                return image
+        if SWAP_BYTES:
+            swapped = array('q', self.slots)
+            swapped.byteswap()
+            return swapped.tobytes()
+        return self.slots.tobytes()
 
     def get_id(self):
         return self.pg_id
@@ -28,84 +82,134 @@ class Page:
         self.pin_lock.release()
 
     def has_capacity(self):
-        return (self.num_records - 2) != 510
-        pass
+        return (self.slots[1] - 2) != 510
 
     def get_capacity(self):
-        return 510 - (self.num_records-2)
-    
+        return 510 - (self.slots[1] - 2)
+
     # use only to write record data, rid and timestamp
     def write(self, value):
-        self.pin()
         if not self.has_capacity():
             print('page write error: page has no more available space.')
             return
-        self.num_records += 1
-        write_pos = self.num_records*8
-        self.data[(write_pos-8):(write_pos)] = struct.pack('>q', value)
-        self.update(self.num_records, 1)
+        self.slots[self.slots[1]] = value
+        self.slots[1] += 1
         self.dirty = True
-        self.unpin()
 
-    # must be used to write schema
-    def write_schema(self, schema_encoding):
-        self.pin()
-        if not self.has_capacity():
+    """
+    Appends several values at once. Returns the offset of the first value
+    written.
+    """
+    def write_many(self, values):
+        start = self.slots[1]
+        end = start + len(values)
+        if end > PAGE_SLOTS:
             print('page write error: page has no more available space.')
             return
-        self.num_records += 1
-        write_pos = self.num_records*8
-        self.data[(write_pos-8):(write_pos)] = struct.pack('>q', int(schema_encoding,2))
-        self.update(self.num_records, 1)
+        self.slots[start:end] = array('q', values)
+        self.slots[1] = end
         self.dirty = True
-        self.unpin()
-    
+        return start
+
+    """
+    Schema encodings are stored as integer bitmasks. Following the original
+    string encoding, column i of an n column table is bit (n - 1 - i).
+    """
+    def write_schema_mask(self, schema_mask):
+        self.write(schema_mask)
+
     # used to update pre-existing values
     def update(self, value, offset):
-        self.pin()
         if offset > 511 or offset < 0:
             print('page update error: offset out of range.')
             return
-        self.data[(offset+1)*8 - 8:8*(offset+1)] = struct.pack('>q', value)
+        self.slots[offset] = value
         self.dirty = True
-        self.unpin()
 
-    def update_schema(self, schema_encoding, offset):
-        self.pin()
-        if offset > 511 or offset < 0:
+    """
+    Overwrites the slots starting at offset with values.
+    """
+    def update_many(self, values, offset):
+        end = offset + len(values)
+        if end > PAGE_SLOTS or offset < 0:
             print('page update error: offset out of range.')
             return
-        self.data[(offset+1)*8 - 8:8*(offset+1)] = struct.pack('>q',
-                int(schema_encoding,2))
+        self.slots[offset:end] = array('q', values)
         self.dirty = True
-        self.unpin()
+
+    """
+    Sets the slot at each of offsets to the matching entry of values.
+    """
+    def scatter(self, offsets, values):
+        slots = self.slots
+        for offset, value in zip(offsets, values):
+            slots[offset] = value
+        self.dirty = True
+
+    def update_schema_mask(self, schema_mask, offset):
+        self.update(schema_mask, offset)
 
     # used to read data from page:
     def read(self, offset):
-        self.pin()
         if offset > 511 or offset < 0:
             print('page read error: offset out of range.')
             return
-        self.unpin()
-        return struct.unpack('>q', self.data[(offset+1)*8 - 8:8*(offset+1)])[0]
+        return self.slots[offset]
 
-    # must be used to read schema
-    def read_schema(self, num_columns, offset):
-        self.pin()
-        if offset > 511 or offset < 0:
-            print('page read error: offset out of range.')
+    def read_many(self, offsets):
+        slots = self.slots
+        return [slots[offset] for offset in offsets]
+
+    """
+    Returns a copy of the record slots in [start, stop) as an array('q'). By
+    default, this is every record that has been written to the page.
+    """
+    def read_column(self, start=2, stop=None):
+        if stop is None:
+            stop = self.slots[1]
+        return self.slots[start:stop]
+
+    def read_schema_mask(self, offset):
+        return self.read(offset)
+
+    """
+    Empties the page, for a page id that is reused.
+    """
+    def clear(self):
+        self.slots[:] = array('q', bytes(PAGE_SIZE))
+        self.slots[1] = 2
+        self.compressed = False
+        self.dirty = True
+
+    """
+    Copies the whole contents of another page into this one.
+    """
+    def copy_from(self, page):
+        self.slots[:] = page.slots
+        self.dirty = True
+
+    """
+    Disk reads go straight into the page's slot array: prepare_load returns the
+    (zeroed) buffer to read the on-disk bytes into and finish_load converts
+    them from the on-disk byte order, or decodes them if they are a compressed
+    image. A short read (e.g. past the end of the page file) leaves the
+    remaining slots zeroed, i.e. an empty page.
+    """
+    def prepare_load(self):
+        self.slots[1] = 0
+        return self.slots
+
+    def finish_load(self):
+        if compression.is_compressed(memoryview(self.slots).cast('B')):
+            self.slots[:] = compression.decode_page(self.slots.tobytes())
+            self.compressed = True
             return
-        schema_encoding = self.data[(offset+1)*8 - 8:8*(offset+1)]
-        schema_in_bits = ''.join(format(byte, '08b') for byte in schema_encoding)
-        self.unpin()
-        return schema_in_bits[64-num_columns:]
+        if SWAP_BYTES:
+            self.slots.byteswap()
+        if self.slots[1] == 0:
+            self.slots[1] = 2
 
     def load_data(self, read_data):
-        for i in range(len(read_data)):
-            self.data[i] = read_data[i]
-        recorded_num = struct.unpack('>q', self.data[8:16])[0]
-        if recorded_num != 0:
-            self.num_records = recorded_num
-        else:
-            self.data[8:16] = struct.pack('>q', self.num_records)
-
+        buffer = memoryview(self.prepare_load()).cast('B')
+        buffer[:len(read_data)] = read_data
+        self.finish_load()
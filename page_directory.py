@@ -0,0 +1,258 @@
+from page import Page
+from array import array
+from wal import DIRECTORY
+import config
+import os
+import threading
+
+"""
+The page directory maps the rid of every record of a table to a
+(first_page_id, schema_page_id, offset, range_idx) tuple, see Table.
+
+Entries are kept in fixed-width directory pages that live in the buffer pool
+like any other page, in a page file of their own (table_name/directory), so
+the directory is cached, written back and checkpointed page by page and never
+has to be held in memory (or pickled) as a whole. Each entry takes two slots
+of a page:
+
+    first_page_id + 1               (0: no record with this rid)
+    schema_page_id << 32 | range_idx << 9 | offset
+
+so a directory page holds ENTRIES_PER_PAGE entries. Rids are grouped into runs
+of ENTRIES_PER_PAGE consecutive rids, and a group gets a directory page when
+the first rid of the group is added. Base rids are handed out in dense blocks
+counting up from 1, and a table's tail rids in dense blocks counting down from
+TAIL_RID_BASE (see RIDspace), so every directory page is filled up.
+
+Lookups go through a cache of decoded groups: one array('q') per group that
+holds the four fields of each entry next to each other (32 bytes per record,
+-1 as first_page_id for a missing record), indexed by the rid's position in
+its group. Finding a record is then a dictionary lookup and array indexing,
+without a trip through the buffer pool. The cache is write-through (changes
+go to the directory page as well) and holds at most
+config.DIRECTORY_CACHE_GROUPS groups; when it is full, the group that was
+loaded first is dropped.
+
+Records of different page ranges are changed concurrently (see
+Table.range_latches), so changes to the directory and cache misses are made
+while holding the directory's own short latch. Lookups that hit the cache
+take no latch.
+
+Changes of different page ranges may reach the write-ahead log in another
+order than the one their groups got directory pages in, so the page of every
+new group is logged on its own (DIRECTORY), while holding the latch and
+before the change that adds the group's first rid (see reserve). Recovery
+gives each group the page it had, and a directory page written back before a
+crash is read back as the same group.
+"""
+ENTRIES_PER_PAGE = 255
+TAIL_RID_BASE = pow(2, 60)
+
+class PageDirectory:
+
+    def __init__(self, table_name, bp, log=None):
+        self.name = table_name + '/directory'
+        self.bp = bp
+        """
+        Appends a record to the write-ahead log and returns its LSN (see
+        Table.log).
+        """
+        self.log = log
+        """
+        Maps each group of rids that has a directory page to the id of that
+        page. Groups of base rids have numbers >= 0, groups of tail rids
+        negative numbers. Saved with the table's metadata.
+        """
+        self.pages = {}
+        self.cache = {}
+        self.latch = threading.Lock()
+
+    """
+    Returns the group of a rid and the position of its entry in the group.
+    """
+    def locate(self, rid):
+        if rid < TAIL_RID_BASE // 2:
+            index = rid - 1
+            return index // ENTRIES_PER_PAGE, index % ENTRIES_PER_PAGE
+        index = TAIL_RID_BASE - rid
+        return -1 - index // ENTRIES_PER_PAGE, index % ENTRIES_PER_PAGE
+
+    """
+    Returns the decoded entries of a group (see above), reading the group's
+    directory page into the cache if necessary, or None if the group has no
+    directory page.
+    """
+    def entries(self, group):
+        entries = self.cache.get(group)
+        if entries is not None:
+            return entries
+        with self.latch:
+            return self._load_entries(group)
+
+    def _load_entries(self, group):
+        # another thread may have loaded the group meanwhile:
+        entries = self.cache.get(group)
+        if entries is not None:
+            return entries
+        page_id = self.pages.get(group)
+        if page_id is None:
+            return None
+        slots = self.bp.get_page(self.name, page_id).read_column(2, 2 + 2*ENTRIES_PER_PAGE)
+        packed = slots[1::2]
+        entries = array('q', bytes(32*ENTRIES_PER_PAGE))
+        entries[0::4] = array('q', [first_page_id - 1 for first_page_id in slots[0::2]])
+        entries[1::4] = array('q', [value >> 32 for value in packed])
+        entries[2::4] = array('q', [value & 511 for value in packed])
+        entries[3::4] = array('q', [(value >> 9) & 0x7fffff for value in packed])
+        if len(self.cache) >= config.DIRECTORY_CACHE_GROUPS:
+            del self.cache[next(iter(self.cache))]
+        self.cache[group] = entries
+        return entries
+
+    def __getitem__(self, rid):
+        group, index = self.locate(rid)
+        entries = self.entries(group)
+        if entries is not None:
+            i = 4*index
+            if entries[i] >= 0:
+                return (entries[i], entries[i + 1], entries[i + 2], entries[i + 3])
+        raise KeyError(rid)
+
+    def __contains__(self, rid):
+        try:
+            self[rid]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, rid, default=None):
+        try:
+            return self[rid]
+        except KeyError:
+            return default
+
+    """
+    Gives the groups of rids that have no directory page yet one, and logs
+    the page of each (see above). Called before the change that adds rids
+    is logged.
+    """
+    def reserve(self, rids):
+        groups = []
+        for rid in rids:
+            group = self.locate(rid)[0]
+            if group not in self.pages and group not in groups:
+                groups.append(group)
+        if not groups:
+            return
+        with self.latch:
+            for group in groups:
+                if group in self.pages:
+                    continue
+                page_id = len(self.pages)
+                if self.log is not None:
+                    self.log(DIRECTORY, [group, page_id])
+                self.pages[group] = page_id
+
+    """
+    Replays a logged DIRECTORY record, on behalf of recovery.
+    """
+    def redo_reserve(self, group, page_id):
+        self.pages[group] = page_id
+
+    """
+    Sets the entry of rid. lsn is the write-ahead log record of the change,
+    if any. Directory pages are shared by the page ranges, so a page keeps
+    the newest lsn it was stamped with.
+    """
+    def set(self, rid, entry, lsn=0):
+        group, index = self.locate(rid)
+        with self.latch:
+            page_id = self.pages.get(group)
+            if page_id is None:
+                page_id = len(self.pages)
+                self.pages[group] = page_id
+            page = self.bp.get_page(self.name, page_id)
+            page.lsn = max(page.lsn, lsn)
+            page.update_many(pack_entry(entry), 2 + 2*index)
+            entries = self.cache.get(group)
+            if entries is not None:
+                entries[4*index:4*index + 4] = array('q', entry)
+
+    """
+    Removes the entry of rid, if there is one.
+    """
+    def remove(self, rid, lsn=0):
+        group, index = self.locate(rid)
+        with self.latch:
+            page_id = self.pages.get(group)
+            if page_id is None:
+                return
+            page = self.bp.get_page(self.name, page_id)
+            page.lsn = max(page.lsn, lsn)
+            page.update_many([0, 0], 2 + 2*index)
+            entries = self.cache.get(group)
+            if entries is not None:
+                entries[4*index] = -1
+
+    """
+    Yields the rid of every base record in the directory, in ascending order.
+    """
+    def base_rids(self):
+        for group in sorted(group for group in self.pages if group >= 0):
+            first_page_ids = self.entries(group)[0::4]
+            first_rid = group*ENTRIES_PER_PAGE + 1
+            for i in range(ENTRIES_PER_PAGE):
+                if first_page_ids[i] >= 0:
+                    yield first_rid + i
+
+    """
+    Returns the rid of the entry at index in group (the inverse of locate).
+    """
+    def rid_of(self, group, index):
+        if group >= 0:
+            return group*ENTRIES_PER_PAGE + index + 1
+        return TAIL_RID_BASE - (-1 - group)*ENTRIES_PER_PAGE - index
+
+    """
+    Writes a copy of the directory to the page file at path, with every entry
+    replaced by remap(rid, entry): a new entry, or None to leave the record
+    out. Groups without entries are left out as well, and the directory pages
+    of the copy are numbered densely. Returns the group to page id map of the
+    copy (see load). Used to compact a table (see Table.compact).
+    """
+    def compact(self, remap, path):
+        pages = {}
+        with open(path, mode='wb') as f:
+            for group in sorted(self.pages):
+                entries = self.entries(group)
+                page = Page(len(pages))
+                empty = True
+                for index in range(ENTRIES_PER_PAGE):
+                    i = 4*index
+                    if entries[i] < 0:
+                        continue
+                    entry = remap(self.rid_of(group, index), tuple(entries[i:i + 4]))
+                    if entry is not None:
+                        page.update_many(pack_entry(entry), 2 + 2*index)
+                        empty = False
+                if not empty:
+                    pages[group] = len(pages)
+                    f.write(page.data)
+            f.flush()
+            os.fsync(f.fileno())
+        return pages
+
+    def snapshot(self):
+        with self.latch:
+            return dict(self.pages)
+
+    def load(self, pages):
+        self.pages = pages
+        self.cache = {}
+
+
+"""
+Returns the two slots that hold a directory entry (see above).
+"""
+def pack_entry(entry):
+    return [entry[0] + 1, entry[1] << 32 | entry[3] << 9 | entry[2]]
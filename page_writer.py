@@ -0,0 +1,161 @@
+import config
+import os
+import threading
+import time
+
+"""
+Background writer for the buffer pool. Without it, dirty pages only reach disk
+when they are picked as eviction victims (putting the write on the latency path
+of whatever request caused the eviction) or when the database is closed.
+
+The writer wakes up every config.WRITER_INTERVAL seconds, or as soon as an
+eviction runs into a dirty victim, and writes dirty pages once more than
+config.WRITER_DIRTY_RATIO of the pool is dirty. Each batch is written in page
+id order per table, runs of adjacent pages are coalesced into a single
+vectored write (pwritev), and every table file that was written to is
+fsynced once per batch. The writer also flushes the write-ahead log every
+time it wakes up, so changes made outside of transactions reach the log on
+disk within config.WRITER_INTERVAL seconds.
+Pages are pinned while they are being written so that the eviction of the same
+page (and its own write-back) cannot overtake the writer's copy.
+"""
+class PageWriter:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.dirty_victims = False
+        self.batch_lock = threading.Lock()
+        """
+        Progress counters. progress_callback, if set, is called with the
+        result of progress() after every batch.
+        """
+        self.batches = 0
+        self.pages_written = 0
+        self.writes = 0
+        self.syncs = 0
+        self.last_batch_pages = 0
+        self.last_batch_time = 0
+        self.progress_callback = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+
+    """
+    Asks the writer to write dirty pages right away, even below the dirty
+    threshold, because evictions are running into (or passing over) dirty
+    victims.
+    """
+    def notify(self):
+        if self.thread is not None:
+            self.dirty_victims = True
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(config.WRITER_INTERVAL)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            self.pool.flush_log()
+            dirty_victims = self.dirty_victims
+            self.dirty_victims = False
+            dirty = self.pool.dirty_pages()
+            if dirty_victims:
+                self.write_batch(dirty)
+            elif len(dirty) > self.pool.limit * config.WRITER_DIRTY_RATIO:
+                # write enough pages to get down to half of the threshold:
+                target = int(self.pool.limit * config.WRITER_DIRTY_RATIO / 2)
+                self.write_batch(dirty[:len(dirty) - target])
+
+    """
+    Writes dirty pages until none are left. Used on shutdown.
+    """
+    def flush(self):
+        while True:
+            dirty = self.pool.dirty_pages()
+            if not dirty:
+                return
+            self.write_batch(dirty)
+
+    """
+    Writes a batch of (table_name, page_id, page) triples. Pages are written in
+    page id order, adjacent pages are written with one pwritev call, and each
+    table file is fsynced once at the end of the batch.
+    """
+    def write_batch(self, dirty):
+        if not dirty:
+            return 0
+        with self.batch_lock:
+            start_time = time.monotonic()
+            tables = {}
+            for table_name, page_id, page in dirty:
+                tables.setdefault(table_name, []).append((page_id, page))
+            written = 0
+            for table_name, pages in tables.items():
+                try:
+                    fd = self.pool.get_file(table_name)
+                except FileNotFoundError:
+                    continue
+                pages.sort(key=lambda pair: pair[0])
+                run_start = None
+                run = []
+                pinned = []
+                for page_id, page in pages:
+                    page = self.pool.pin_resident(table_name, page_id)
+                    if page is None:
+                        continue
+                    pinned.append(page)
+                    if not page.dirty:
+                        continue
+                    # clear the flag before copying, so that a concurrent
+                    # write makes the page dirty again:
+                    page.dirty = False
+                    data = page.data
+                    self.pool.flush_log(page.lsn)
+                    if run and (page_id != run_start + len(run) or
+                            len(run) == config.WRITER_MAX_RUN):
+                        self._write_run(fd, run_start, run)
+                        run = []
+                    if not run:
+                        run_start = page_id
+                    run.append(data)
+                    written += 1
+                if run:
+                    self._write_run(fd, run_start, run)
+                for page in pinned:
+                    self.pool.unpin(page)
+                os.fsync(fd)
+                self.syncs += 1
+            self.batches += 1
+            self.pages_written += written
+            self.last_batch_pages = written
+            self.last_batch_time = time.monotonic() - start_time
+        if self.progress_callback is not None:
+            self.progress_callback(self.progress())
+        return written
+
+    def _write_run(self, fd, first_page_id, buffers):
+        os.pwritev(fd, buffers, 4096*first_page_id)
+        self.writes += 1
+
+    def progress(self):
+        return {'batches': self.batches, 'pages_written': self.pages_written,
+                'writes': self.writes, 'syncs': self.syncs,
+                'last_batch_pages': self.last_batch_pages,
+                'last_batch_time': self.last_batch_time,
+                'dirty_pages': len(self.pool.dirty_pages())}
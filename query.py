@@ -1,5 +1,8 @@
 from table import Table, Record
 from index import Index
+from scan import ColumnScanner
+from mvcc import read_snapshot
+from logger import in_transaction
 import threading
 
 
@@ -14,22 +17,30 @@ class Query:
         self.table = table
         self.key = self.table.key
         self.bp = self.table.bp
+        self.scanner = ColumnScanner(self.table)
 
     """
-    Delete a record with specified key.
+    Delete a record with specified key. Reads take no locks (see mvcc), but
+    changes lock their record, and a transaction only changes records whose
+    latest version its snapshot sees (see Table.is_current).
     """
     def delete(self, key):
         rid = self.table.index.locate(self.key, key)[0]
-        got_lock = self.table.index.obtain_xlock([rid])
-        if got_lock:
-            self.table.invalidate_record(rid)
-            for i in self.table.index.indices.keys():
-                if self.table.index.indices[i] != None:
-                    self.table.index.delete(rid, i, key)
-            return True
-        else:
-            print(threading.current_thread().ident, 'aborted on delete')
-            return False
+        got_lock = self.table.index.obtain_xlock(rid)
+        try:
+            if got_lock and (not in_transaction() or self.table.is_current(rid, read_snapshot())):
+                self.table.invalidate_record(rid)
+                for i in self.table.index.indices.keys():
+                    if self.table.index.indices[i] != None:
+                        self.table.index.delete(rid, i, key)
+                return True
+            else:
+                print(threading.current_thread().ident, 'aborted on delete')
+                return False
+        finally:
+            # outside of a transaction, the lock is only held for the query
+            if not in_transaction():
+                self.table.index.release_locks()
     """
     Insert a record with specified columns.
     """
@@ -38,12 +49,34 @@ class Query:
             print(threading.current_thread().ident, 'aborted on insert')
             return False
         rid = self.table.insert_base_record(*columns)
-        self.table.index.add_key(rid, self.key, self.bp)
+        for i in self.table.index.indices.keys():
+            if self.table.index.indices[i] != None:
+                self.table.index.add_keys([rid], i, [columns[i]])
+        return True
+
+    """
+    Insert many records at once. rows is a list of column lists. The records
+    are written a page range at a time and their keys are registered with
+    every existing index in bulk.
+    """
+    def insert_many(self, rows):
+        for columns in rows:
+            if len(columns) != self.table.num_columns:
+                print(threading.current_thread().ident, 'aborted on insert')
+                return False
+        rids = self.table.insert_base_records(rows)
+        for i in self.table.index.indices.keys():
+            if self.table.index.indices[i] != None:
+                self.table.index.add_keys(rids, i, [row[i] for row in rows])
         return True
 
     """
     Read a record with specified key. Will return an empty list if query
-    cannot be completed or if no records are found.
+    cannot be completed or if no records are found. Records are read as the
+    snapshot of the running transaction sees them, or at their latest
+    committed version outside of one, without taking locks (see mvcc). The
+    index holds the newest keys, so records whose version read has another
+    key are left out.
     """
     def select(self, key, column_number, query_columns):
         if len(query_columns) is not self.table.num_columns:
@@ -54,16 +87,67 @@ class Query:
             self.table.index.create_index(column_number)
 
         rids = self.table.index.locate(column_number, key)
-        got_lock = self.table.index.obtain_rlock(rids)
-        if len(rids) != 0 and got_lock:
-            records = self.table.get_records(rids, query_columns, key)      
-            return records
-        elif len(rids) == 0:
+        if len(rids) != 0:
+            records = self.table.get_records(rids,
+                    self._with_column(query_columns, column_number), key,
+                    read_snapshot())
+            return self._matching(records, column_number, key, query_columns)
+        else:
             print('select error: table does not contain specified key')
             return []
-        else:
-            # print(threading.current_thread().ident, 'aborted on select')
-            return False
+    """
+    Read the records for many keys at once. Returns a list with one entry per
+    key, in the order of keys, where each entry is the list of records found
+    for that key (empty if the key does not exist).
+    """
+    def select_many(self, keys, column_number, query_columns):
+        if len(query_columns) != self.table.num_columns:
+            return []
+
+        if self.table.index.indices[column_number] == None:
+            self.table.index.create_index(column_number)
+
+        rid_lists = [self.table.index.locate(column_number, key) for key in keys]
+        rids = []
+        rid_keys = []
+        for key, rid_list in zip(keys, rid_lists):
+            rids.extend(rid_list)
+            rid_keys.extend([key]*len(rid_list))
+        records = self.table.get_records_batch(rids,
+                self._with_column(query_columns, column_number), rid_keys,
+                read_snapshot())
+        results = []
+        start = 0
+        for key, rid_list in zip(keys, rid_lists):
+            results.append(self._matching([record for record in
+                    records[start:start + len(rid_list)] if record is not None],
+                    column_number, key, query_columns))
+            start += len(rid_list)
+        return results
+
+    """
+    Returns query_columns with column_number queried as well, so the records
+    read can be checked against the key they were located with.
+    """
+    def _with_column(self, query_columns, column_number):
+        if query_columns[column_number] == 1:
+            return query_columns
+        query_columns = list(query_columns)
+        query_columns[column_number] = 1
+        return query_columns
+
+    """
+    Leaves out the records whose column column_number is not key: the index
+    located them by a key that the version read does not have (see mvcc).
+    Blanks the column again if it was not queried.
+    """
+    def _matching(self, records, column_number, key, query_columns):
+        records = [record for record in records if record.columns[column_number] == key]
+        if query_columns[column_number] != 1:
+            for record in records:
+                record.columns[column_number] = None
+        return records
+
     """
     Update a record with specified key and columns.
     Currently assumes uniqueness of primary key.
@@ -84,41 +168,63 @@ class Query:
             return
 
         got_lock = self.table.index.obtain_xlock(rid)
-        if got_lock:
-            self.table.update_record(rid, columns)
-            for i in range(len(columns)):
-                # if we've updated column value and updated value is different
-                # from old value:
-                if columns[i] != None:
-                    try:
-                        self.table.index.update_index(rid, i, columns[i])
-                    except KeyError:
-                        pass
-            return True
-        else:
-            # print(threading.current_thread().ident, 'aborted on update')
-            return False
+        try:
+            if got_lock and (not in_transaction() or self.table.is_current(rid, read_snapshot())):
+                self.table.update_record(rid, columns)
+                for i in range(len(columns)):
+                    # if we've updated column value and updated value is different
+                    # from old value:
+                    if columns[i] != None:
+                        try:
+                            self.table.index.update_index(rid, i, columns[i])
+                        except KeyError:
+                            pass
+                return True
+            else:
+                # print(threading.current_thread().ident, 'aborted on update')
+                return False
+        finally:
+            # outside of a transaction, the lock is only held for the query
+            if not in_transaction():
+                self.table.index.release_locks()
     """
     Aggregate values stored in specfied column over specified range of key
     values:
     """
     def sum(self, start_range, end_range, aggregate_column_index):
+        # wide ranges are cheaper to answer with a columnar scan:
+        if self.scanner.should_scan(start_range, end_range):
+            return self.scanner.aggregate(aggregate_column_index, start_range,
+                    end_range, read_snapshot())[0]
         column_sum = 0
-        key = 0
         query_columns = [0]*self.table.num_columns
         query_columns[aggregate_column_index] = 1
-        rids = self.table.index.locate_range(start_range, end_range,
-                self.key)
-
-        if len(rids) is not 0:
-            records = self.table.get_records(rids, query_columns, key)
-            for record in records:
-                column_sum += record.columns[aggregate_column_index]
+        rids = []
+        keys = []
+        cursor = self.table.index.range_cursor(start_range, end_range, self.key)
+        for key, key_rids in cursor:
+            rids.extend(key_rids)
+            keys.extend([key]*len(key_rids))
+            if len(rids) >= 4096:
+                column_sum += self._sum_records(rids, query_columns, keys,
+                        aggregate_column_index)
+                rids = []
+                keys = []
+        if len(rids) != 0:
+            column_sum += self._sum_records(rids, query_columns, keys,
+                    aggregate_column_index)
         return column_sum
 
+    def _sum_records(self, rids, query_columns, keys, aggregate_column_index):
+        records = self.table.get_records_batch(rids, query_columns, keys,
+                read_snapshot())
+        return sum(record.columns[aggregate_column_index] for record in records
+                if record is not None)
+
     def increment(self, key, column):
-        r = self.select(key, self.table.key, [1] * self.table.num_columns)[0]
-        if r is not False:
+        records = self.select(key, self.table.key, [1] * self.table.num_columns)
+        if records:
+            r = records[0]
             updated_columns = [None] * self.table.num_columns
             updated_columns[column] = r[column] + 1
             u = self.update(key, *updated_columns)
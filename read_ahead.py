@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+import config
+import os
+import threading
+
+"""
+Read-ahead for the buffer pool. Pages are loaded into frames in the background
+by a small, bounded pool of I/O threads, either because a caller asked for them
+explicitly (prefetch, e.g. "the column pages of this page range") or because
+the pool noticed a table missing on consecutive page ids, in which case the
+next config.READ_AHEAD_WINDOW pages are requested.
+
+Hints are best effort: pages that are already resident or already queued are
+skipped, pages past the end of the page file are ignored, and hints are dropped
+once config.READ_AHEAD_MAX_PENDING pages are waiting to be read.
+"""
+class ReadAhead:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        """
+        Sequential access detection: for each table, the last page id that
+        missed, the length of the run of (roughly) consecutive misses ending
+        there, and the last page id that has been read ahead for the run.
+        """
+        self.last_miss = {}
+        self.worker = threading.local()
+        self.pages_requested = 0
+        self.pages_loaded = 0
+
+    """
+    Records a buffer pool miss and issues read-ahead once a table has missed on
+    config.READ_AHEAD_TRIGGER consecutive page ids. Returns True if the miss
+    was caused by read-ahead itself (such misses are not counted).
+    """
+    def record_miss(self, table_name, page_id):
+        if getattr(self.worker, 'active', False):
+            return True
+        last_page_id, run, window_end = self.last_miss.get(table_name, (None, 0, None))
+        if last_page_id is not None and last_page_id < page_id <= max(last_page_id, window_end) + 1:
+            run += 1
+        else:
+            run = 1
+            window_end = page_id
+        if run >= config.READ_AHEAD_TRIGGER and page_id + config.READ_AHEAD_WINDOW > window_end:
+            self.prefetch(table_name, range(max(page_id, window_end) + 1,
+                page_id + 1 + config.READ_AHEAD_WINDOW))
+            window_end = page_id + config.READ_AHEAD_WINDOW
+        self.last_miss[table_name] = (page_id, run, window_end)
+        return False
+
+    """
+    Asks for page_ids of table_name to be loaded into the pool in the
+    background. If the calling thread runs in a scan ring, the pages are loaded
+    into that ring.
+    """
+    def prefetch(self, table_name, page_ids):
+        requests = []
+        with self.pending_lock:
+            for page_id in page_ids:
+                key = (table_name, page_id)
+                if key in self.pending or self.pool.is_resident(table_name, page_id):
+                    continue
+                if len(self.pending) >= config.READ_AHEAD_MAX_PENDING:
+                    break
+                self.pending.add(key)
+                requests.append(page_id)
+        if not requests:
+            return
+        self.pages_requested += len(requests)
+        ring = self.pool.current_ring()
+        executor = self._get_executor()
+        for page_id in requests:
+            try:
+                if ring is None:
+                    executor.submit(self._load, table_name, page_id)
+                else:
+                    executor.submit(ring.run, self._load, table_name, page_id)
+            except RuntimeError:
+                # the executor has been shut down (the pool is closing)
+                with self.pending_lock:
+                    self.pending.discard((table_name, page_id))
+
+    def _get_executor(self):
+        if self.executor is None:
+            with self.executor_lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                            max_workers=config.READ_AHEAD_THREADS,
+                            thread_name_prefix='read-ahead')
+        return self.executor
+
+    def _load(self, table_name, page_id):
+        self.worker.active = True
+        try:
+            fd = self.pool.get_file(table_name)
+            if 4096*page_id < os.fstat(fd).st_size:
+                self.pool.get_page(table_name, page_id)
+                self.pages_loaded += 1
+        except Exception:
+            pass
+        finally:
+            with self.pending_lock:
+                self.pending.discard((table_name, page_id))
+
+    """
+    Waits for queued reads to finish and stops the I/O threads.
+    """
+    def stop(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
@@ -0,0 +1,201 @@
+from db import Database
+from query import Query
+from transaction import Transaction
+from wal import UPDATE
+
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import threading
+from random import randint, sample, seed
+
+"""
+Crash recovery tester. Every scenario runs a workload in a child process that
+dies with os._exit, without closing the database or finishing what it was
+doing, then reopens the database and checks every record against the values
+the workload expected, and every index against one rebuilt from the records.
+
+- workload: inserts, updates, deletes, merges, a checkpoint, a committed and
+  an unfinished transaction,
+- checkpoint: a crash in the middle of a checkpoint, after it freed the pages
+  merges retired and a merge reused them,
+- directory: a crash after an update was logged, and while it was not applied
+  yet, another page range started a new group of the page directory.
+"""
+
+# each scenario runs in a directory of its own, since tables keep their page
+# files in the working directory:
+root = os.path.abspath('./ECS165_recovery')
+path = 'ECS165'
+num_columns = 3
+
+
+def crash(db, records):
+    with open('expected', mode='wb') as f:
+        pickle.dump(records, f)
+    db.wal.flush()
+    os._exit(0)
+
+
+def update(query, records, key):
+    columns = [None]*num_columns
+    column = randint(1, num_columns - 1)
+    columns[column] = randint(0, 1000)
+    records[key][column] = columns[column]
+    query.update(key, *columns)
+
+
+def run_workload():
+    db = Database()
+    db.open(path)
+    table = db.create_table('Grades', num_columns, 0)
+    query = Query(table)
+    table.index.create_index(2)
+    records = {}
+    for key in range(2000):
+        records[key] = [key, randint(0, 1000), randint(0, 1000)]
+    query.insert_many([records[key][:] for key in range(1500)])
+    for key in range(1500, 2000):
+        query.insert(*records[key])
+    for i in range(6):
+        for key in range(2000):
+            update(query, records, key)
+        db.merge_scheduler.wait()
+        if i == 2:
+            db.checkpoint()
+    for key in sample(range(2000), 50):
+        query.delete(key)
+        del records[key]
+    keys = sorted(records)
+    transaction = Transaction()
+    for key in keys[:5]:
+        transaction.add_query(query.increment, key, 1)
+        records[key][1] += 1
+    transaction.run()
+    # never committed, so recovery rolls it back:
+    transaction = Transaction()
+    transaction.add_query(query.update, keys[5], None, -1, -1)
+    transaction.tables.append(table)
+    transaction.begin()
+    for key in keys[5:10]:
+        query.update(key, None, -1, -1)
+    query.delete(keys[10])
+    query.insert(5000, 0, 0)
+    crash(db, records)
+
+
+def run_checkpoint():
+    db = Database()
+    db.open(path)
+    db.merge_scheduler.stop()
+    table = db.create_table('Grades', num_columns, 0)
+    query = Query(table)
+    db.checkpoint()
+    records = {key: [key, key, -key] for key in range(1020)}
+    query.insert_many([records[key][:] for key in range(1020)])
+    for key in range(1020):
+        update(query, records, key)
+    table.merge_range(0)
+    update(query, records, 0)
+    def merge_and_crash(metadata):
+        # the checkpoint has freed pages (step 2) but is not saved (step 4)
+        table.merge_range(1)
+        crash(db, records)
+    table.save_metadata = merge_and_crash
+    db.checkpoint()
+
+
+def run_directory():
+    db = Database()
+    db.open(path)
+    db.merge_scheduler.stop()
+    table = db.create_table('Grades', num_columns, 0)
+    query = Query(table)
+    # three full groups of base rids:
+    records = {key: [key, key, 0] for key in range(765)}
+    query.insert_many([records[key][:] for key in range(765)])
+    db.checkpoint()
+    logged = threading.Event()
+    inserted = threading.Event()
+    log = table.log
+    def slow_log(record_type, values):
+        lsn = log(record_type, values)
+        if record_type == UPDATE and not inserted.is_set():
+            logged.set()
+            inserted.wait()
+        return lsn
+    table.log = slow_log
+    table.page_directory.log = slow_log
+    # the first tail record starts a group, and so do the inserted records:
+    records[0][1] = 1000
+    thread = threading.Thread(target=query.update, args=(0, None, 1000, None))
+    thread.start()
+    logged.wait()
+    for key in (765, 766):
+        records[key] = [key, key, 0]
+        query.insert(*records[key])
+    inserted.set()
+    thread.join()
+    for key in range(1, 5):
+        records[key][1] = 1000
+        query.update(key, None, 1000, None)
+    db.bp.flush()
+    crash(db, records)
+
+
+def check():
+    with open('expected', mode='rb') as f:
+        records = pickle.load(f)
+    db = Database()
+    db.open(path)
+    table = db.get_table('Grades')
+    query = Query(table)
+    errors = 0
+    rids = list(table.page_directory.base_rids())
+    if len(rids) != len(records):
+        print('directory error:', len(rids), 'base records, correct:', len(records))
+        errors += 1
+    for key in sorted(records):
+        result = query.select(key, 0, [1]*num_columns)
+        if len(result) != 1 or result[0].columns != records[key]:
+            print('recovery error on', key, ':', [r.columns for r in result],
+                    ', correct:', records[key])
+            errors += 1
+    for column_number in range(num_columns):
+        if table.index.indices[column_number] is None:
+            continue
+        index = table.index.get_index(column_number, True)
+        recovered = {key: sorted(rids) for key, rids in index.items()}
+        table.index.drop_index(column_number)
+        table.index.create_index(column_number)
+        index = table.index.get_index(column_number, True)
+        rebuilt = {key: sorted(rids) for key, rids in index.items()}
+        if recovered != rebuilt:
+            print('index error on column', column_number)
+            errors += 1
+    db.close()
+    return errors
+
+
+scenarios = {'workload': run_workload, 'checkpoint': run_checkpoint,
+        'directory': run_directory}
+
+if len(sys.argv) > 1:
+    seed(3562901)
+    scenarios[sys.argv[1]]()
+else:
+    failed = False
+    shutil.rmtree(root, ignore_errors=True)
+    for name in scenarios:
+        os.makedirs(os.path.join(root, name))
+        os.chdir(os.path.join(root, name))
+        subprocess.run([sys.executable, os.path.abspath(sys.argv[0]), name],
+                check=True)
+        errors = check()
+        print(name, 'recovered with', errors, 'errors')
+        failed = failed or errors != 0
+    os.chdir(os.path.dirname(root))
+    shutil.rmtree(root, ignore_errors=True)
+    print('Failed.' if failed else 'Pass.')
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+
+"""
+Page replacement policies for the buffer pool. Each BufferPoolShard owns one
+policy object, which it only calls while holding its latch. A policy tracks the
+frames that hold evictable pages and decides the order in which they are
+offered for eviction; pins and dirty pages are left to the shard, which walks
+candidates() until it finds a frame it can use.
+
+    admit(frame, key, cold)   a page has been read into frame (or handed over
+                              by a scan ring). Cold pages are placed where
+                              they will be evicted first.
+    access(frame)             the page in frame has been requested again.
+    remove(frame, evicted)    frame no longer belongs to the policy, either
+                              because its page was picked as a victim
+                              (evicted=True) or because it was dropped or
+                              taken over by a scan ring.
+    candidates()              yields frames in the order they should be
+                              evicted.
+
+The policy is picked with config.BUFFER_POOL_POLICY (see POLICIES).
+"""
+
+"""
+CLOCK: every frame has a reference bit that is set when its page is requested.
+The clock hand sweeps over the frames, clearing reference bits, and offers the
+frames whose bit is already clear. Gives up after two full sweeps.
+"""
+class ClockPolicy:
+
+    def __init__(self, size):
+        self.limit = size
+        self.reference_bits = bytearray(size)
+        self.present = bytearray(size)
+        self.clock_hand = 0
+
+    def admit(self, frame, key, cold=False):
+        self.present[frame] = 1
+        self.reference_bits[frame] = 0 if cold else 1
+
+    def access(self, frame):
+        self.reference_bits[frame] = 1
+
+    def remove(self, frame, evicted=False):
+        self.present[frame] = 0
+        self.reference_bits[frame] = 0
+
+    def candidates(self):
+        reference_bits = self.reference_bits
+        present = self.present
+        for i in range(2*self.limit):
+            frame = self.clock_hand
+            self.clock_hand = (frame + 1) % self.limit
+            if not present[frame]:
+                continue
+            if reference_bits[frame]:
+                reference_bits[frame] = 0
+                continue
+            yield frame
+
+
+"""
+LRU: frames are offered least recently used first.
+"""
+class LRUPolicy:
+
+    def __init__(self, size):
+        self.frames = OrderedDict()
+
+    def admit(self, frame, key, cold=False):
+        self.frames[frame] = key
+        if cold:
+            self.frames.move_to_end(frame, last=False)
+
+    def access(self, frame):
+        self.frames.move_to_end(frame)
+
+    def remove(self, frame, evicted=False):
+        del self.frames[frame]
+
+    def candidates(self):
+        return iter(self.frames)
+
+
+"""
+2Q (Johnson and Shasha). Pages seen once go into a FIFO queue (a1in); a page
+only enters the LRU main queue (am) if it is requested again after having been
+evicted from a1in, which is remembered by a bounded queue of page keys (a1out)
+with no frames attached. Pages that are read once, as in a scan, therefore
+never push the main queue out; a1in is evicted from first once it holds more
+than a quarter of the shard.
+"""
+class TwoQueuePolicy:
+
+    def __init__(self, size):
+        self.in_limit = max(1, size // 4)
+        self.out_limit = max(1, size // 2)
+        self.a1in = OrderedDict()
+        self.am = OrderedDict()
+        self.a1out = OrderedDict()
+        self.cold = set()
+
+    def admit(self, frame, key, cold=False):
+        if cold:
+            self.a1in[frame] = key
+            self.a1in.move_to_end(frame, last=False)
+            self.cold.add(frame)
+        elif key in self.a1out:
+            del self.a1out[key]
+            self.am[frame] = key
+        else:
+            self.a1in[frame] = key
+
+    def access(self, frame):
+        if frame in self.am:
+            self.am.move_to_end(frame)
+        else:
+            self.cold.discard(frame)
+
+    def remove(self, frame, evicted=False):
+        if frame in self.a1in:
+            key = self.a1in.pop(frame)
+            if evicted and frame not in self.cold:
+                self.a1out[key] = None
+                if len(self.a1out) > self.out_limit:
+                    self.a1out.popitem(last=False)
+        else:
+            del self.am[frame]
+        self.cold.discard(frame)
+
+    def candidates(self):
+        if len(self.a1in) > self.in_limit or not self.am:
+            yield from self.a1in
+            yield from self.am
+        else:
+            yield from self.am
+            yield from self.a1in
+
+
+"""
+ARC (Megiddo and Modha). t1 holds pages seen once recently and t2 pages seen
+at least twice, both in LRU order; b1 and b2 remember the keys of pages
+recently evicted from t1 and t2. A request for a page in b1 means t1 is too
+small, one in b2 that t2 is too small, and the target size p of t1 is adapted
+accordingly. Victims come from t1 while it is larger than p, else from t2.
+"""
+class ARCPolicy:
+
+    def __init__(self, size):
+        self.limit = size
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.cold = set()
+
+    def admit(self, frame, key, cold=False):
+        if cold:
+            self.t1[frame] = key
+            self.t1.move_to_end(frame, last=False)
+            self.cold.add(frame)
+            return
+        if key in self.b1:
+            self.p = min(self.limit, self.p + max(1, len(self.b2) / len(self.b1)))
+            del self.b1[key]
+            self.t2[frame] = key
+        elif key in self.b2:
+            self.p = max(0, self.p - max(1, len(self.b1) / len(self.b2)))
+            del self.b2[key]
+            self.t2[frame] = key
+        else:
+            self.t1[frame] = key
+        while self.b1 and len(self.t1) + len(self.b1) > self.limit:
+            self.b1.popitem(last=False)
+        while self.b2 and (len(self.t1) + len(self.t2) + len(self.b1) +
+                len(self.b2) > 2*self.limit):
+            self.b2.popitem(last=False)
+
+    def access(self, frame):
+        if frame in self.t1:
+            self.t2[frame] = self.t1.pop(frame)
+            self.cold.discard(frame)
+        else:
+            self.t2.move_to_end(frame)
+
+    def remove(self, frame, evicted=False):
+        if frame in self.t1:
+            key = self.t1.pop(frame)
+            if evicted and frame not in self.cold:
+                self.b1[key] = None
+        else:
+            key = self.t2.pop(frame)
+            if evicted:
+                self.b2[key] = None
+        self.cold.discard(frame)
+
+    def candidates(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            yield from self.t1
+            yield from self.t2
+        else:
+            yield from self.t2
+            yield from self.t1
+
+
+POLICIES = {'clock': ClockPolicy, 'lru': LRUPolicy, '2q': TwoQueuePolicy,
+        'arc': ARCPolicy}
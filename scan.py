@@ -0,0 +1,181 @@
+import compression
+import config
+
+"""
+Columnar scan engine. Rather than locating records through an index and
+materializing a Record for each of them, a scan walks the table's page ranges
+and pulls whole column pages out of the buffer pool as int64 arrays.
+
+Base pages already hold the current value of every record whose indirection
+pointer is 0, or whose most recent update has been merged (indirection >= TPS).
+Only the remaining records are overlaid with their latest tail record values,
+after which the aggregates are computed over the arrays with builtins
+(sum/min/max/len), which run in C rather than once per record in Python.
+"""
+class ColumnScanner:
+
+    def __init__(self, table):
+        self.table = table
+        self.bp = table.bp
+
+    """
+    For each page range, yields an array with the current values of
+    column_number for every live record whose key column value lies in
+    [begin, end]. If begin and end are None, every live record is included.
+    The scan runs in a scan ring, so it does not flush the buffer pool.
+    With summaries, page ranges whose column values can be aggregated straight
+    from their compressed page yield a (sum, count, min, max) tuple instead
+    (see _summarize_page_range). With a snapshot (see mvcc), the values are
+    those of the versions it sees.
+    """
+    def scan(self, column_number, begin=None, end=None, summaries=False, snapshot=None):
+        table = self.table
+        key_column = table.key
+        with self.bp.scan_ring():
+            for range_idx in range(len(table.page_ranges)):
+                # read the next page range in while this one is being scanned:
+                table.prefetch_page_ranges([range_idx + 1], [column_number, key_column])
+                latch = table.range_latches[range_idx]
+                latch.acquire()
+                epoch = table.epochs.enter()
+                try:
+                    values = None
+                    if summaries and table.versions.sees_all(range_idx, snapshot):
+                        values = self._summarize_page_range(range_idx,
+                                column_number, key_column, begin, end)
+                    if values is None:
+                        values = self._scan_page_range(range_idx, column_number,
+                                key_column, begin, end, snapshot)
+                finally:
+                    table.epochs.exit(epoch)
+                    latch.release()
+                if values is not None and len(values) != 0:
+                    yield values
+
+    """
+    A merged page range whose records are all live, have no unmerged updates
+    and lie in [begin, end] holds the current values of column_number in its
+    base page. If that page is compressed and not in the buffer pool, returns
+    the (sum, count, min, max) of the values computed from the compressed
+    image (see compression.summarize), without reading the page into the
+    pool. Returns None otherwise.
+    """
+    def _summarize_page_range(self, range_idx, column_number, key_column, begin, end):
+        table = self.table
+        num_columns = table.num_columns
+        page_range = table.page_ranges[range_idx]
+        if len(page_range) == num_columns + 4:
+            # never merged
+            return None
+        rid_page = self.bp.get_page(table.name, page_range[num_columns + 1])
+        if rid_page.read_column().count(0) != 0:
+            return None
+        if begin is not None or end is not None:
+            if column_number == key_column:
+                return None
+            keys = self.bp.get_page(table.name, page_range[key_column]).read_column()
+            if ((begin is not None and min(keys) < begin) or
+                    (end is not None and max(keys) > end)):
+                return None
+        image = self.bp.read_image(table.name, page_range[column_number])
+        if image is None or not compression.is_compressed(image):
+            return None
+        indirection_pointers = self.bp.get_page(table.name,
+                page_range[num_columns]).read_column()
+        # tail rids count down, so updates that were not merged are below tps:
+        tps = compression.image_tps(image)
+        if min(filter(None, indirection_pointers), default=tps) < tps:
+            return None
+        return compression.summarize(image)
+
+    def _scan_page_range(self, range_idx, column_number, key_column, begin, end,
+            snapshot=None):
+        table = self.table
+        num_columns = table.num_columns
+        page_range = table.page_ranges[range_idx]
+        rid_page = self.bp.get_page(table.name, page_range[num_columns + 1])
+        num_rows = rid_page.num_records - 2
+        if num_rows <= 0:
+            return None
+        rids = rid_page.read_column(2, 2 + num_rows)
+        if table.versions.sees_all(range_idx, snapshot):
+            snapshot = None
+        else:
+            # records the snapshot does not see are left out like deleted ones:
+            for i in range(num_rows):
+                if rids[i] != 0 and not table.versions.visible(rids[i], snapshot):
+                    rids[i] = 0
+        indir_page = self.bp.get_page(table.name, page_range[num_columns])
+        indirection_pointers = indir_page.read_column(2, 2 + num_rows)
+        value_page = self.bp.get_page(table.name, page_range[column_number])
+        values = value_page.read_column(2, 2 + num_rows)
+        tps = self.bp.get_page(table.name, page_range[0]).read(0)
+        filter_keys = begin is not None or end is not None
+        if filter_keys:
+            if column_number == key_column:
+                keys = values[:]
+            else:
+                key_page = self.bp.get_page(table.name, page_range[key_column])
+                keys = key_page.read_column(2, 2 + num_rows)
+
+        # overlay records whose latest updates have not been merged yet:
+        if indirection_pointers.count(0) != num_rows:
+            for i in range(num_rows):
+                pointer = indirection_pointers[i]
+                if pointer == 0 or (tps != 0 and pointer >= tps) or rids[i] == 0:
+                    continue
+                columns = table._get_most_recent_update(rids[i], pointer, None,
+                        tps, None, page_range, snapshot)
+                values[i] = columns[column_number]
+                if filter_keys:
+                    keys[i] = columns[key_column]
+
+        has_deletes = rids.count(0) != 0
+        if filter_keys:
+            lo = min(keys) if begin is None else begin
+            hi = max(keys) if end is None else end
+            if not has_deletes and lo <= min(keys) and max(keys) <= hi:
+                return values
+            return [values[i] for i in range(num_rows)
+                    if rids[i] != 0 and lo <= keys[i] <= hi]
+        if has_deletes:
+            return [values[i] for i in range(num_rows) if rids[i] != 0]
+        return values
+
+    """
+    Returns (sum, count, min, max) of column_number over the records with keys
+    in [begin, end], as snapshot sees them. min and max are None if no
+    records match.
+    """
+    def aggregate(self, column_number, begin=None, end=None, snapshot=None):
+        total = 0
+        count = 0
+        minimum = None
+        maximum = None
+        for values in self.scan(column_number, begin, end,
+                summaries=config.COMPRESS_MERGED_PAGES, snapshot=snapshot):
+            if isinstance(values, tuple):
+                range_total, range_count, low, high = values
+                total += range_total
+                count += range_count
+            else:
+                total += sum(values)
+                count += len(values)
+                low = min(values)
+                high = max(values)
+            if minimum is None or low < minimum:
+                minimum = low
+            if maximum is None or high > maximum:
+                maximum = high
+        return total, count, minimum, maximum
+
+    """
+    Decides whether a scan of the key range [begin, end] is cheaper than
+    looking up each record through the primary key index.
+    """
+    def should_scan(self, begin, end):
+        table = self.table
+        if table.num_records == 0:
+            return False
+        estimate = table.index.estimate_range(begin, end, table.key)
+        return estimate >= table.num_records * config.SCAN_SELECTIVITY
@@ -0,0 +1,115 @@
+import threading
+
+"""
+A scan ring bounds the buffer pool frames used by a bulk operation (a full
+scan, a merge or an index build), which reads every page once and would
+otherwise evict the pages that point lookups keep coming back to.
+
+While a thread runs inside a ring, every page it reads into a shard gets a
+frame that belongs to the ring (and not to the shard's replacement policy)
+until the ring owns its share of config.SCAN_RING_SIZE frames in that shard
+(but never more than a quarter of the shard); after that, the ring reuses its
+own frames in turn. Frames whose page is still
+pinned are skipped, and a frame whose page is requested by another thread
+leaves the ring (see BufferPoolShard._ring_hit). When the ring is closed, its
+remaining frames are handed to the policies as the first eviction candidates.
+
+Read-ahead issued from inside a ring is loaded into the same ring.
+"""
+class ScanRing:
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.shard_limit = max(1, size // len(pool.shards)) if size > 0 else 0
+        """
+        The frames the ring owns in each shard, and the position in that list
+        of the next frame to reuse. Only modified while holding the latch of
+        the shard in question.
+        """
+        self.frames = {}
+        self.positions = {}
+        self.closed = False
+        self.thread_id = None
+        self.outer = None
+
+    def __enter__(self):
+        ring = self.pool.current_ring()
+        if ring is not None:
+            # already running in a ring, keep using that one
+            self.outer = ring
+            return ring
+        if self.shard_limit > 0:
+            self.thread_id = threading.get_ident()
+            self.pool.rings[self.thread_id] = self
+        return self
+
+    def __exit__(self, *args):
+        if self.thread_id is not None:
+            del self.pool.rings[self.thread_id]
+            self.thread_id = None
+            self.close()
+
+    """
+    Runs fn in the ring from another thread (used by read-ahead). Does nothing
+    once the ring has been closed: the bulk operation is over, so pages it
+    asked for would only displace other pages.
+    """
+    def run(self, fn, *args):
+        thread_id = threading.get_ident()
+        if self.closed:
+            return None
+        if thread_id in self.pool.rings:
+            return fn(*args)
+        self.pool.rings[thread_id] = self
+        try:
+            return fn(*args)
+        finally:
+            del self.pool.rings[thread_id]
+
+    """
+    A ring never takes more than a quarter of a shard, so the shard's own
+    policy always has frames left to work with.
+    """
+    def _limit(self, shard):
+        return min(self.shard_limit, shard.limit // 4)
+
+    """
+    Adds a newly assigned frame of shard to the ring if the ring has room for
+    it there. Called while holding the shard's latch.
+    """
+    def add(self, shard, frame):
+        frames = self.frames.setdefault(shard, [])
+        if len(frames) >= self._limit(shard):
+            return False
+        frames.append(frame)
+        return True
+
+    """
+    Returns the next ring frame of shard that can be reused, or None if the
+    ring still has room to grow in the shard or all of its frames are pinned.
+    Called while holding the shard's latch.
+    """
+    def reusable_frame(self, shard):
+        frames = self.frames.get(shard)
+        if not frames:
+            return None
+        # forget frames that have left the ring:
+        owned = [frame for frame in frames if shard.ring_frames.get(frame) is self]
+        if len(owned) != len(frames):
+            self.frames[shard] = frames = owned
+            self.positions[shard] = 0
+        if len(frames) < self._limit(shard):
+            return None
+        position = self.positions.get(shard, 0)
+        for i in range(len(frames)):
+            frame = frames[(position + i) % len(frames)]
+            page = shard.frames[frame]
+            if page is not None and page.pinned == 0:
+                self.positions[shard] = (position + i + 1) % len(frames)
+                return frame
+        return None
+
+    def close(self):
+        self.closed = True
+        for shard in self.pool.shards:
+            shard.release_ring(self)
@@ -0,0 +1,125 @@
+from bisect import bisect_left, bisect_right
+
+"""
+An ordered index over a single column. It behaves like the dict based hash
+indices (key -> list of rids), but also keeps its keys in a sorted list so that
+range lookups only need to bisect the key list and walk the keys that actually
+fall into the range.
+
+Newly added keys are buffered in pending_keys and merged into sorted_keys the
+next time the key order is needed, so a burst of inserts costs one sort rather
+than one list insertion per key. Deleted keys are left in sorted_keys (and
+remembered in stale_keys) until enough of them pile up to be worth compacting.
+"""
+class SortedIndex:
+
+    def __init__(self):
+        self.buckets = {}
+        self.sorted_keys = []
+        self.pending_keys = []
+        self.stale_keys = set()
+
+    def __getitem__(self, key):
+        return self.buckets[key]
+
+    def __setitem__(self, key, rids):
+        if key not in self.buckets:
+            if key in self.stale_keys:
+                self.stale_keys.discard(key)
+            else:
+                self.pending_keys.append(key)
+        self.buckets[key] = rids
+
+    def __delitem__(self, key):
+        del self.buckets[key]
+        self.stale_keys.add(key)
+
+    def __contains__(self, key):
+        return key in self.buckets
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key, default=None):
+        return self.buckets.get(key, default)
+
+    def keys(self):
+        return self.buckets.keys()
+
+    def items(self):
+        return self.buckets.items()
+
+    """
+    Replaces the contents of the index with buckets, whose keys must already
+    be in ascending order (see IndexSnapshot.load).
+    """
+    def load_sorted(self, buckets):
+        self.buckets = buckets
+        self.sorted_keys = list(buckets)
+        self.pending_keys = []
+        self.stale_keys = set()
+
+    """
+    Merges pending keys into sorted_keys and drops stale keys once they make up
+    a quarter of the sorted list.
+    """
+    def _flush(self):
+        pending = self.pending_keys
+        if pending:
+            self.pending_keys = []
+            if len(pending) < 64:
+                for key in pending:
+                    i = bisect_left(self.sorted_keys, key)
+                    if i == len(self.sorted_keys) or self.sorted_keys[i] != key:
+                        self.sorted_keys.insert(i, key)
+            else:
+                # both runs are sorted, so this is a linear time merge:
+                pending.sort()
+                self.sorted_keys.extend(pending)
+                self.sorted_keys.sort()
+                self._compact()
+                return
+        if len(self.stale_keys) * 4 > len(self.sorted_keys):
+            self._compact()
+
+    def _compact(self):
+        buckets = self.buckets
+        compacted = []
+        previous = None
+        for key in self.sorted_keys:
+            if key in buckets and (not compacted or key != previous):
+                compacted.append(key)
+                previous = key
+        self.sorted_keys = compacted
+        self.stale_keys = set()
+
+    """
+    Returns the keys in [begin, end], in ascending order.
+    """
+    def key_range(self, begin, end):
+        self._flush()
+        lo = bisect_left(self.sorted_keys, begin)
+        hi = bisect_right(self.sorted_keys, end)
+        keys = self.sorted_keys[lo:hi]
+        if self.stale_keys:
+            keys = [key for key in keys if key in self.buckets]
+        return keys
+
+    """
+    Returns an upper bound on the number of keys in [begin, end] without
+    copying them out of the sorted key list.
+    """
+    def estimate_range(self, begin, end):
+        self._flush()
+        return (bisect_right(self.sorted_keys, end) -
+                bisect_left(self.sorted_keys, begin))
+
+    """
+    Returns the rids of every key in [begin, end], in key order.
+    """
+    def rid_range(self, begin, end):
+        buckets = self.buckets
+        rids = []
+        for key in self.key_range(begin, end):
+            rids.extend(buckets[key])
+        return rids
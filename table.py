@@ -1,7 +1,16 @@
 from page import Page
-from time import time
 from index import Index
 from logger import Logger
+from checkpoint import save_pickle
+from page_directory import PageDirectory, TAIL_RID_BASE
+from free_pages import FreePageMap, page_extents, subtract_extent
+from epoch import EpochManager
+from mvcc import VersionTable, next_timestamp
+from lock_manager import LockManager
+from wal import INSERT, UPDATE, DELETE, UNDO_INSERT, UNDO_DELETE, UNDO_UPDATE, MERGE, DIRECTORY
+from itertools import compress, repeat
+from operator import and_
+import config
 import pickle
 import pathlib
 import threading
@@ -25,7 +34,8 @@ class Record:
 
 class Table:
 
-    def __init__(self, name, num_columns, key, rid_space, buffer_pool):
+    def __init__(self, name, num_columns, key, rid_space, buffer_pool, wal=None,
+            merge_scheduler=None, lock_manager=None):
         self.name = name
         
         """
@@ -54,10 +64,25 @@ class Table:
         """
         self.rid_block_offset = 0
 
+        """
+        Tail rids are handed out the same way, from blocks of 512 rids that
+        count down (see RIDspace.assign_tail_space), so the tail rids of a
+        table are dense as well.
+        """
+        self.tail_rid_block = rid_space.assign_tail_space()
+        self.tail_rid_block_offset = 0
+
         """
         num_columns simply represents the number of columns in the table.
         """
         self.num_columns = num_columns
+
+        """
+        Schema encodings are integer bitmasks. column_masks[i] is the bit that
+        represents column i (column 0 is the most significant of the
+        num_columns bits, matching the on-disk encoding).
+        """
+        self.column_masks = [1 << (num_columns - 1 - i) for i in range(num_columns)]
         
         """
         Keep track of the number of records assoicated with this table. for
@@ -66,8 +91,7 @@ class Table:
         self.num_records = 0
         
         """
-        Keep track of number updates made to records in table. Merge is
-        initiated upon every 512 updates.
+        Keep track of number updates made to records in table.
         """
         self.num_updates = 0
         
@@ -82,17 +106,20 @@ class Table:
         self.record_offset = 0
 
         """
-        The directory_lock is used to regulate concurrent access to the page
-        directory. Currently, there are only two threads that will have to
-        compete for the lock/acquire and release the lock: The background merge
-        thread and the main forefround thread.
+        Latches. Every page range has a latch of its own, range_latches[i] for
+        page_ranges[i], held while the records of the range are read or
+        changed, so operations on different page ranges run concurrently. The
+        background merge thread only holds it to take a snapshot of a page
+        range and to swap in the merged base pages (see merge_range).
+        append_lock is a short latch for the state that every page range
+        shares: the append cursor (the last page range, which new records go
+        to, and the record counts), the rid blocks and the page allocator
+        (page_ids, free_pages and retired). The page directory has a latch of
+        its own (see PageDirectory). Latches are taken in that order: range
+        latches (by increasing range), append_lock, the directory's latch.
         """
-        self.directory_lock = threading.Lock()
-
-        """
-        Simple flag that indicates if a merge is currently occuring.
-        """
-        self.merging = False
+        self.range_latches = []
+        self.append_lock = threading.Lock()
 
         """
         page_ranges contains a list of page ranges. A page range is purely
@@ -144,16 +171,27 @@ class Table:
         like: 1 -> (0,7,0,0) since base pages would have ids 0-3, metadata
         pages would have ids 4-7 and these pages would be located in page range
         0.
+        The directory is stored in pages of its own, which are managed by the
+        buffer pool (see PageDirectory).
+        For base records, first_page_id is the first of the base pages the
+        record was inserted into. A merge replaces the base column pages of a
+        page range with merged copies (see merge_range), so the current base
+        pages of a record are always looked up in page_ranges[range_idx].
         """
-        self.page_directory = {}
-
-        self.base_rids = set()
+        self.page_directory = PageDirectory(name, buffer_pool, self.log)
         
         """
-        Keeps track of the page ranges that are ready for merging. Only page
-        ranges with full base pages are merged.
+        Merge state of the page ranges: range_versions maps a page range to
+        the number of times it has been merged, and range_updates and
+        range_segments count the updates and the sets of tail pages each
+        range received since its last merge (see request_merge).
+        merge_scheduler runs the merges (see MergeScheduler), or is None if
+        the table is never merged.
         """
-        self.merge_queue = []
+        self.range_versions = {}
+        self.range_updates = {}
+        self.range_segments = {}
+        self.merge_scheduler = merge_scheduler
 
         """
         Each page that is created is granted a table-unique numerical ID. Page
@@ -161,9 +199,16 @@ class Table:
         Page ID's are assigned by simply giving the page the current value of page_ids.
         page_ids is then incremented to ensure that the next page is given
         a unique (sequentially assigned) ID.  
+        Pages that are no longer used are given back to free_pages and handed
+        out again before new ids are (see allocate_pages). Until they can be,
+        they are kept in retired as [first_page_id, count, epoch, lsn] entries
+        (see reclaim_pages); epochs tracks the readers that may still use them.
         """
 
         self.page_ids = 0
+        self.free_pages = FreePageMap()
+        self.retired = []
+        self.epochs = EpochManager()
 
         """
         bp is a reference to the global buffer pool. The buffer pool manages
@@ -174,6 +219,14 @@ class Table:
        
         self.bp = buffer_pool
 
+        """
+        wal is the database's write-ahead log (see WriteAheadLog), or None if
+        the database has not been opened on disk. Every change is logged
+        before it is made, while holding the latch of its page range (or the
+        append_lock), and each page it touches gets the LSN of the record.
+        """
+        self.wal = wal
+
         """
         index is a reference to an Index object that maintains all indices that
         have created over the table.
@@ -183,6 +236,21 @@ class Table:
 
         self.session_log = Logger()
 
+        """
+        versions decides which versions of the table's records each snapshot
+        sees (see mvcc). Versions are stamped with the time they were written,
+        taken while holding the latch of their page range, so a reader that
+        holds the latch sees every version stamped before its snapshot.
+        """
+        self.versions = VersionTable()
+
+        """
+        lock_manager keeps the record locks of transactions (see LockManager),
+        shared by every table of the database so a transaction that changes
+        several tables is ordered the same way in all of them.
+        """
+        self.lock_manager = lock_manager if lock_manager is not None else LockManager()
+
         pass
 
 
@@ -194,52 +262,200 @@ class Table:
     |___________metadata
     |
     |___________page_file
+    |
+    |___________directory
+    |           |___________page_file
+    |
+    |___________index_<n>
 
     the metadata file contains the pickled data structures used by the table.
     the page_file (will) contain the bytes for all files that have been
-    allocated for the table.
+    allocated for the table, and directory/page_file the pages of the page
+    directory. Each index_<n> file holds the snapshot of the index on column n
+    (see IndexSnapshot).
     """
     
     def init_table_dir(self):
         page_path = self.name+'/page_file'
         metadata_path = self.name+'/metadata'
-        pathlib.Path(self.name+'/').mkdir(parents=True, exist_ok=True)
+        pathlib.Path(self.name+'/directory/').mkdir(parents=True, exist_ok=True)
         open(page_path, mode='wb').close()
+        open(self.page_directory.name+'/page_file', mode='wb').close()
         open(metadata_path, mode = 'wb').close()
     
     def close_table(self):
-        metadata = [self.rid_block, self.rid_block_offset, self.num_updates,
-                self.record_offset, self.page_ranges, self.page_directory,
-                self.merge_queue, self.num_records, self.base_rids]
-        f = open(self.name+'/metadata', mode='wb')
-        pickle.dump(metadata, f)
-        f.close()
+        self.save_metadata(self.snapshot_metadata())
+
+    """
+    Returns a copy of the table's metadata, as saved in the metadata file.
+    Taken while holding every latch of the table, so it reflects every logged
+    change up to some point in the write-ahead log (see Checkpointer).
+    """
+    def snapshot_metadata(self):
+        latches = self.latch_all()
+        try:
+            return [self.rid_block, self.rid_block_offset, self.num_updates,
+                    self.record_offset,
+                    [page_range[:] for page_range in self.page_ranges],
+                    self.page_directory.snapshot(),
+                    dict(self.range_versions),
+                    self.num_records, self.tail_rid_block,
+                    self.tail_rid_block_offset, self.page_ids,
+                    self.free_pages.snapshot(),
+                    [entry[:] for entry in self.retired]]
+        finally:
+            self.unlatch_all(latches)
+
+    def save_metadata(self, metadata):
+        save_pickle(self.name+'/metadata', metadata)
 
     def open_table(self):
+        if os.path.exists(self.name+'/metadata.compact'):
+            self._finish_compaction()
+        for path in [self.name+'/page_file', self.page_directory.name+'/page_file']:
+            # left by a compaction that was cut short before it was final
+            if os.path.exists(path+'.compact'):
+                os.unlink(path+'.compact')
         try:
             f = open(self.name+'/metadata', mode='rb')
             metadata = pickle.load(f)
-            self.rid_block = metadata[0]
-            self.rid_block_offset = metadata[1]
-            self.num_updates = metadata[2]
-            self.record_offset = metadata[3]
-            self.page_ranges = metadata[4]
-            self.page_directory = metadata[5]
-            self.merge_queue = metadata[6]
-            self.num_records = metadata[7]
-            self.base_rids = metadata[8]
-            self.index = Index(self)
+            self.load_metadata(metadata)
             f.close()
         except FileNotFoundError:
             self.init_table_dir()
+        except EOFError:
+            # created, but never checkpointed: everything is in the log
+            pass
+
+    def load_metadata(self, metadata):
+        self.rid_block = metadata[0]
+        self.rid_block_offset = metadata[1]
+        self.num_updates = metadata[2]
+        self.record_offset = metadata[3]
+        self.page_ranges = metadata[4]
+        self.range_latches = [threading.Lock() for page_range in self.page_ranges]
+        self.page_directory.load(metadata[5])
+        self.range_versions = metadata[6]
+        self.num_records = metadata[7]
+        self.tail_rid_block = metadata[8]
+        self.tail_rid_block_offset = metadata[9]
+        self.page_ids = metadata[10]
+        self.free_pages.load(metadata[11])
+        self.retired = [list(entry) for entry in metadata[12]]
+
+    """
+    Rebuilds the indices that have no valid snapshot from the table's records
+    (after open_table and recovery, see Index.open_snapshots).
+    """
+    def load_index(self):
+        self.index.rebuild_indices()
 
     def delete_files(self):
+        self.bp.drop_table(self.name)
+        self.bp.drop_table(self.page_directory.name)
+        os.unlink(self.page_directory.name+'/page_file')
+        os.rmdir(self.page_directory.name)
+        for file_name in os.listdir(self.name):
+            if file_name.startswith('index_'):
+                os.unlink(self.name+'/'+file_name)
         os.unlink(self.name+'/page_file')
         os.unlink(self.name+'/metadata')
         os.rmdir(self.name)
+
+    """
+    Rewrites the page file of the table so that it only holds the pages that
+    are in use, page range by page range (base pages, metadata pages and then
+    each set of tail pages, so every run of pages that has to be consecutive
+    stays so), and the page directory to match. Retired and free pages are
+    dropped, as are the directory entries of tail records whose tail pages
+    are gone. Returns the size of the page file, in pages, before and after.
+
+    The table must not be in use, and every change must be checkpointed (see
+    Database.compact): the log never has to be replayed against the old page
+    ids. The new files are written next to the old ones and saving the new
+    metadata to metadata.compact makes the compaction final; the files are
+    then renamed into place, which open_table finishes if it was cut short.
+    """
+    def compact(self):
+        n = self.num_columns
+        latches = self.latch_all()
+        try:
+            order = []
+            page_ranges = []
+            segments = {}
+            for page_range in self.page_ranges:
+                first_page_id = len(order)
+                for i in range(n + 4, len(page_range), n + 5):
+                    segments[page_range[i]] = first_page_id + i
+                page_ranges.append(list(range(first_page_id, first_page_id + len(page_range))))
+                order.extend(page_range)
+
+            def remap(rid, entry):
+                if rid < TAIL_RID_BASE // 2:
+                    page_range = page_ranges[entry[3]]
+                    return (page_range[0], page_range[n + 3], entry[2], entry[3])
+                first_page_id = segments.get(entry[0])
+                if first_page_id is None:
+                    return None
+                return (first_page_id, first_page_id + n + 4, entry[2], entry[3])
+
+            with self.bp.scan_ring():
+                with open(self.name+'/page_file.compact', mode='wb') as f:
+                    for page_id in order:
+                        f.write(self.bp.get_page(self.name, page_id).data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            directory_pages = self.page_directory.compact(remap,
+                    self.page_directory.name+'/page_file.compact')
+            metadata = [self.rid_block, self.rid_block_offset, self.num_updates,
+                    self.record_offset, page_ranges, directory_pages,
+                    dict(self.range_versions), self.num_records,
+                    self.tail_rid_block, self.tail_rid_block_offset, len(order),
+                    [], []]
+            save_pickle(self.name+'/metadata.compact', metadata)
+            size = self.page_ids
+            self._finish_compaction()
+            self.load_metadata(metadata)
+        finally:
+            self.unlatch_all(latches)
+        return size, len(order)
+
+    """
+    Moves the files written by compact into place. Every page of the table
+    held by the buffer pool is dropped, since page ids have changed.
+    """
+    def _finish_compaction(self):
+        self.bp.drop_table(self.name)
+        self.bp.drop_table(self.page_directory.name)
+        for path in [self.name+'/page_file', self.page_directory.name+'/page_file']:
+            if os.path.exists(path+'.compact'):
+                os.replace(path+'.compact', path)
+        os.replace(self.name+'/metadata.compact', self.name+'/metadata')
         
 # ==================== HELPER FUNCTIONS ====================
 
+    """
+    Takes every latch of the table, for the operations that need all of it to
+    hold still (see snapshot_metadata and compact). Page ranges may be added
+    while the range latches are being taken, in which case the latches of
+    the new ones are taken too. Returns the range latches taken.
+    """
+    def latch_all(self):
+        latches = []
+        while True:
+            for latch in self.range_latches[len(latches):]:
+                latch.acquire()
+                latches.append(latch)
+            self.append_lock.acquire()
+            if len(self.range_latches) == len(latches):
+                return latches
+            self.append_lock.release()
+
+    def unlatch_all(self, latches):
+        self.append_lock.release()
+        for latch in latches:
+            latch.release()
+
     """
     Return a new unique rid for record.
     Will retrieve a new rid space from the rid space allocator. This will be
@@ -254,19 +470,43 @@ class Table:
         return rid
 
     """
-    Take the set of base pages, which are clearly located in the most recently
-    created page range, and determine if they can hold any more records:
+    Return a new unique tail rid, from the table's current block of tail
+    rids.
     """
-    def current_base_page_is_full(self):
-        if len(self.page_ranges) is 0:
-            return False
-        else:
-            page_id = self.page_ranges[-1][0] 
-            page = self.bp.get_page(self.name, page_id)
-            if page.has_capacity() is True:
-                return False
-            else:
-                return True
+    def get_tail_rid(self):
+        if self.tail_rid_block_offset == 512:
+            self.tail_rid_block = self.global_rid_space.assign_tail_space()
+            self.tail_rid_block_offset = 0
+        rid = self.tail_rid_block[0] - self.tail_rid_block_offset
+        self.tail_rid_block_offset += 1
+        return rid
+
+    """
+    Return a list of count new unique rids. Rids are handed out as contiguous
+    runs of the current rid block, and new blocks are requested from the rid
+    space allocator as needed.
+    """
+    def get_rids(self, count):
+        rids = []
+        while len(rids) < count:
+            if self.rid_block_offset == 512:
+                self.rid_block = self.global_rid_space.assign_space()
+                self.rid_block_offset = 0
+            num_rids = min(count - len(rids), 512 - self.rid_block_offset)
+            first_rid = self.rid_block[0] + self.rid_block_offset
+            rids.extend(range(first_rid, first_rid + num_rids))
+            self.rid_block_offset += num_rids
+        return rids
+
+    """
+    Appends a record about this table to the write-ahead log. Returns the LSN
+    to stamp the changed pages with (0 without a log).
+    """
+    def log(self, record_type, values):
+        if self.wal is None:
+            return 0
+        return self.wal.log(record_type, self.name, values)
+
     """
     Determines if the base pages for a given page range are full
     """
@@ -285,61 +525,95 @@ class Table:
         return not page.has_capacity()
 
     """
-    Allocates base pages that will contain metadata
+    Returns the id of the first of count consecutive pages that are not in
+    use, taken from the free pages if possible and from the end of the page
+    file otherwise. Reused pages are cleared.
+    """
+    def allocate_pages(self, count):
+        first_page_id = self.free_pages.allocate(count)
+        if first_page_id is None:
+            first_page_id = self.page_ids
+            self.page_ids += count
+            return first_page_id
+        for page_id in range(first_page_id, first_page_id + count):
+            self.bp.get_page(self.name, page_id).clear()
+        return first_page_id
+
+    """
+    Allocates the base pages of a new page range, followed by the base pages
+    that will contain metadata. Returns the new page range.
+    """
+    def allocate_base_pages(self):
+        first_page_id = self.allocate_pages(self.num_columns + 4)
+        return list(range(first_page_id, first_page_id + self.num_columns + 4))
+
+    """
+    Returns the index of the page range that new records go to, the last one,
+    with its latch held. If its base pages are full (or there are no page
+    ranges yet), a new page range is added first. The new page range is only
+    logged along with the first record inserted into it (see redo).
     """
-    def allocate_metadata_pages(self, page_range):
-        for i in range(4):
-            metadata_column = self.page_ids
-            self.page_ids += 1
-            page_range.append(metadata_column)
+    def _latch_insert_range(self):
+        while True:
+            range_idx = len(self.page_ranges) - 1
+            if range_idx >= 0:
+                latch = self.range_latches[range_idx]
+                latch.acquire()
+                if not self.base_page_is_full(self.page_ranges[range_idx]):
+                    return range_idx
+                latch.release()
+            with self.append_lock:
+                # unless another thread has added one meanwhile:
+                if len(self.page_ranges) - 1 == range_idx:
+                    self.range_latches.append(threading.Lock())
+                    self.page_ranges.append(self.allocate_base_pages())
 
     """
     Creates metadata pages given metadata list (indirection pointer, rid, time
     stamp, schema encoding)
     """
-    def write_metadata(self, metadata, page_range):
+    def write_metadata(self, metadata, page_range, lsn=0):
         base_splice = page_range[:self.num_columns+4]
         for i in range(len(metadata)):
             page_id = base_splice[self.num_columns+i] 
             page = self.bp.get_page(self.name, page_id)
+            page.lsn = lsn
             if i == 3:
-                page.write_schema(metadata[i])
+                page.write_schema_mask(metadata[i])
             else:
                 page.write(metadata[i])
 
     """
-    Update page directory and related book-keeping fields.
+    Update page directory for a new base record at offset of page_range.
     """
-    def update_directory(self, rid, page_range, page_ranges_idx):
-        self.page_directory[rid] = (page_range[0],
+    def update_directory(self, rid, page_range, page_ranges_idx, offset, lsn=0):
+        self.page_directory.set(rid, (page_range[0],
                 page_range[self.num_columns+3],
-                self.record_offset, page_ranges_idx)
-        self.record_offset += 1
-        self.num_records += 1
+                offset, page_ranges_idx), lsn)
             
 
     """
-    For given update range, loads a snapshot of this update range into the
-    merge queue. If changes have been made to this update range since it was
-    first placed into the merge queue, then the old range will be swapped out
-    with the new one. Must only be called while merge is not ongoing, so as to
-    avoid conflicts.
+    Hints the buffer pool to read, in the background, the pages of the given
+    page ranges that a scan over column_numbers will touch: the base pages of
+    those columns plus the first base page (which holds the TPS) and the
+    metadata pages.
     """
-    def load_merge_queue(self, page_range, old_range):
-        if old_range in self.merge_queue:
-            i = self.merge_queue.index(old_range)
-            self.merge_queue[i] = page_range[:]
-        else:
-            self.merge_queue.append(page_range[:])
- 
+    def prefetch_page_ranges(self, range_indices, column_numbers):
+        page_ids = set()
+        for range_idx in range_indices:
+            if range_idx < len(self.page_ranges):
+                page_range = self.page_ranges[range_idx]
+                page_ids.add(page_range[0])
+                page_ids.update(page_range[column] for column in column_numbers)
+                page_ids.update(page_range[self.num_columns:self.num_columns + 4])
+        self.bp.prefetch(self.name, sorted(page_ids))
+
     """
     Allocates a set of tail pages that are used to contain tail records.
     """
     def allocate_tail_pages(self, page_range):
-        for i in range(self.num_columns + 5):
-            page_id = self.page_ids
-            self.page_ids += 1
-            page_range.append(page_id)
+        first_page_id = self.allocate_pages(self.num_columns + 5)
+        page_range.extend(range(first_page_id, first_page_id + self.num_columns + 5))
 
     """
     Determines if a new set of tail pages need to be allocated.
@@ -374,42 +648,56 @@ class Table:
 # ==================== RECORD RETRIEVAL ====================
 
     """
-
+    Returns every column of base record rid as of its most recent update
+    that snapshot sees (by default, its most recent update; see mvcc). It
+    starts from the record's values in the base pages of page_range (by
+    default, the current version of the record's page range) and follows the
+    tail chain from indirection_pointer, but only down to the tail records
+    that were merged into those base pages (tps, read from the same version
+    of the page range). The newest tail records may not be visible to
+    snapshot, and are skipped. Long chains get the page range queued for a
+    merge.
     """
-
     def _get_most_recent_update(self, rid, indirection_pointer, query_columns,
-            tps, key):
+            tps, key, page_range=None, snapshot=None):
         rid_tuple = self.page_directory[rid]
+        if page_range is None:
+            page_range = self.page_ranges[rid_tuple[3]]
         schema_encoding_id = rid_tuple[1] 
         schema_encoding_col = self.bp.get_page(self.name, schema_encoding_id)
-        base_schema = schema_encoding_col.read_schema(self.num_columns,
-                rid_tuple[2])
-        tail_encodings = '0'*self.num_columns
+        base_schema = schema_encoding_col.read_schema_mask(rid_tuple[2])
+        tail_encodings = 0
         columns = [0]*self.num_columns
-        for idx in range(len(base_schema)):
-            page_id = rid_tuple[0] + idx 
-            page = self.bp.get_page(self.name, page_id)
+        for idx in range(self.num_columns):
+            page = self.bp.get_page(self.name, page_range[idx])
             columns[idx] = page.read(rid_tuple[2])
-        while indirection_pointer != 0:
+        chain_length = 0
+        while indirection_pointer != 0 and (tps == 0 or indirection_pointer < tps):
+            chain_length += 1
             tail_tuple = self.page_directory[indirection_pointer]
+            if snapshot is not None and not self.versions.visible(indirection_pointer, snapshot):
+                # newer than the snapshot: go on to the version before it
+                indir_col = self.bp.get_page(self.name, tail_tuple[0] + self.num_columns)
+                indirection_pointer = indir_col.read(tail_tuple[2])
+                continue
             tail_schema_id = tail_tuple[1] - 1 
             tail_schema_col = self.bp.get_page(self.name, tail_schema_id)
-            tail_schema = tail_schema_col.read_schema(self.num_columns,
-                    tail_tuple[2])
-            for idx in range(len(tail_schema)):
-                if tail_schema[idx] == '1' and tail_encodings[idx] == '0': 
-                    page = self.bp.get_page(self.name, tail_tuple[0] + idx)
-                    columns[idx] = page.read(tail_tuple[2])
-                    tail_encodings = list(tail_encodings)
-                    tail_encodings[idx] = '1'
-                    tail_encodings = ''.join(tail_encodings)
-            if int(tail_encodings,2) & int(base_schema,2) == int(base_schema,2):
+            tail_schema = tail_schema_col.read_schema_mask(tail_tuple[2])
+            # columns updated by this tail record and not by a newer one:
+            new_columns = tail_schema & ~tail_encodings
+            if new_columns:
+                for idx in range(self.num_columns):
+                    if new_columns & self.column_masks[idx]:
+                        page = self.bp.get_page(self.name, tail_tuple[0] + idx)
+                        columns[idx] = page.read(tail_tuple[2])
+                tail_encodings |= new_columns
+            if tail_encodings & base_schema == base_schema:
                 break
             indir_id = tail_tuple[0] + self.num_columns 
             indir_col = self.bp.get_page(self.name, indir_id)
             indirection_pointer = indir_col.read(tail_tuple[2])
-            #if indirection_pointer == tps and tps !=0:
-             #   break
+        if config.MERGE_CHAIN_LENGTH and chain_length >= config.MERGE_CHAIN_LENGTH:
+            self.request_merge(rid_tuple[3])
         return columns
 
     """
@@ -421,47 +709,143 @@ class Table:
     rid -> (page_directory) -> page_id and offset -> buffer pool request -> page
     
     Will return a list of record objects containing key and requested column
-    data.
+    data. With a snapshot (see mvcc), the records hold the versions it sees,
+    and records it does not see at all are left out.
     """
 
-    def get_records(self, rids, query_columns, key):
+    def get_records(self, rids, query_columns, key, snapshot=None):
         records = []
-        self.directory_lock.acquire()
-        for rid in rids:
-            rid_tuple = self.page_directory[rid]
-            first_page_id = rid_tuple[0]
-            
-            first_page = self.bp.get_page(self.name, first_page_id)
-            tps = first_page.read(0)
-            indir_id = rid_tuple[1] - 3
-            
-            indir_col = self.bp.get_page(self.name, indir_id)
-            indirection_pointer = indir_col.read(rid_tuple[2])
-            columns = []
-            if indirection_pointer == 0 or (indirection_pointer >= tps and tps != 0):
-                for idx in range(len(query_columns)):
-                    if query_columns[idx] is 1:
-                        page_id = rid_tuple[0] + idx
-                        
-                        page = self.bp.get_page(self.name, page_id)
-                        column_val = page.read(rid_tuple[2])
-                        columns.append(column_val)
+        epoch = self.epochs.enter()
+        try:
+            for rid in rids:
+                rid_tuple = self.page_directory[rid]
+                with self.range_latches[rid_tuple[3]]:
+                    record_snapshot = snapshot
+                    if self.versions.sees_all(rid_tuple[3], snapshot):
+                        record_snapshot = None
+                    elif not self.versions.visible(rid, snapshot):
+                        continue
+                    page_range = self.page_ranges[rid_tuple[3]]
+
+                    first_page = self.bp.get_page(self.name, page_range[0])
+                    tps = first_page.read(0)
+                    indir_id = rid_tuple[1] - 3
+
+                    indir_col = self.bp.get_page(self.name, indir_id)
+                    indirection_pointer = indir_col.read(rid_tuple[2])
+                    columns = []
+                    if indirection_pointer == 0 or (indirection_pointer >= tps and tps != 0):
+                        for idx in range(len(query_columns)):
+                            if query_columns[idx] is 1:
+                                page_id = page_range[idx]
+
+                                page = self.bp.get_page(self.name, page_id)
+                                column_val = page.read(rid_tuple[2])
+                                columns.append(column_val)
+                            else:
+                                columns.append(None)
                     else:
-                        columns.append(None)
+                        updated_record_columns = self._get_most_recent_update(rid,
+                                indirection_pointer, query_columns, tps, key, page_range,
+                                record_snapshot)
+                        key = updated_record_columns[self.key]
+                        for idx in range(len(query_columns)):
+                            if query_columns[idx] == 1:
+                                columns.append(updated_record_columns[idx])
+                            else:
+                                columns.append(None)
+
+                record = Record(rid, key, columns)
+                records.append(record)
+        finally:
+            self.epochs.exit(epoch)
+        return records
+
+    """
+    Batched version of get_records. rids are grouped by the set of base pages
+    that hold them, and each page needed by a group is pinned once and read
+    for every record in the group at the same time, while holding the latch
+    of the group's page range. keys[i] is the key that rids[i] was located
+    with. Returns the records in the order of rids, with None for the records
+    that snapshot does not see.
+    """
+    def get_records_batch(self, rids, query_columns, keys, snapshot=None):
+        records = [None]*len(rids)
+        groups = {}
+        epoch = self.epochs.enter()
+        try:
+            for i in range(len(rids)):
+                rid_tuple = self.page_directory[rids[i]]
+                group = groups.setdefault((rid_tuple[3], rid_tuple[1]), [])
+                group.append((rid_tuple[2], i))
+            for (range_idx, schema_id), group in groups.items():
+                with self.range_latches[range_idx]:
+                    self._read_group(range_idx, schema_id, group, rids,
+                            query_columns, keys, records, snapshot)
+        finally:
+            self.epochs.exit(epoch)
+        return records
+
+    """
+    Reads the records of one group of get_records_batch, the records of rids
+    at the offsets in group, into records.
+    """
+    def _read_group(self, range_idx, schema_id, group, rids, query_columns, keys,
+            records, snapshot=None):
+        group.sort()
+        offsets = [offset for offset, i in group]
+        pinned = []
+        page_range = self.page_ranges[range_idx]
+        if self.versions.sees_all(range_idx, snapshot):
+            snapshot = None
+        first_page = self.bp.get_page(self.name, page_range[0], pin=True)
+        indir_col = self.bp.get_page(self.name, schema_id - 3, pin=True)
+        pinned.extend([first_page, indir_col])
+        tps = first_page.read(0)
+        indirection_pointers = indir_col.read_many(offsets)
+        column_values = {}
+        for idx in range(len(query_columns)):
+            if query_columns[idx] == 1:
+                page = self.bp.get_page(self.name, page_range[idx], pin=True)
+                pinned.append(page)
+                column_values[idx] = page.read_many(offsets)
+        for j in range(len(group)):
+            i = group[j][1]
+            if snapshot is not None and not self.versions.visible(rids[i], snapshot):
+                continue
+            key = keys[i]
+            indirection_pointer = indirection_pointers[j]
+            columns = [None]*len(query_columns)
+            if indirection_pointer == 0 or (indirection_pointer >= tps and tps != 0):
+                for idx in column_values:
+                    columns[idx] = column_values[idx][j]
             else:
-                updated_record_columns = self._get_most_recent_update(rid,
-                        indirection_pointer, query_columns, tps, key)
+                updated_record_columns = self._get_most_recent_update(rids[i],
+                        indirection_pointer, query_columns, tps, key, page_range,
+                        snapshot)
                 key = updated_record_columns[self.key]
-                for idx in range(len(query_columns)):
-                    if query_columns[idx] == 1:
-                        columns.append(updated_record_columns[idx])
-                    else:
-                        columns.append(None)
-            
-            record = Record(rid, key, columns)
-            records.append(record)
-        self.directory_lock.release()
-        return records
+                for idx in column_values:
+                    columns[idx] = updated_record_columns[idx]
+            records[i] = Record(rids[i], key, columns)
+        for page in pinned:
+            self.bp.unpin(page)
+
+    """
+    Whether snapshot sees the latest version of record rid. Transactions
+    only change records whose latest version they see, so of two
+    transactions that change a record concurrently, the first to do so wins
+    and the other aborts.
+    """
+    def is_current(self, rid, snapshot):
+        rid_tuple = self.page_directory.get(rid)
+        if rid_tuple is None:
+            return False
+        with self.range_latches[rid_tuple[3]]:
+            indir_col = self.bp.get_page(self.name, rid_tuple[1] - 3)
+            indirection_pointer = indir_col.read(rid_tuple[2])
+            if indirection_pointer == 0:
+                return self.versions.visible(rid, snapshot)
+            return self.versions.visible(indirection_pointer, snapshot)
 
 # ==================== INSERTING NEW RECORDS ====================
 
@@ -471,65 +855,88 @@ class Table:
     structures. 
     """
     def insert_base_record(self, *columns):
-        self.directory_lock.acquire()
-        schema_encoding = '0' * self.num_columns
-        curr_time = int(time())
+        schema_encoding = 0
         """
-        If 'current' base pages is full, or if no records have been inserted,
-        then create new page range containing a fresh set of base pages and
-        insert record data into these base pages.
-
-        Otherwise, insert the new base record into the most recently allocated
-        set of base pages.
+        The record goes to the base pages of the last page range, which gets
+        replaced by a new page range with a fresh set of base pages if they
+        are full (see _latch_insert_range).
         """
-        if self.current_base_page_is_full() or self.num_records is 0:
-            self.record_offset = 2
-            page_range = []
+        page_range_idx = self._latch_insert_range()
+        try:
+            curr_time = next_timestamp()
+            page_range = self.page_ranges[page_range_idx]
+            offset = self.bp.get_page(self.name, page_range[0]).num_records
+            with self.append_lock:
+                # obtain new rid from currently assigned rid space
+                rid = self.get_rid()
+                self.record_offset = offset + 1
+                self.num_records += 1
+            self.page_directory.reserve([rid])
+            lsn = self.log(INSERT, [page_range_idx, page_range[0], offset,
+                curr_time, 1, rid] + list(columns))
             # data storage is column-oriented:
-            for column in columns:
-                page_id = self.page_ids
-                self.page_ids += 1
-                page = self.bp.get_page(self.name, page_id)
-                page.write(column)
-                page_range.append(page_id)
-            # obtain new rid from currently assigned rid space
-            rid = self.get_rid()
-            # create metadata pages and write metadata to those pages
-            self.allocate_metadata_pages(page_range)
+            for i in range(len(columns)):
+                page = self.bp.get_page(self.name, page_range[i])
+                page.lsn = lsn
+                page.write(columns[i])
             # metadata list containing indirection pointer, rid of base record,
             # time-stamp, schema encoding:
             metadata = [0, rid, curr_time, schema_encoding]
-            self.write_metadata(metadata, page_range)
-            self.update_directory(rid, page_range, len(self.page_ranges))
-            self.page_ranges.append(page_range)
-            self.base_rids.add(rid)
+            self.write_metadata(metadata, page_range, lsn)
+            self.update_directory(rid, page_range, page_range_idx, offset, lsn)
+            self.versions.record_write(rid, page_range_idx, curr_time)
             self.session_log.archive_insert(rid)
-            self.directory_lock.release()
-            # return rid of newly inserted record
-            return rid
+        finally:
+            self.range_latches[page_range_idx].release()
+        # return rid of newly inserted record
+        return rid
 
-        else:
-            range_idx = 0
-            page_range = self.page_ranges[-1]
-            for column in columns:
-                # pull out page id from current page range
-                page_id = self.page_ranges[-1][range_idx]
-                # get page corresponding to this id 
-                page = self.bp.get_page(self.name, page_id)
-                # write data to page
-                page.write(column)
-                range_idx += 1
-            # obtain a new rid from currently assigned rid space
-            rid = self.get_rid()
-            # write metadata to metadata pages
-            metadata = [0, rid, curr_time, schema_encoding]
-            self.write_metadata(metadata, page_range)
-            self.update_directory(rid, page_range, len(self.page_ranges)-1)
-            self.base_rids.add(rid)
-            self.session_log.archive_insert(rid)
-            # return rid of newly created record
-            self.directory_lock.release()
-            return rid
+    """
+    Inserts many records at once. Rows are split into chunks that fill the
+    remaining space of the current set of base pages (at most 510 records),
+    and every column and metadata page of a chunk is written with a single
+    call. Returns the rids of the new records, in the order of rows.
+    """
+    def insert_base_records(self, rows):
+        rids = []
+        start = 0
+        while start < len(rows):
+            page_range_idx = self._latch_insert_range()
+            try:
+                curr_time = next_timestamp()
+                page_range = self.page_ranges[page_range_idx]
+                first_page = self.bp.get_page(self.name, page_range[0])
+                chunk = rows[start:start + first_page.get_capacity()]
+                with self.append_lock:
+                    chunk_rids = self.get_rids(len(chunk))
+                    self.record_offset = first_page.num_records + len(chunk)
+                    self.num_records += len(chunk)
+                self.page_directory.reserve(chunk_rids)
+                lsn = self.log(INSERT, [page_range_idx, page_range[0],
+                    first_page.num_records, curr_time, len(chunk)] + chunk_rids +
+                    [value for row in chunk for value in row])
+                # data storage is column-oriented:
+                for i in range(self.num_columns):
+                    page = self.bp.get_page(self.name, page_range[i])
+                    page.lsn = lsn
+                    offset = page.write_many([row[i] for row in chunk])
+                # metadata: indirection pointer, rid, time-stamp, schema encoding
+                metadata = [[0]*len(chunk), chunk_rids, [curr_time]*len(chunk),
+                        [0]*len(chunk)]
+                for i in range(len(metadata)):
+                    page = self.bp.get_page(self.name, page_range[self.num_columns+i])
+                    page.lsn = lsn
+                    page.write_many(metadata[i])
+                for rid in chunk_rids:
+                    self.update_directory(rid, page_range, page_range_idx, offset, lsn)
+                    self.versions.record_write(rid, page_range_idx, curr_time)
+                    self.session_log.archive_insert(rid)
+                    offset += 1
+            finally:
+                self.range_latches[page_range_idx].release()
+            rids.extend(chunk_rids)
+            start += len(chunk)
+        return rids
 
 # ==================== UPDATING AND TAIL RECORD CREATION ====================
 
@@ -539,25 +946,35 @@ class Table:
     """
     def _insert_tail_record(self, tail_page_range, column_update, indir_rid, base_rid):
         rid_tuple = self.page_directory[base_rid]
-        schema_encoding = ['0']*self.num_columns
-        tail_record_offset = 0
+        schema_encoding = 0
+        values = [0]*self.num_columns
+        for i in range(self.num_columns):
+            if column_update[i] is not None:
+                schema_encoding |= self.column_masks[i]
+                values[i] = column_update[i]
+        with self.append_lock:
+            tail_rid = self.get_tail_rid()
+            self.num_updates += 1
+        curr_time = next_timestamp()
+        tail_record_offset = self.bp.get_page(self.name, tail_page_range[0]).num_records
+        indir_page_id = rid_tuple[1] - 3
+        schema_page_id = indir_page_id + 3 
+        offset = rid_tuple[2]
+        old_pointer = self.bp.get_page(self.name, indir_page_id).read(offset)
+        base_schema = self.bp.get_page(self.name, schema_page_id).read_schema_mask(offset)
+        self.page_directory.reserve([tail_rid])
+        lsn = self.log(UPDATE, [base_rid, tail_rid, rid_tuple[3],
+            tail_page_range[0], tail_record_offset, curr_time, schema_encoding,
+            schema_page_id, offset, old_pointer, base_schema] + values)
         # write tail record data
         for i in range(self.num_columns):
-            page_id = tail_page_range[i]
-            
-            page = self.bp.get_page(self.name, page_id)
-            update_value = column_update[i]
-            tail_record_offset = 512 - page.get_capacity()
-            if update_value is not None:
-                schema_encoding[i] = '1'
-                page.write(update_value)
-            else:
-                page.write(0)
-        tail_rid = self.global_rid_space.assign_tail_rid()
+            page = self.bp.get_page(self.name, tail_page_range[i])
+            page.lsn = lsn
+            page.write(values[i])
         # place metadata into list for easy access in upcoming for loop
         metadata = [indir_rid]
         metadata.append(tail_rid)
-        metadata.append(int(time()))
+        metadata.append(curr_time)
         metadata.append(schema_encoding)
         metadata.append(base_rid)
         # write tail record metadata
@@ -565,30 +982,25 @@ class Table:
             page_id = tail_page_range[self.num_columns:][k]
             
             page = self.bp.get_page(self.name, page_id)
+            page.lsn = lsn
             if k != 3:
                 page.write(metadata[k])
             else:
-                schema_encoding = ''.join(schema_encoding)
-                page.write_schema(schema_encoding)
+                page.write_schema_mask(schema_encoding)
         # update indirection column of base record
-        # get page containing indirection pointers and update
-        indir_page_id = rid_tuple[1] - 3
         page = self.bp.get_page(self.name, indir_page_id)
-        offset = rid_tuple[2]
-        old_pointer = page.read(offset)
+        page.lsn = lsn
         page.update(tail_rid, offset)
         # update schema encoding column of base record
-        # get page containing schema encodings and update
-        schema_page_id = indir_page_id + 3 
         page = self.bp.get_page(self.name, schema_page_id)
-        base_schema = page.read_schema(self.num_columns,offset) 
-        base_schema = bin(int(base_schema,2) | int(schema_encoding,2))
-        page.update_schema(base_schema[2:], offset)
+        page.lsn = lsn
+        page.update_schema_mask(base_schema | schema_encoding, offset)
         # create the following page directory entry:
         # tail_rid -> (id0,idn,offset,page_range)
-        self.page_directory[tail_rid] = (tail_page_range[0],tail_page_range[-1],
-                tail_record_offset, rid_tuple[3])
-        return tail_rid, schema_encoding, old_pointer
+        self.page_directory.set(tail_rid, (tail_page_range[0],tail_page_range[-1],
+                tail_record_offset, rid_tuple[3]), lsn)
+        self.versions.record_write(tail_rid, rid_tuple[3], curr_time)
+        return tail_rid, old_pointer, base_schema
 
     """
     Updates a record. This is achieved by simply creating a tail record that
@@ -618,259 +1030,517 @@ class Table:
     pages will beplaced in page_ranges[1].
     """
     def update_record(self, rid, column_update):
-        self.directory_lock.acquire()
-        rid_tuple = self.page_directory[rid]
-        page_range_idx = rid_tuple[3]
-        page_range = self.page_ranges[page_range_idx]
-        old_range = page_range[:]
-        
-        if self.need_tail_page_allocation(page_range):
-            self.allocate_tail_pages(page_range)
-        
-        indir_page = self.bp.get_page(self.name, rid_tuple[1]-3)
-        indirection_pointer = indir_page.read(rid_tuple[2])
-        tail_page_range = page_range[-(self.num_columns + 5):]
-        tail_rid, tail_schema, old_pointer = self._insert_tail_record(tail_page_range, column_update, indirection_pointer, rid)
+        page_range_idx = self.page_directory[rid][3]
+        with self.range_latches[page_range_idx]:
+            rid_tuple = self.page_directory[rid]
+            page_range = self.page_ranges[page_range_idx]
 
-        if self.base_page_is_full(page_range) and self.tail_page_is_full(page_range) and not self.merging:
-            self.load_merge_queue(page_range, old_range)
+            if self.need_tail_page_allocation(page_range):
+                with self.append_lock:
+                    self.allocate_tail_pages(page_range)
+                self.range_segments[page_range_idx] = self.range_segments.get(page_range_idx, 0) + 1
 
-        self.session_log.archive_update(tail_rid, rid, old_pointer, rid_tuple[1]-3, rid_tuple[1], rid_tuple[2], tail_schema)
-        
-        self.directory_lock.release()
-        """ 
-        self.num_updates += 1
-        if self.num_updates >= 5000 and not self.merging and not len(self.merge_queue) == 0:
-            merge_thread = threading.Thread(target=self.__merge, args=())
-            self.num_updates = 0
-            merge_thread.start()
-        """
+            indir_page = self.bp.get_page(self.name, rid_tuple[1]-3)
+            indirection_pointer = indir_page.read(rid_tuple[2])
+            tail_page_range = page_range[-(self.num_columns + 5):]
+            tail_rid, old_pointer, old_base_schema = self._insert_tail_record(tail_page_range, column_update, indirection_pointer, rid)
+
+            updates = self.range_updates.get(page_range_idx, 0) + 1
+            self.range_updates[page_range_idx] = updates
+            if ((config.MERGE_UPDATE_COUNT and updates >= config.MERGE_UPDATE_COUNT) or
+                    (config.MERGE_TAIL_SEGMENTS and self.range_segments.get(page_range_idx, 0)
+                        >= config.MERGE_TAIL_SEGMENTS)):
+                self.request_merge(page_range_idx)
+
+            self.session_log.archive_update(tail_rid, rid, old_pointer, rid_tuple[1]-3, rid_tuple[1], rid_tuple[2], old_base_schema)
 
 # ==================== RECORD INVALIDATION ====================
 
     def invalidate_record(self, rid):
-        self.directory_lock.acquire()
         try:
             rid_tuple = self.page_directory[rid]
         except KeyError:
             print('error: cannot delete nonexistent record')
             return
 
-        # obtain metadata page containing record's rid
-        rid_page_id = rid_tuple[1] - RID_COLUMN
-        rid_page = self.bp.get_page(self.name, rid_page_id)
-        # invalidate base record:
-        rid_page.update(0,rid_tuple[2])
-        # remove the record's entry from the page directory
-        del self.page_directory[rid]
-        self.session_log.archive_delete(rid, rid_tuple)
-        self.directory_lock.release()
+        with self.range_latches[rid_tuple[3]]:
+            lsn = self.log(DELETE, [rid] + list(rid_tuple))
+            # obtain metadata page containing record's rid
+            rid_page_id = rid_tuple[1] - RID_COLUMN
+            rid_page = self.bp.get_page(self.name, rid_page_id)
+            # invalidate base record:
+            rid_page.lsn = lsn
+            rid_page.update(0,rid_tuple[2])
+            # remove the record's entry from the page directory
+            self.page_directory.remove(rid, lsn)
+            self.session_log.archive_delete(rid, rid_tuple)
 
 # ==================== ROLL BACK ====================
 
+    """
+    Rolls back the changes archived for the transaction running on thread_id.
+    Each change is reverted while holding the latch of the page range of its
+    record.
+    """
     def rollback(self, thread_id):
-        self.directory_lock.acquire()
         if thread_id in self.session_log.log:
             transaction_archive = self.session_log.log[thread_id]
-            tail_encodings_map = {}
             # roll back inserts:
             if 'inserts' in transaction_archive:
                 for inserted_rid in transaction_archive['inserts']:
                     rid_tuple = self.page_directory[inserted_rid]
-                    rid_page_id = rid_tuple[1] - RID_COLUMN
-                    rid_page = self.bp.get_page(self.name, rid_page_id)
-                    rid_page.update(0, rid_tuple[2])
-                    del self.page_directory[inserted_rid]
+                    with self.range_latches[rid_tuple[3]]:
+                        lsn = self.log(UNDO_INSERT, [inserted_rid] + list(rid_tuple))
+                        rid_page_id = rid_tuple[1] - RID_COLUMN
+                        rid_page = self.bp.get_page(self.name, rid_page_id)
+                        rid_page.lsn = lsn
+                        rid_page.update(0, rid_tuple[2])
+                        self.page_directory.remove(inserted_rid, lsn)
             if 'deletes' in transaction_archive:
                 for deleted_rid in transaction_archive['deletes']:
                     rid_tuple = self.session_log.dir_log[deleted_rid] 
-                    rid_page_id = rid_tuple[1] - RID_COLUMN
-                    rid_page = self.bp.get_page(self.name, rid_page_id)
-                    rid_page.update(deleted_rid, rid_tuple[2])
-                    self.page_directory[deleted_rid] = rid_tuple
+                    with self.range_latches[rid_tuple[3]]:
+                        lsn = self.log(UNDO_DELETE, [deleted_rid] + list(rid_tuple))
+                        rid_page_id = rid_tuple[1] - RID_COLUMN
+                        rid_page = self.bp.get_page(self.name, rid_page_id)
+                        rid_page.lsn = lsn
+                        rid_page.update(deleted_rid, rid_tuple[2])
+                        self.page_directory.set(deleted_rid, rid_tuple, lsn)
             if 'updates' in transaction_archive:
-                for update in transaction_archive['updates']:
+                # newest first, so a record updated more than once ends up
+                # as it was before them all:
+                for update in reversed(transaction_archive['updates']):
                     tail_rid = update[0]
                     base_rid = update[1]
                     next_tail = update[2]
                     base_indir_id = update[3]
                     base_schema_id = update[4]
                     base_offset = update[5]
-                    tail_schema = update[6]
-                    # get base schema page:
-                    base_schema_page = self.bp.get_page(self.name, base_schema_id)
-                    # get base indirection page:
-                    base_indirection_page = self.bp.get_page(self.name, base_indir_id)
-                    # set base indirection pointer to next tail record in lineage:
-                    base_indirection_page.update(next_tail, base_offset)
-                    # revert base schema to previous state, if necessary:
-                    if base_rid not in tail_encodings_map:
-                        tail_encodings_map[base_rid] = '0'*self.num_columns
-                    tail_encoding = tail_encodings_map[base_rid]
-                    if int(tail_encoding,2) | int(tail_schema,2) != int(tail_encoding,2):
-                        format_spec = '0' + str(self.num_columns) +'b'
-                        base_schema = base_schema_page.read_schema(self.num_columns, base_offset)
-                        base_schema = format(int(base_schema,2)^int(tail_schema,2), format_spec)
-                        tail_encoding = format(int(tail_encoding,2)|int(tail_schema,2), format_spec)
-                        base_schema_page.update_schema(base_schema, base_offset)
-                        tail_encodings_map[base_rid] = tail_encoding
+                    base_schema = update[6]
+                    # the tail record is in the page range of the base record:
+                    with self.range_latches[self.page_directory[tail_rid][3]]:
+                        # restore the base schema the update found (the
+                        # columns updated since the last merge, by this
+                        # transaction or the ones committed before it):
+                        base_schema_page = self.bp.get_page(self.name, base_schema_id)
+                        lsn = self.log(UNDO_UPDATE, [base_rid, tail_rid,
+                            base_schema_id, base_offset, next_tail, base_schema])
+                        base_schema_page.lsn = lsn
+                        base_schema_page.update_schema_mask(base_schema, base_offset)
+                        # get base indirection page:
+                        base_indirection_page = self.bp.get_page(self.name, base_indir_id)
+                        # set base indirection pointer to next tail record in lineage:
+                        base_indirection_page.lsn = lsn
+                        base_indirection_page.update(next_tail, base_offset)
+                        self._invalidate_tail_record(tail_rid, lsn)
+            # the thread's next transaction must not roll these back again:
+            self.session_log.clear_archive(thread_id)
+        self.versions.abort(thread_id)
         self.index.rollback_index(thread_id)
-        self.directory_lock.release()
+
+    """
+    Clears the rid of a rolled back tail record in its tail pages, so merges
+    skip it (see _consolidate_tail_columns). The record stays in the page
+    directory.
+    """
+    def _invalidate_tail_record(self, tail_rid, lsn=0):
+        tail_tuple = self.page_directory.get(tail_rid)
+        if tail_tuple is None:
+            return
+        page = self.bp.get_page(self.name, tail_tuple[0] + self.num_columns + 1)
+        if lsn:
+            page.lsn = lsn
+        page.update(0, tail_tuple[2])
 
     def commit(self, thread_id):
-        self.directory_lock.acquire()
         self.session_log.clear_archive(thread_id)
-        self.directory_lock.release()
+        self.index.index_log.pop(thread_id, None)
+
+# ==================== RECOVERY ====================
+
+    """
+    Writes values into a page starting at offset, on behalf of recovery.
+    Unlike Page.write, this does not depend on what the page already holds,
+    so it can be repeated.
+    """
+    def _redo_write(self, page_id, offset, values):
+        page = self.bp.get_page(self.name, page_id)
+        page.update_many(values, offset)
+        if page.num_records < offset + len(values):
+            page.num_records = offset + len(values)
+
+    """
+    Makes sure rids handed out from now on come after rid.
+    """
+    def _advance_rid_block(self, rid):
+        block_start = rid - (rid - 1) % 512
+        if block_start > self.rid_block[0]:
+            self.rid_block = (block_start, block_start + 511)
+            self.rid_block_offset = 0
+        if block_start == self.rid_block[0]:
+            self.rid_block_offset = max(self.rid_block_offset, rid - block_start + 1)
+        if self.global_rid_space.rid_block[0] <= block_start:
+            self.global_rid_space.rid_block = (block_start + 512, block_start + 1023)
+
+    """
+    The same for tail rids, whose blocks count down.
+    """
+    def _advance_tail_rid_block(self, rid):
+        block_start = rid + (TAIL_RID_BASE - rid) % 512
+        if block_start < self.tail_rid_block[0]:
+            self.tail_rid_block = (block_start, block_start - 511)
+            self.tail_rid_block_offset = 0
+        if block_start == self.tail_rid_block[0]:
+            self.tail_rid_block_offset = max(self.tail_rid_block_offset,
+                    block_start - rid + 1)
+        if self.global_rid_space.tail_rid >= block_start:
+            self.global_rid_space.tail_rid = block_start - 512
+
+    """
+    Repeats a logged change (see wal for the record layouts). Changes are
+    replayed in log order on top of a metadata snapshot and pages that may
+    already contain some of them, so every change is applied in a way that
+    can be repeated: values are written at their logged positions, and
+    directory entries and page ranges are set rather than added to.
+    """
+    def redo(self, record_type, values):
+        n = self.num_columns
+        if record_type == INSERT:
+            range_idx, first_page_id, offset, curr_time, count = values[:5]
+            rids = list(values[5:5 + count])
+            rows = values[5 + count:]
+            if range_idx == len(self.page_ranges):
+                self.range_latches.append(threading.Lock())
+                self.page_ranges.append(list(range(first_page_id, first_page_id + n + 4)))
+                self._redo_allocation(first_page_id, n + 4)
+            elif range_idx > len(self.page_ranges):
+                raise Exception('recovery error: log refers to a missing page range')
+            self.page_ids = max(self.page_ids, first_page_id + n + 4)
+            for i in range(n):
+                self._redo_write(first_page_id + i, offset, rows[i::n])
+            metadata = [[0]*count, rids, [curr_time]*count, [0]*count]
+            for i in range(4):
+                self._redo_write(first_page_id + n + i, offset, metadata[i])
+            for j in range(count):
+                if rids[j] not in self.page_directory:
+                    self.num_records += 1
+                self.page_directory.set(rids[j], (first_page_id,
+                        first_page_id + n + 3, offset + j, range_idx))
+                self._advance_rid_block(rids[j])
+            if range_idx == len(self.page_ranges) - 1:
+                self.record_offset = self.bp.get_page(self.name, first_page_id).num_records
+        elif record_type == UPDATE:
+            (base_rid, tail_rid, range_idx, tail_first_page_id, tail_offset,
+                    curr_time, tail_schema, base_schema_page_id, base_offset,
+                    old_pointer, old_base_schema) = values[:11]
+            page_range = self.page_ranges[range_idx]
+            if tail_first_page_id not in page_range:
+                page_range.extend(range(tail_first_page_id, tail_first_page_id + n + 5))
+                self._redo_allocation(tail_first_page_id, n + 5)
+            for i in range(n):
+                self._redo_write(tail_first_page_id + i, tail_offset, [values[11 + i]])
+            metadata = [old_pointer, tail_rid, curr_time, tail_schema, base_rid]
+            for k in range(5):
+                self._redo_write(tail_first_page_id + n + k, tail_offset, [metadata[k]])
+            self.bp.get_page(self.name, base_schema_page_id - 3).update(tail_rid, base_offset)
+            self.bp.get_page(self.name, base_schema_page_id).update_schema_mask(
+                    old_base_schema | tail_schema, base_offset)
+            self.page_directory.set(tail_rid, (tail_first_page_id,
+                    tail_first_page_id + n + 4, tail_offset, range_idx))
+            self._advance_tail_rid_block(tail_rid)
+        elif record_type == DELETE or record_type == UNDO_INSERT:
+            rid, first_page_id, schema_page_id, offset, range_idx = values
+            self.bp.get_page(self.name, schema_page_id - RID_COLUMN).update(0, offset)
+            self.page_directory.remove(rid)
+        elif record_type == UNDO_DELETE:
+            rid, first_page_id, schema_page_id, offset, range_idx = values
+            self.bp.get_page(self.name, schema_page_id - RID_COLUMN).update(rid, offset)
+            self.page_directory.set(rid, values[1:])
+        elif record_type == UNDO_UPDATE:
+            base_rid, tail_rid, schema_page_id, offset, pointer, schema = values
+            self.bp.get_page(self.name, schema_page_id - 3).update(pointer, offset)
+            self.bp.get_page(self.name, schema_page_id).update_schema_mask(schema, offset)
+            self._invalidate_tail_record(tail_rid)
+        elif record_type == DIRECTORY:
+            self.page_directory.redo_reserve(*values)
+        elif record_type == MERGE:
+            range_idx, version, first_page_id, tps = values[:4]
+            new_page_ids = self.page_ranges[range_idx][:n]
+            if version > self.range_versions.get(range_idx, 0):
+                # the merged pages were written before the merge was logged
+                new_page_ids = list(range(first_page_id, first_page_id + n))
+                self._claim_pages(first_page_id, n)
+                self.page_ids = max(self.page_ids, first_page_id + n)
+                self.range_versions[range_idx] = version
+            self._swap_merged_pages(range_idx, new_page_ids, values[4:])
+
+    """
+    Replays the allocation of count pages starting at first_page_id. The
+    pages may have been reused, so they are cleared first; every change to
+    them since is replayed after this.
+    """
+    def _redo_allocation(self, first_page_id, count):
+        self._claim_pages(first_page_id, count)
+        self.page_ids = max(self.page_ids, first_page_id + count)
+        for page_id in range(first_page_id, first_page_id + count):
+            self.bp.get_page(self.name, page_id).clear()
+
+    """
+    Reverts a logged change of a transaction that never finished. Called for
+    the transaction's records in reverse log order, after redo, which leaves
+    every record the transaction touched as the transaction left it.
+    Compensation records (UNDO_*) of a rollback that was cut short need no
+    undo of their own: undoing the original changes restores the same state.
+    """
+    def undo(self, record_type, values):
+        n = self.num_columns
+        if record_type == INSERT:
+            range_idx, first_page_id, offset, curr_time, count = values[:5]
+            for j in range(count):
+                self.bp.get_page(self.name, first_page_id + n + 1).update(0, offset + j)
+                self.page_directory.remove(values[5 + j])
+        elif record_type == UPDATE:
+            base_rid, tail_rid = values[:2]
+            base_schema_page_id, base_offset, old_pointer, old_base_schema = values[7:11]
+            self.bp.get_page(self.name, base_schema_page_id - 3).update(old_pointer, base_offset)
+            self.bp.get_page(self.name, base_schema_page_id).update_schema_mask(
+                    old_base_schema, base_offset)
+            self._invalidate_tail_record(tail_rid)
+        elif record_type == DELETE:
+            rid, first_page_id, schema_page_id, offset, range_idx = values
+            self.bp.get_page(self.name, schema_page_id - RID_COLUMN).update(rid, offset)
+            self.page_directory.set(rid, values[1:])
 
 # ==================== MERGE ====================
 
-    def _get_tail_record(self, id_segment, offset):
-        tail_record_data = []
-        for i in range(self.num_columns):
-            page_id = id_segment[i]
-            tail_page = page = self.bp.get_page(self.name, page_id)
-            data = tail_page.read(offset)
-            tail_record_data.append(data)
-        for k in range(5):
-            page_id = id_segment[self.num_columns + k]
-            tail_page = page = self.bp.get_page(self.name, page_id)
-            if k != 3:
-                data = tail_page.read(offset)
-                tail_record_data.append(data)
-            else:
-                data = tail_page.read_schema(self.num_columns, offset)
-                tail_record_data.append(data)
-        return tail_record_data
-            
-    def _process_tail_page(self, id_segment):
-        tail_records = []
-        tail_id = id_segment[-1] 
-        tail_page = self.bp.get_page(self.name, tail_id)
-        offset = tail_page.num_records - 1
-        while offset >= 1:
-            tail_records.append(self._get_tail_record(id_segment, offset))
-            offset -= 1
-        return tail_records
-
-    def _write_tps_to_base(self, base_page_ids, tail_records):
-        most_recent_update = tail_records[0]
-        tail_id = most_recent_update[-4]
-        for page_id in base_page_ids: 
-            page = page = self.bp.get_page(self.name, page_id)
-            page.update(tail_id, 0)
-
-    def _write_updates_to_base_pages(self, tail_records, base_page_ids, updated_mappings):
-        tail_encodings_map = {}
-        for tail_record in tail_records:
-            tail_schema  = tail_record[-2]
-            base_rid = tail_record[-1]  
-            if base_rid not in tail_encodings_map:
-                tail_encodings_map[base_rid] = '0'*self.num_columns
-            tail_encoding = tail_encodings_map[base_rid]
-            # determine if tail record contains a yet to be encountered update:
-            if int(tail_encoding,2) | int(tail_schema,2) != int(tail_encoding,2):
-                # If it does, write update and update tail_encodings
-                try:
-                    base_tuple = self.page_directory[base_rid]
-                except KeyError:
-                    continue
-                base_offset = base_tuple[2]
-                for i in range(len(base_page_ids)):
-                    if tail_schema[i] == '1' and tail_encoding[i] == '0':
-                        data = tail_record[i]
-                        base_page_id = base_page_ids[i] 
-                        base_page = page = self.bp.get_page(self.name, base_page_id)
-                        base_page.update(data, base_offset)
-                # following list comprehension was taken from stack overflow.
-                # this is used to update the tail encodings.
-                ones = [i for i, num in enumerate(tail_schema) if num == '1']
-                for j in ones:
-                    tail_encoding = list(tail_encoding)
-                    tail_encoding[j] = '1'
-                    tail_encoding = ''.join(tail_encoding)
-                tail_encodings_map[base_rid] = tail_encoding
-
-                if base_rid not in updated_mappings:
-                    updated_mappings[base_rid] = (base_page_ids, base_tuple[3])
-
-                        
-    def _process_tail_records(self, id_segments, base_page_ids, updated_mappings):
-        tps_updated = False
-        while id_segments != []:
-            latest_segment = id_segments[-1]
-            tail_records = self._process_tail_page(latest_segment)
-            if not tps_updated:
-                self._write_tps_to_base(base_page_ids, tail_records)
-                tps_updated = True
-            self._write_updates_to_base_pages(tail_records, base_page_ids,
-                    updated_mappings)
-            id_segments.pop(-1)
-
-    def _copy_base_pages(self, base_page_ids, update_range):
-        for i in range(len(base_page_ids)):
-            new_page_id = base_page_ids[i]
-            old_page_id = update_range[i]  
-            old_page = self.bp.get_page(self.name, old_page_id)
-            new_page = self.bp.get_page(self.name, new_page_id)
-            for k in range(0,512):
-                old_data = old_page.read(k)
-                new_page.update(old_data,k)
-    
-    def _modify_page_directory(self, updated_mappings, stale_page_ids):
-        self.directory_lock.acquire()
-        stale_page_ids = set(stale_page_ids)
-        for rid in updated_mappings.keys():
-            base_page_ids = updated_mappings[rid][0]
-            try:
-                old_tuple = self.page_directory[rid]
-            except KeyError:
+    """
+    Queues page range range_idx for a merge (see MergeScheduler), if the
+    table has a scheduler and the base pages of the range are full. Records
+    are only ever added to the base pages of the last page range, so the base
+    pages a merge copies do not change while it runs.
+    """
+    def request_merge(self, range_idx):
+        if self.merge_scheduler is None:
+            return
+        if self.base_page_is_full(self.page_ranges[range_idx]):
+            self.merge_scheduler.request(self, range_idx)
+
+    """
+    Returns the sets of tail pages of a page range that may hold tail records
+    the next merge has to consolidate, oldest first, as (tail page ids,
+    number of slots to read, rid column) triples: the last set up to slot
+    tail_end, and every set before it back to the newest one that has been
+    merged completely (its last tail rid is at least tps). Tail rids count
+    down, so newer means smaller.
+    """
+    def _unmerged_tail_segments(self, segments, tail_end, tps):
+        n = self.num_columns
+        unmerged = []
+        for i in range(len(segments) - 1, -1, -1):
+            stop = tail_end if i == len(segments) - 1 else None
+            rids = self.bp.get_page(self.name, segments[i][n + 1]).read_column(2, stop)
+            if tps != 0 and len(rids) != 0 and rids[-1] >= tps:
+                break
+            unmerged.append((segments[i], stop, rids))
+        unmerged.reverse()
+        return unmerged
+
+    """
+    Computes the newest value of every updated column of every base record
+    from a page range's tail records, a whole tail page at a time. Tail
+    records are consolidated if they are newer than the ones merged so far
+    (tps), older than horizon (the oldest tail record of a transaction that
+    may still be rolled back, or that a snapshot does not see) and not
+    rolled back already (a rid of 0, see _invalidate_tail_record). segments
+    are oldest first (see _unmerged_tail_segments) and tail records within a
+    set of tail pages are oldest first too, so building a dictionary from
+    (offset, value) pairs leaves the last writer of each column of each
+    record in it.
+    offsets maps the rids of the base records to their offsets. Returns a
+    list with one {offset: value} dictionary per column, and the rid of the
+    newest tail record consolidated (0 if there was none).
+    """
+    def _consolidate_tail_columns(self, segments, tps, horizon, offsets):
+        n = self.num_columns
+        newer_than = tps if tps != 0 else TAIL_RID_BASE + 1
+        older_than = horizon if horizon is not None else 0
+        latest = [{} for i in range(n)]
+        newest = 0
+        for segment, stop, rids in segments:
+            keep = list(map(and_, map(newer_than.__gt__, rids), map(older_than.__lt__, rids)))
+            if not any(keep):
                 continue
-            page_range = self.page_ranges[old_tuple[3]]
-            new_tuple = list(old_tuple)
-            new_tuple[0] = base_page_ids[0]
-            new_tuple = tuple(new_tuple)
-            self.page_directory[rid] = new_tuple
-            for i in range(len(base_page_ids)):
-                page_range[i] = base_page_ids[i]
-            page_range = set(page_range)
-            page_range = page_range - stale_page_ids
-            page_range = list(page_range)
-        self.directory_lock.release()
-
-    def __merge(self):
-        self.merging = True
-        updated_mappings = {}
-        stale_tail_page_ids = []
-        for update_range in self.merge_queue:
-            tail_page_ids = update_range[self.num_columns+4:]
-            
-            for i in range(len(tail_page_ids)):
-                stale_tail_page_ids.append(tail_page_ids[i])
+            newest = min(compress(rids, keep))
+            schemas = list(compress(self.bp.get_page(self.name, segment[n + 3]).read_column(2, stop), keep))
+            base_rids = self.bp.get_page(self.name, segment[n + 4]).read_column(2, stop)
+            base_offsets = list(map(offsets.get, compress(base_rids, keep)))
+            for i in range(n):
+                updated = list(map(and_, schemas, repeat(self.column_masks[i])))
+                if not any(updated):
+                    continue
+                values = compress(self.bp.get_page(self.name, segment[i]).read_column(2, stop), keep)
+                latest[i].update(zip(compress(base_offsets, updated), compress(values, updated)))
+        for column in latest:
+            # tail records of deleted base records:
+            column.pop(None, None)
+        return latest, newest
 
-            id_segments = []
-            while tail_page_ids != []:
-                id_segment = []
-                for i in range(self.num_columns+5):
-                    id_segment.append(tail_page_ids.pop(0))
-                id_segments.append(id_segment)
+    """
+    Swaps the merged base pages (new_page_ids) into page range range_idx and
+    drops the sets of tail pages that start at merged_segments from it,
+    retiring the pages that are replaced or dropped. The page range gets a
+    new list, so readers that looked it up before keep a consistent version.
+    """
+    def _swap_merged_pages(self, range_idx, new_page_ids, merged_segments, lsn=0):
+        n = self.num_columns
+        page_range = self.page_ranges[range_idx]
+        retired = []
+        if page_range[:n] != new_page_ids:
+            retired.extend(page_range[:n])
+        new_range = new_page_ids + page_range[n:n + 4]
+        for i in range(n + 4, len(page_range), n + 5):
+            segment = page_range[i:i + n + 5]
+            if segment[0] in merged_segments:
+                retired.extend(segment)
+            else:
+                new_range.extend(segment)
+        self.page_ranges[range_idx] = new_range
+        self._retire_pages(retired, lsn)
 
-            base_page_ids = []
+    """
+    Takes pages out of use. They become free pages once no reader can still
+    be using them and the log no longer has to be replayed up to lsn, the
+    log record that retired them (see reclaim_pages).
+    """
+    def _retire_pages(self, page_ids, lsn=0):
+        if not page_ids:
+            return
+        epoch = self.epochs.advance()
+        with self.append_lock:
+            for first_page_id, count in page_extents(page_ids):
+                self.retired.append([first_page_id, count, epoch, lsn])
 
-            """
-            Allocate new set of base pages for merging. Metadata pages are not
-            touched, so we only allocate enought to write metadata.
-            """
-            for i in range(self.num_columns):
-                page_id = self.page_ids
-                self.page_ids += 1
-                base_page_ids.append(page_id)
-
-            self._copy_base_pages(base_page_ids, update_range)
-            self._process_tail_records(id_segments, base_page_ids,
-                    updated_mappings)
-
-        self._modify_page_directory(updated_mappings, stale_tail_page_ids) 
-        self.merging = False
-        self.merge_queue = []
-        pass
+    """
+    Removes pages that the log shows were allocated (by a change replayed
+    by recovery) from the free and the retired pages.
+    """
+    def _claim_pages(self, first_page_id, count):
+        self.free_pages.claim(first_page_id, count)
+        self.retired = subtract_extent(self.retired, first_page_id, count)
+
+    """
+    Turns the retired pages that can be reused into free pages: those that
+    no reader entered an epoch early enough to still use (see EpochManager)
+    and that were retired by a log record before checkpoint_lsn, the LSN of
+    the last durable checkpoint. Called by every checkpoint, before it saves
+    the metadata: recovery, from that checkpoint or the one being taken,
+    never replays a change to the pages from before they were retired, even
+    if the pages are reused before the new checkpoint is saved. Returns the
+    number of pages freed.
+    """
+    def reclaim_pages(self, checkpoint_lsn):
+        freed = 0
+        with self.append_lock:
+            retired = []
+            for entry in self.retired:
+                first_page_id, count, epoch, lsn = entry
+                if lsn < checkpoint_lsn and self.epochs.quiesced(epoch):
+                    self.free_pages.release(first_page_id, count)
+                    freed += count
+                else:
+                    retired.append(entry)
+            self.retired = retired
+        return freed
 
+    """
+    Merges the tail records of page range range_idx into new copies of its
+    base column pages. Runs on the merge worker thread (see MergeScheduler):
+
+    1. While holding the latch of the page range, it notes the version of the
+       range, its base and tail pages, the number of records in its last set
+       of tail pages and the oldest tail record of a transaction that has not
+       finished yet, or that some snapshot does not see (see
+       VersionTable.merge_horizon); merging stops short of that record, since
+       the transaction may still roll it back, and the snapshot must still
+       find the version before it.
+    2. Without holding the latch, it computes the newest value of every
+       updated column from the tail pages (see _consolidate_tail_columns),
+       copies each base column page to a new page and writes the new values
+       into it in one go. Slot 0 of every new page gets the new TPS, the rid
+       of the newest tail record merged. The new pages are written to disk
+       before the merge is logged, so the log only has to record which pages
+       replaced which.
+    3. While holding the latch again, it logs the merge and swaps the new
+       pages into the page range by assigning it a new list, so a reader
+       sees either the old or the new version of the page range, each with
+       its own TPS, and bumps the version of the range.
+
+    Readers of the page range therefore only ever wait for the merge in steps
+    1 and 3, and readers of other page ranges never do. The
+    metadata pages are shared by both versions. The old base pages, and the
+    sets of tail pages whose tail records have all been merged, are retired
+    (see _swap_merged_pages). Returns False if there was nothing to merge.
+    """
+    def merge_range(self, range_idx):
+        n = self.num_columns
+        with self.range_latches[range_idx]:
+            page_range = self.page_ranges[range_idx]
+            if len(page_range) == n + 4 or not self.base_page_is_full(page_range):
+                return False
+            version = self.range_versions.get(range_idx, 0)
+            base_page_ids = page_range[:n]
+            rid_page_id = page_range[n + 1]
+            segments = [page_range[i:i + n + 5] for i in range(n + 4, len(page_range), n + 5)]
+            tail_end = self.bp.get_page(self.name, segments[-1][0]).num_records
+            horizon = self.session_log.oldest_update()
+            snapshot_horizon = self.versions.merge_horizon(range_idx)
+            if horizon is None or (snapshot_horizon is not None and snapshot_horizon > horizon):
+                horizon = snapshot_horizon
+            self.range_updates[range_idx] = 0
+            self.range_segments[range_idx] = 0
+        # merging reads every page of the range once, so it runs in a scan
+        # ring rather than pushing everything else out of the pool:
+        with self.bp.scan_ring():
+            tps = self.bp.get_page(self.name, base_page_ids[0]).read(0)
+            unmerged = self._unmerged_tail_segments(segments, tail_end, tps)
+            rids = self.bp.get_page(self.name, rid_page_id).read_column()
+            offsets = dict(zip(rids, range(2, 2 + len(rids))))
+            # deleted base records:
+            offsets.pop(0, None)
+            latest, tps = self._consolidate_tail_columns(unmerged, tps, horizon, offsets)
+            if tps == 0:
+                return False
+            # the sets of tail pages (other than the one being filled) whose
+            # tail records are all merged now are no longer needed:
+            still_needed = set(segment[0] for segment, stop, tail_rids in unmerged
+                    if min(filter(None, tail_rids), default=tps) < tps)
+            merged_segments = [segment[0] for segment in segments[:-1]
+                    if segment[0] not in still_needed]
+            with self.append_lock:
+                first_page_id = self.allocate_pages(n)
+            new_page_ids = list(range(first_page_id, first_page_id + n))
+            new_pages = [self.bp.get_page(self.name, page_id, pin=True)
+                    for page_id in new_page_ids]
+            try:
+                for i in range(n):
+                    new_pages[i].copy_from(self.bp.get_page(self.name, base_page_ids[i]))
+                    new_pages[i].scatter(latest[i].keys(), latest[i].values())
+                    new_pages[i].update(tps, 0)
+                    new_pages[i].compressed = config.COMPRESS_MERGED_PAGES
+                if self.wal is not None:
+                    self.bp.writer.write_batch([(self.name, new_page_ids[i], new_pages[i])
+                            for i in range(n)])
+                with self.range_latches[range_idx]:
+                    if self.range_versions.get(range_idx, 0) != version:
+                        # the new pages were never logged, so they are free
+                        with self.append_lock:
+                            self.free_pages.release(first_page_id, n)
+                        return False
+                    lsn = self.log(MERGE, [range_idx, version + 1, first_page_id, tps]
+                            + merged_segments)
+                    self._swap_merged_pages(range_idx, new_page_ids, merged_segments, lsn)
+                    self.range_versions[range_idx] = version + 1
+            finally:
+                for new_page in new_pages:
+                    self.bp.unpin(new_page)
+        return True
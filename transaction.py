@@ -1,5 +1,8 @@
 from table import Table, Record
 from index import Index
+from logger import transaction_context
+from lock_manager import LockOwner
+import mvcc
 import threading
 
 class Transaction:
@@ -10,6 +13,19 @@ class Transaction:
     def __init__(self):
         self.queries = []
         self.tables = []
+        """
+        The write-ahead log the transaction is logged in (that of the database
+        its tables belong to, if it has one) and its id in that log.
+        """
+        self.wal = None
+        self.txn_id = 0
+        """
+        The snapshot the transaction reads (see mvcc), from begin on, and the
+        owner of its record locks (see LockManager), which it holds until it
+        commits or aborts.
+        """
+        self.snapshot = None
+        self.lock_owner = None
         pass
 
     """
@@ -24,25 +40,69 @@ class Transaction:
 
     # If you choose to implement this differently this method must still return True if transaction commits or False on abort
     def run(self):
+        self.begin()
         for query, args in self.queries:
             query_object = query.__self__
             table = query_object.table
             if table not in self.tables:
                 self.tables.append(table)
             result = query(*args)
-            # If the query has failed the transaction should abort
-            if result == False:
+            # If the query has failed the transaction should abort, and so
+            # should a transaction wounded by an older one (see LockManager)
+            if result == False or self.lock_owner.wounded:
                 return self.abort() 
         return self.commit()
 
+    """
+    Starts the transaction in the write-ahead log of the database its tables
+    belong to, if that database has one. Until it commits or aborts, the
+    changes the thread makes are archived for a rollback (see Logger), and
+    its reads see the snapshot it takes now (see mvcc).
+    """
+    def begin(self):
+        transaction_context.active = True
+        self.snapshot = mvcc.begin_snapshot()
+        transaction_context.snapshot = self.snapshot
+        # transactions are ordered by age by the start of their snapshot:
+        self.lock_owner = LockOwner(self.snapshot[0])
+        transaction_context.lock_owner = self.lock_owner
+        for query, args in self.queries:
+            wal = query.__self__.table.wal
+            if wal is not None:
+                self.wal = wal
+                self.txn_id = wal.begin()
+                return
+
     def abort(self):
         thread_id = threading.current_thread().ident
         for table in self.tables:
             table.rollback(thread_id)
+        transaction_context.active = False
+        mvcc.end_snapshot(self.snapshot)
+        self.release_locks()
+        if self.wal is not None:
+            self.wal.abort(self.txn_id)
         return False
 
+    """
+    Returns once the commit is durable. Concurrent commits share their log
+    flushes (see WriteAheadLog.flush). The transaction's changes become
+    visible to other snapshots after that, all at once (see mvcc.commit).
+    """
     def commit(self):
         thread_id = threading.current_thread().ident
+        if self.wal is not None:
+            self.wal.commit(self.txn_id)
+        mvcc.commit([table.versions for table in self.tables], thread_id)
         for table in self.tables:
             table.commit(thread_id)
+        transaction_context.active = False
+        mvcc.end_snapshot(self.snapshot)
+        self.release_locks()
         return True
+
+    def release_locks(self):
+        if self.lock_owner is None:
+            return
+        for table in self.tables:
+            table.lock_manager.release_all(self.lock_owner)
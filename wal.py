@@ -0,0 +1,373 @@
+import config
+import os
+import struct
+import threading
+import zlib
+
+"""
+Write-ahead log. Every change to a table's pages, page directory or indices is
+appended to the log before it is made, and the log is forced to disk when a
+transaction commits, so committed changes survive a crash without the buffer
+pool having to write back the pages they touched.
+
+The log is a sequence of binary records:
+
+    payload length (uint32) | transaction id (uint64) | record type (uint8) |
+    payload | crc32 of everything before it (uint32)
+
+all little-endian. The payload of a table record is the table name (uint16
+length followed by utf-8 bytes) and a list of int64 values whose meaning
+depends on the record type (see below); BEGIN, COMMIT and ABORT records have no
+payload. The log sequence number (LSN) of a record is its byte offset from the
+start of the log. The log is split into segment files of about
+config.WAL_SEGMENT_SIZE bytes, named after the LSN of their first record in
+hex, so a record is found by LSN without reading the segments in front of it.
+
+Records are appended to an in-memory buffer, which is written out and fsynced
+by flush(). Commits use group commit: the first committing thread that finds
+no flush in progress becomes the leader and flushes everything appended so
+far, including the commit records of every thread that appended its record in
+the meantime; those threads just wait for the leader, so concurrent commits
+share a single fsync.
+
+Records that are not part of a transaction (plain Query calls) have
+transaction id 0. They are forced to disk by the next commit, by the
+background page writer (every config.WRITER_INTERVAL seconds) and on close.
+A page is never written back before the log records of the changes made to it
+are on disk (see Page.lsn and BufferPool.flush_log).
+"""
+
+BEGIN = 1
+COMMIT = 2
+ABORT = 3
+
+"""
+INSERT: range_idx, first_page_id, offset, time_stamp, count, followed by count
+rids and then count rows of column values. A range_idx equal to the number of
+page ranges means the records started a new page range, whose base and
+metadata pages are num_columns + 4 consecutive page ids from first_page_id.
+"""
+INSERT = 4
+
+"""
+UPDATE (a tail record append): base_rid, tail_rid, range_idx,
+tail_first_page_id, tail_offset, time_stamp, tail_schema, base_schema_page_id,
+base_offset, old_pointer, old_base_schema, followed by one value per column
+(0 for columns that are not updated). A tail_first_page_id that is not part of
+the page range yet means a new set of num_columns + 5 tail pages was
+allocated for the record.
+"""
+UPDATE = 5
+
+"""
+DELETE, UNDO_INSERT and UNDO_DELETE: rid, first_page_id, schema_page_id,
+offset, range_idx (the record's page directory entry).
+UNDO_UPDATE: base_rid, tail_rid, base_schema_page_id, base_offset, pointer,
+schema (the base indirection pointer and schema encoding the rollback
+restored).
+The UNDO_ records are written when a transaction is rolled back, so replaying
+the log in order repeats rollbacks as well.
+"""
+DELETE = 6
+UNDO_INSERT = 7
+UNDO_DELETE = 8
+UNDO_UPDATE = 9
+
+"""
+INDEX: op, column_number, followed by (rid, key, new_key) triples. new_key is
+only used by INDEX_UPDATE. INDEX_CREATE (followed by 1 for an ordered index, 0
+otherwise) and INDEX_DROP have no triples.
+"""
+INDEX = 10
+INDEX_ADD = 0
+INDEX_UPDATE = 1
+INDEX_DELETE = 2
+INDEX_CREATE = 3
+INDEX_DROP = 4
+
+"""
+MERGE: range_idx, version, first_page_id, tps. The base column pages of the
+page range were replaced by the num_columns pages from first_page_id, which
+hold every tail record of the range down to tail rid tps and were on disk
+before the record was logged (see Table.merge_range).
+"""
+MERGE = 11
+
+"""
+DIRECTORY: group, page_id. The group of rids got directory page page_id (see
+PageDirectory.reserve).
+"""
+DIRECTORY = 12
+
+HEADER = struct.Struct('<IQB')
+CHECKSUM = struct.Struct('<I')
+NAME_LENGTH = struct.Struct('<H')
+
+def encode_record(record_type, txn_id, table_name=None, values=()):
+    if table_name is None:
+        payload = b''
+    else:
+        name = table_name.encode()
+        payload = (NAME_LENGTH.pack(len(name)) + name +
+                struct.pack('<%dq' % len(values), *values))
+    header = HEADER.pack(len(payload), txn_id, record_type)
+    checksum = zlib.crc32(payload, zlib.crc32(header))
+    return header + payload + CHECKSUM.pack(checksum)
+
+"""
+Decodes the records in data, starting at offset. Yields (offset, txn_id,
+record_type, table_name, values) tuples and stops at the end of data or at the
+first record that is cut short or fails its checksum (a torn write at the end
+of the log).
+"""
+def decode_records(data, offset=0):
+    while offset + HEADER.size <= len(data):
+        length, txn_id, record_type = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length + CHECKSUM.size
+        if end > len(data):
+            return
+        payload = data[offset + HEADER.size:end - CHECKSUM.size]
+        checksum = zlib.crc32(payload, zlib.crc32(data[offset:offset + HEADER.size]))
+        if CHECKSUM.unpack_from(data, end - CHECKSUM.size)[0] != checksum:
+            return
+        table_name = None
+        values = ()
+        if length:
+            name_length = NAME_LENGTH.unpack_from(payload)[0]
+            name_end = NAME_LENGTH.size + name_length
+            table_name = bytes(payload[NAME_LENGTH.size:name_end]).decode()
+            values = struct.unpack_from('<%dq' % ((length - name_end) // 8),
+                    payload, name_end)
+        yield offset, txn_id, record_type, table_name, values
+        offset = end
+
+
+class WriteAheadLog:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        """
+        Records appended since the last flush, and the LSN the next record will
+        get. Both are only touched while holding append_lock.
+        """
+        self.append_lock = threading.Lock()
+        self.buffer = bytearray()
+        self.next_lsn = 0
+        """
+        Group commit: flushed_lsn is the LSN up to which the log is on disk.
+        At most one thread (the leader) flushes at a time; the others wait on
+        flush_done until their records are covered.
+        """
+        self.flush_done = threading.Condition()
+        self.flushed_lsn = 0
+        self.flushing = False
+        """
+        The transaction id of the transaction the calling thread is running,
+        if any (see begin).
+        """
+        self.context = threading.local()
+        """
+        The LSN of the BEGIN record of every transaction that has neither
+        committed nor aborted yet, by transaction id (see checkpoint_lsns).
+        """
+        self.active = {}
+        self.segment_fd = None
+        self.segment_start = 0
+        self.commits = 0
+        self.syncs = 0
+        self.open_segments()
+
+    """
+    Returns the start LSNs of the segment files, in log order.
+    """
+    def segments(self):
+        starts = []
+        for file_name in os.listdir(self.path):
+            try:
+                starts.append(int(file_name, 16))
+            except ValueError:
+                continue
+        return sorted(starts)
+
+    def segment_path(self, start):
+        return self.path + '/' + '%016x' % start
+
+    """
+    Opens the last segment for appending. Anything after the last complete
+    record (a write that was torn by a crash) is cut off.
+    """
+    def open_segments(self):
+        starts = self.segments()
+        if not starts:
+            self.new_segment(0)
+            return
+        start = starts[-1]
+        with open(self.segment_path(start), mode='rb') as f:
+            data = f.read()
+        end = 0
+        for offset, txn_id, record_type, table_name, values in decode_records(data):
+            end = offset + HEADER.size + HEADER.unpack_from(data, offset)[0] + CHECKSUM.size
+        self.segment_fd = os.open(self.segment_path(start), os.O_RDWR)
+        if end != len(data):
+            os.ftruncate(self.segment_fd, end)
+        self.segment_start = start
+        self.next_lsn = self.flushed_lsn = start + end
+
+    def new_segment(self, start):
+        if self.segment_fd is not None:
+            os.close(self.segment_fd)
+        self.segment_fd = os.open(self.segment_path(start),
+                os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.segment_start = start
+        # make the new file itself durable:
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    """
+    Appends a record for the calling thread's transaction and returns the LSN
+    just past it: the record is durable once the log has been flushed up to
+    that LSN.
+    """
+    def log(self, record_type, table_name=None, values=(), txn_id=None):
+        if txn_id is None:
+            txn_id = getattr(self.context, 'txn_id', 0)
+        record = encode_record(record_type, txn_id, table_name, values)
+        with self.append_lock:
+            self.buffer += record
+            self.next_lsn += len(record)
+            return self.next_lsn
+
+    """
+    Starts a transaction on the calling thread. Records the thread logs until
+    commit or abort belong to it. The transaction id is one past the LSN of
+    the BEGIN record, so ids are never reused, not even across restarts, and
+    are never 0.
+    """
+    def begin(self):
+        with self.append_lock:
+            txn_id = self.next_lsn + 1
+            record = encode_record(BEGIN, txn_id)
+            self.active[txn_id] = self.next_lsn
+            self.buffer += record
+            self.next_lsn += len(record)
+        self.context.txn_id = txn_id
+        return txn_id
+
+    """
+    Logs the commit of a transaction and returns once it is durable.
+    """
+    def commit(self, txn_id):
+        lsn = self.end(COMMIT, txn_id)
+        self.context.txn_id = 0
+        self.flush(lsn)
+        self.commits += 1
+
+    """
+    Logs the end of a rolled back transaction. Does not wait for the disk: a
+    transaction without a COMMIT record is rolled back either way.
+    """
+    def abort(self, txn_id):
+        self.end(ABORT, txn_id)
+        self.context.txn_id = 0
+
+    def end(self, record_type, txn_id):
+        record = encode_record(record_type, txn_id)
+        with self.append_lock:
+            self.active.pop(txn_id, None)
+            self.buffer += record
+            self.next_lsn += len(record)
+            return self.next_lsn
+
+    """
+    Returns the LSN a checkpoint starting now covers the log up to, and the
+    LSN of the oldest record that rolling back the transactions that are
+    still running may need.
+    """
+    def checkpoint_lsns(self):
+        with self.append_lock:
+            return self.next_lsn, min(self.active.values(), default=self.next_lsn)
+
+    """
+    Deletes the segment files that only hold records before lsn. The current
+    segment is always kept.
+    """
+    def truncate(self, lsn):
+        starts = self.segments()
+        for i in range(len(starts) - 1):
+            if starts[i + 1] <= lsn and starts[i] != self.segment_start:
+                os.unlink(self.segment_path(starts[i]))
+
+    """
+    Returns once the log is on disk up to lsn (by default, up to the last
+    record appended so far).
+    """
+    def flush(self, lsn=None):
+        if lsn is None:
+            lsn = self.next_lsn
+        with self.flush_done:
+            while self.flushed_lsn < lsn and self.flushing:
+                self.flush_done.wait()
+            if self.flushed_lsn >= lsn:
+                return
+            self.flushing = True
+        # this thread is the leader, and flushes everything appended so far
+        flushed_lsn = self.flushed_lsn
+        try:
+            with self.append_lock:
+                data = self.buffer
+                self.buffer = bytearray()
+                end = self.next_lsn
+            self.write(data, end - len(data))
+            flushed_lsn = end
+        finally:
+            with self.flush_done:
+                self.flushed_lsn = flushed_lsn
+                self.flushing = False
+                self.flush_done.notify_all()
+
+    """
+    Writes data, which starts at LSN start, to the current segment and fsyncs
+    it. Starts a new segment first if the current one is full. Only called by
+    the flush leader.
+    """
+    def write(self, data, start):
+        if start - self.segment_start >= config.WAL_SEGMENT_SIZE:
+            os.fsync(self.segment_fd)
+            self.new_segment(start)
+        view = memoryview(data)
+        position = start - self.segment_start
+        while view:
+            written = os.pwrite(self.segment_fd, view, position)
+            view = view[written:]
+            position += written
+        os.fsync(self.segment_fd)
+        self.syncs += 1
+
+    """
+    Yields (lsn, txn_id, record_type, table_name, values) for every durable
+    record from start_lsn on, in log order.
+    """
+    def records(self, start_lsn=0):
+        self.flush()
+        starts = self.segments()
+        for i in range(len(starts)):
+            if i + 1 < len(starts) and starts[i + 1] <= start_lsn:
+                continue
+            with open(self.segment_path(starts[i]), mode='rb') as f:
+                data = f.read()
+            offset = max(0, start_lsn - starts[i])
+            for record in decode_records(data, offset):
+                yield (starts[i] + record[0],) + record[1:]
+
+    def stats(self):
+        return {'commits': self.commits, 'syncs': self.syncs,
+                'flushed_lsn': self.flushed_lsn, 'next_lsn': self.next_lsn}
+
+    def close(self):
+        self.flush()
+        os.close(self.segment_fd)
+        self.segment_fd = None